@@ -1,12 +1,154 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify
+import json
+import time
 import strava_api
-import polyline
-import networkx as nx
-import math
-import osmnx as ox
+import spatial_index
+import os
+import requests
+from connectors import ConnectorMatrix
+from csr_graph import as_csr
+from graph_server import RemoteGraphStore
+from graph_store import GraphTileStore
+import corridor
+import simplify
+import metrics
+import wire_format
+from jobs import JobCancelled, JobQueue
+from match_cache import MatchCache
+from route_cache import RouteCache, route_key
+from route_session import RouteSessionStore
+from segment_cache import SegmentCache
+from segment_network import SegmentNetworkCache
+from warmup import WarmUp, parse_regions
 
 app = Flask(__name__)
 
+# Road-network tiles are cached on disk and shared across requests; under
+# serve.py one loader process holds the graphs in shared memory for all workers
+if os.environ.get('GRAPH_SERVER_ADDRESS'):
+    graph_tiles = RemoteGraphStore(os.environ['GRAPH_SERVER_ADDRESS'],
+                                   os.environ.get('GRAPH_SERVER_AUTHKEY', '').encode())
+else:
+    graph_tiles = GraphTileStore(
+        os.environ.get('GRAPH_TILE_DIR', 'graph_tiles'),
+        offline=os.environ.get('GRAPH_TILE_OFFLINE', '0') == '1',
+        max_bytes=int(float(os.environ['GRAPH_TILE_MAX_MB']) * 1024 * 1024) if os.environ.get('GRAPH_TILE_MAX_MB') else None,
+        landmarks=int(os.environ.get('GRAPH_LANDMARKS', 0)),
+    )
+
+# Route jobs, route sessions, segments sent to clients and planned routes
+# are kept in this SQLite file, which every server process opens, so any
+# worker can answer for them; serve.py sets it up for its workers
+server_state_path = os.environ.get('SERVER_STATE_PATH', ':memory:')
+
+# Strava segment-explore results, reused across overlapping viewports
+segment_cache = SegmentCache(
+    ttl=float(os.environ.get('SEGMENT_CACHE_TTL', 3600)),
+    max_tiles=int(os.environ.get('SEGMENT_CACHE_TILES', 1024)),
+    path=server_state_path,
+)
+
+# Matched segments and connector distances persist across requests and
+# restarts; an empty MATCH_CACHE_PATH turns the cache off
+match_cache_path = os.environ.get('MATCH_CACHE_PATH', 'match_cache.sqlite')
+match_results = MatchCache(match_cache_path) if match_cache_path else None
+# Route planning runs on a small pool so it never holds every request thread
+best_path_jobs = JobQueue(server_state_path, max_workers=int(os.environ.get('BEST_PATH_WORKERS', 2)))
+# Finished /best-path routes by request; identical requests in flight share
+# one computation. ROUTE_CACHE_MB=0 turns it off
+route_cache_mb = float(os.environ.get('ROUTE_CACHE_MB', 64))
+route_cache = RouteCache(
+    server_state_path,
+    max_bytes=int(route_cache_mb * 1024 * 1024),
+    ttl=float(os.environ.get('ROUTE_CACHE_TTL', 3600)),
+    retry_errors=(JobCancelled,),
+) if route_cache_mb > 0 else None
+# Routes being edited keep their graph, matches and connectors between updates
+route_sessions = RouteSessionStore(
+    server_state_path,
+    ttl=float(os.environ.get('ROUTE_SESSION_TTL', 1800)),
+    max_sessions=int(os.environ.get('ROUTE_SESSION_MAX', 100)),
+)
+# Douglas-Peucker importance of segment and route geometry, reused across zoom levels
+line_importance = simplify.ImportanceCache(max_lines=int(os.environ.get('SIMPLIFY_CACHE_LINES', 4096)))
+# /find-path networks of recently queried segment sets
+segment_networks = SegmentNetworkCache(max_networks=int(os.environ.get('SEGMENT_NETWORK_MAX', 32)))
+# Graphs of the regions in WARMUP_REGIONS ("lat_min,lon_min,lat_max,lon_max;...")
+# load in the background at startup; /ready reports when they are in
+warm_up = WarmUp(
+    graph_tiles,
+    parse_regions(os.environ.get('WARMUP_REGIONS')),
+    viewports=match_results.viewports_within if match_results is not None else None,
+    max_graphs=getattr(graph_tiles, 'memory_graphs', 8),
+)
+warm_up.start()
+# Seconds between keep-alive comments on an idle progress stream
+JOB_KEEPALIVE = 15
+
+# Send stage timings back in a Server-Timing header unless turned off
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '1') == '1'
+
+def collect_cache_metrics():
+    samples = [('cache_requests_total', 'counter', {'cache': 'segments', 'result': 'hit'}, segment_cache.hits),
+               ('cache_requests_total', 'counter', {'cache': 'segments', 'result': 'miss'}, segment_cache.misses)]
+    if match_results is not None:
+        samples += [('cache_requests_total', 'counter', {'cache': 'matches', 'result': 'hit'}, match_results.hits),
+                    ('cache_requests_total', 'counter', {'cache': 'matches', 'result': 'miss'}, match_results.misses)]
+    if route_cache is not None:
+        samples += [('cache_requests_total', 'counter', {'cache': 'routes', 'result': 'hit'}, route_cache.hits),
+                    ('cache_requests_total', 'counter', {'cache': 'routes', 'result': 'miss'}, route_cache.misses),
+                    ('cache_requests_total', 'counter', {'cache': 'routes', 'result': 'coalesced'}, route_cache.coalesced),
+                    ('route_cache_bytes', 'gauge', {}, route_cache.nbytes)]
+    return samples
+
+metrics.register_collector(collect_cache_metrics)
+
+@app.before_request
+def start_request_metrics():
+    request.environ['metrics.start'] = time.perf_counter()
+    metrics.start_request()
+
+@app.after_request
+def finish_request_metrics(response):
+    duration = time.perf_counter() - request.environ['metrics.start']
+    endpoint = request.endpoint or 'unknown'
+    metrics.observe('request_seconds', duration, endpoint=endpoint)
+    metrics.increment('requests_total', endpoint=endpoint, status=response.status_code)
+    server_timing = metrics.finish_request()
+    if SERVER_TIMING:
+        total = f"total;dur={duration * 1000:.1f}"
+        response.headers['Server-Timing'] = f"{server_timing}, {total}" if server_timing else total
+    return response
+
+def send_payload(payload, status=200):
+    """
+    Respond with JSON, or with a compact encoding the client accepts.
+    
+    See wire_format for the encodings; clients that send no Accept header
+    get the same JSON as before.
+    """
+    media_type = wire_format.negotiate(request.accept_mimetypes)
+    if media_type == wire_format.JSON_TYPE:
+        response = jsonify(payload)
+    else:
+        with metrics.timed('encode'):
+            response = Response(wire_format.encode(payload, media_type), mimetype=media_type)
+    response.status_code = status
+    response.vary.add('Accept')
+    return response
+
+@app.route('/ready')
+def ready():
+    """
+    Readiness probe: 503 until the warm-up has loaded its graphs.
+    """
+    status = warm_up.status()
+    return jsonify(status), 200 if status['ready'] else 503
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -27,207 +169,561 @@ def update_segments():
     lat_max = northeast['lat']
     lon_max = northeast['lng']
 
-    access_token = strava_api.get_access_token(strava_api.CLIENT_ID, 
-                strava_api.CLIENT_SECRET, strava_api.REFRESH_TOKEN)
+    def fetch_segments(lat_min, lon_min, lat_max, lon_max):
+        # The token is reused until it expires
+        access_token = strava_api.token_manager.get_token()
+        try:
+            result = strava_api.search_segments(lat_min, lon_min, lat_max, lon_max, access_token)
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 401:
+                raise
+            # Revoked before it expired, refresh once and try again
+            strava_api.token_manager.invalidate()
+            result = strava_api.search_segments(lat_min, lon_min, lat_max, lon_max,
+                                                strava_api.token_manager.get_token())
+        return result['segments']
 
-    # Search for segments
-    segments = strava_api.search_segments(lat_min, lon_min, lat_max, lon_max, access_token)
-    
-    #decode polyline to coordinates
-    segments = segments['segments']
-    for segment in segments:
-        encoded_polyline = segment['points']
-        decoded_points = polyline.decode(encoded_polyline)
-        segment['points'] = decoded_points
+    # Search for segments, decoded polylines come back from the cache
+    with metrics.profiled('update_segments'):
+        segments = segment_cache.get_segments(lat_min, lon_min, lat_max, lon_max, fetch_segments)
+
+    # Only as much detail as the map can show; /segments/<id> has the rest
+    tolerance = requested_tolerance(data, (lat_min + lat_max) / 2)
+    if tolerance:
+        with metrics.timed('simplify'):
+            segments = [simplify_segment(segment, tolerance) for segment in segments]
 
     #return the segment results to page
-    return jsonify(segments)
+    return send_payload(segments)
+
+@app.route('/segments/<int:segment_id>', methods=['GET'])
+def get_segment(segment_id):
+    """
+    Return a segment /update-segments sent recently, with every point.
+    """
+    segment = segment_cache.get_segment(segment_id)
+    if segment is None:
+        return jsonify({'error': 'Segment no longer cached'}), 404
+    segment.pop('points_encoded', None)
+    return send_payload(segment)
+
+@app.route('/routes/<route_id>', methods=['GET'])
+def get_route(route_id):
+    """
+    Return a route planned recently by its route_id, with every point unless
+    a 'zoom' or 'tolerance' query parameter asks for less.
+    """
+    route = route_cache.get(route_id) if route_cache is not None else None
+    if route is None:
+        return jsonify({'error': 'Route no longer cached'}), 404
+    return send_payload(simplify_for_request(route, request.args))
+
+def requested_tolerance(data, lat):
+    """
+    Simplification tolerance a request asks for, in meters.
+    
+    Args:
+        data: request body or query parameters with an optional 'tolerance'
+            in meters or map 'zoom' level
+        lat: latitude the geometry is at, for converting a zoom level
+    
+    Returns:
+        Tolerance in meters, or None for full detail
+    """
+    if data.get('tolerance') is not None:
+        return float(data['tolerance'])
+    if data.get('zoom') is not None:
+        return simplify.zoom_tolerance(data['zoom'], lat)
+    return None
+
+def simplify_segment(segment, tolerance):
+    """
+    Copy of a segment with its points simplified to a tolerance in meters.
+    """
+    points = segment['points']
+    key = ('segment', segment['id'], hash(tuple(map(tuple, points))))
+    simplified, _ = simplify.simplify_line(points, tolerance, line_importance.get(key, points))
+    return dict(segment, points=simplified, tolerance=tolerance)
+
+def simplify_for_request(route, data):
+    """
+    Simplify a route's path as far as a request's zoom or tolerance allows.
+    
+    Routes with a route_id reuse the cached importance of their path, and
+    their full path stays available from /routes/<route_id>.
+    """
+    if not route.get('path'):
+        return route
+    tolerance = requested_tolerance(data, route['path'][0][0])
+    if not tolerance:
+        return route
+    importance = None
+    if route.get('route_id'):
+        # A route session may re-plan the same route_id along another path
+        key = ('route', route['route_id'], len(route['path']), route['total_distance'])
+        importance = line_importance.get(key, route['path'])
+    with metrics.timed('simplify'):
+        return simplify.simplify_route(route, tolerance, importance)
 
 @app.route('/find-path', methods=['POST'])
 def find_path():
     data = request.json
-    segments = data.get('segments')
+    try:
+        segments = resolve_segments(data)['segments']
+    except BestPathError as e:
+        return jsonify({'error': str(e)}), e.status
     start_point = data.get('start')  # {'lat': value, 'lng': value}
     end_point = data.get('end')      # {'lat': value, 'lng': value}
 
-    # Create a graph from the segments
-    G = nx.Graph()
-    
-    # Add all segment points as nodes and create edges
-    for i, segment in enumerate(segments):
-        points = segment['points']
-        # Add nodes for each point in the segment
-        for j in range(len(points) - 1):
-            point1 = points[j]
-            point2 = points[j + 1]
-            
-            # Calculate distance between points
-            distance = calculate_distance(point1[0], point1[1], point2[0], point2[1])
-            
-            # Add edge with distance as weight
-            G.add_edge(
-                f"{i}_{j}", 
-                f"{i}_{j+1}", 
-                weight=distance,
-                segment_id=segment['id']
-            )
-
-    # Find closest nodes to start and end points
-    start_node = find_closest_node(G, start_point)
-    end_node = find_closest_node(G, end_point)
-
-    try:
-        # Find shortest path
-        path = nx.shortest_path(G, start_node, end_node, weight='weight')
-        
-        # Get the actual coordinates for the path
-        path_coordinates = []
-        for node in path:
-            segment_idx, point_idx = map(int, node.split('_'))
-            point = segments[segment_idx]['points'][point_idx]
-            path_coordinates.append([point[0], point[1]])
-
-        return jsonify({
-            'path': path_coordinates,
-            'distance': sum(G[path[i]][path[i+1]]['weight'] for i in range(len(path)-1))
-        })
-    except nx.NetworkXNoPath:
+    # The network of the same segments is reused across queries
+    with metrics.timed('segment_network'):
+        network = segment_networks.get(segments)
+    if network.graph.n_nodes == 0:
+        return jsonify({'error': 'No path found'}), 404
+    path, distance = network.shortest_path((start_point['lat'], start_point['lng']),
+                                           (end_point['lat'], end_point['lng']))
+    if path is None:
         return jsonify({'error': 'No path found'}), 404
 
+    return jsonify({
+        'path': path,
+        # Kilometers, as this endpoint has always reported
+        'distance': distance / 1000
+    })
+
+class BestPathError(Exception):
+    """
+    A /best-path request that cannot be planned, with its HTTP status.
+    """
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.status = status
+
+def resolve_segments(data):
+    """
+    Look up the segments a route request names by id.
+    
+    Clients can send 'segment_ids' of segments /update-segments returned
+    instead of posting their points back; they come from the segment cache.
+    
+    Args:
+        data: request body with 'segments' and/or 'segment_ids'
+    
+    Returns:
+        Copy of data with every segment in 'segments'
+    """
+    segment_ids = data.get('segment_ids')
+    if not segment_ids:
+        return data
+    segments = list(data.get('segments') or [])
+    missing = []
+    for segment_id in segment_ids:
+        segment = segment_cache.get_segment(segment_id)
+        if segment is None:
+            missing.append(segment_id)
+        else:
+            segments.append(segment)
+    if missing:
+        # Expired from the cache, the client has to send these in full
+        raise BestPathError(f"Segments no longer cached: {', '.join(str(i) for i in missing)}", 409)
+    return dict(data, segments=segments)
+
 @app.route('/best-path', methods=['POST'])
 def best_path():
     try:
-        data = request.json
-        segments = data.get('segments')
-
-        if not segments:
-            return jsonify({'error': 'No segments provided'}), 400
-
-        # Calculate bounding box from all segments
-        all_points = []
-        for segment in segments:
-            all_points.extend(segment['points'])
-        
-        lats = [p[0] for p in all_points]
-        lons = [p[1] for p in all_points]
-        north, south = max(lats), min(lats)
-        east, west = max(lons), min(lons)
-        
-        # Add padding to ensure we have enough road network
-        padding = 0.001  # approximately 100m
-        north += padding
-        south -= padding
-        east += padding
-        west -= padding
-
-        print(f"Building graph for bbox: {north}, {south}, {east}, {west}")
-
-        # Get the OSMnx graph for the area using smallest boundary
-        graph = get_graph_from_smallest_boundary(north, south, east, west, 'walk')
-        
-        if len(graph.nodes) == 0:
-            return jsonify({'error': 'No road network found in the specified area'}), 404
-
-        # Find the best path through all segments
-        result = find_best_path_through_segments(graph, segments)
-
-        return jsonify({
-            'path': result['path'],
-            'segments': result['segments'],
-            'total_distance': result['total_distance'],
-            'optimal_order': result['optimal_order'],
-            'segments_covered': len(segments)
-        })
-
+        return send_payload(plan_best_path(resolve_segments(request.json)))
+    except BestPathError as e:
+        return jsonify({'error': str(e)}), e.status
     except Exception as e:
         print(f"Error in best_path: {str(e)}")
         return jsonify({'error': f'Error finding best path: {str(e)}'}), 500
 
-def calculate_distance(lat1, lon1, lat2, lon2):
-    """Calculate the distance between two points using the Haversine formula"""
-    R = 6371  # Earth's radius in kilometers
+@app.route('/best-path/jobs', methods=['POST'])
+def submit_best_path_job():
+    """
+    Plan a route in the background; a newer job from the same client
+    cancels this one.
+    """
+    try:
+        data = resolve_segments(request.json)
+    except BestPathError as e:
+        return jsonify({'error': str(e)}), e.status
+    job = best_path_jobs.submit(plan_best_path, data, client_id=data.get('client_id'))
+    return jsonify({'job_id': job.id, 'status': job.status}), 202
 
-    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
+@app.route('/best-path/jobs/<job_id>', methods=['GET'])
+def get_best_path_job(job_id):
+    job = best_path_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job.to_dict())
 
-    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-    c = 2 * math.asin(math.sqrt(a))
-    return R * c
+@app.route('/best-path/jobs/<job_id>', methods=['DELETE'])
+def cancel_best_path_job(job_id):
+    job = best_path_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    job.cancel()
+    return jsonify(job.to_dict())
 
-def find_closest_node(G, point):
-    """Find the closest node in the graph to a given point"""
-    min_distance = float('inf')
-    closest_node = None
-    
-    for node in G.nodes():
-        segment_idx, point_idx = map(int, node.split('_'))
-        node_point = segments[segment_idx]['points'][point_idx]
-        
-        distance = calculate_distance(point['lat'], point['lng'], node_point[0], node_point[1])
-        if distance < min_distance:
-            min_distance = distance
-            closest_node = node
+@app.route('/best-path/jobs/<job_id>/result', methods=['GET'])
+def get_best_path_job_result(job_id):
+    """
+    Return the route of a finished job, in any encoding the client accepts.
+    """
+    job = best_path_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if job.status == 'done':
+        return send_payload(job.result)
+    if job.status == 'failed':
+        return jsonify({'error': job.error}), 500
+    return jsonify({'error': f'Job is {job.status}'}), 409
+
+@app.route('/best-path/jobs/<job_id>/events', methods=['GET'])
+def stream_best_path_job(job_id):
+    """
+    Stream job progress as server-sent events, ending with the result.
     
-    return closest_node
+    With ?result=0 the final event leaves the result out, for clients that
+    fetch it from /best-path/jobs/<job_id>/result in a compact encoding.
+    """
+    job = best_path_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    include_result = request.args.get('result', '1') != '0'
 
-def get_graph_from_smallest_boundary(north, south, east, west, network_type='walk'):
+    def events():
+        sent = 0
+        while True:
+            new_events = job.wait_events(sent, timeout=JOB_KEEPALIVE)
+            if not new_events:
+                # Keep proxies from closing an idle stream
+                yield ': keep-alive\n\n'
+                continue
+            sent += len(new_events)
+            for event in new_events:
+                if event['stage'] in ('done', 'failed', 'cancelled'):
+                    event = dict(event, result=job.result if include_result else None, error=job.error)
+                yield f"event: {event['stage']}\ndata: {json.dumps(event)}\n\n"
+            if job.done and sent == len(job.events):
+                return
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def route_bounds(segments, start=None, end=None):
     """
-    Get a graph from the smallest administrative boundary that contains the bounding box.
+    Bounding box of the road network a route needs.
     
     Args:
-        north, south, east, west: bounding box coordinates
-        network_type: 'walk', 'bike', 'drive', etc.
+        segments: List of segment objects with 'points' field
+        start, end: optional {'lat': value, 'lng': value}
     
     Returns:
-        OSMnx graph object
+        Tuple of (north, south, east, west) with ~100 m of padding
     """
-    # Calculate the center point of the bounding box
-    center_lat = (north + south) / 2
-    center_lon = (east + west) / 2
+    # Calculate bounding box from all segments and the start and end points
+    all_points = []
+    for segment in segments:
+        all_points.extend(segment['points'])
+    for point in (start, end):
+        if point is not None:
+            all_points.append([point['lat'], point['lng']])
     
-    print(f"Center point: {center_lat}, {center_lon}")
+    lats = [p[0] for p in all_points]
+    lons = [p[1] for p in all_points]
     
+    # Add padding to ensure we have enough road network
+    padding = 0.001  # approximately 100m
+    return max(lats) + padding, min(lats) - padding, max(lons) + padding, min(lons) - padding
+
+@app.route('/route-sessions', methods=['POST'])
+def create_route_session():
+    """
+    Start a route that is updated segment by segment.
+    """
+    session = route_sessions.create()
+    return jsonify({'session_id': session.id}), 201
+
+@app.route('/route-sessions/<session_id>', methods=['PUT'])
+def update_route_session(session_id):
+    """
+    Set a session's segments and return the re-planned route.
+    """
+    session = route_sessions.get(session_id)
+    if session is None:
+        return jsonify({'error': 'Unknown route session'}), 404
     try:
-        # Try to get graph from point with a reasonable distance
-        # Use 1000 meters radius to get a neighborhood-sized area
-        graph = ox.graph.graph_from_point(
-            (center_lat, center_lon),
-            dist=1000,  # 1km radius
-            network_type=network_type,
-            simplify=True
-        )
-        print(f"Found graph with {len(graph.nodes)} nodes and {len(graph.edges)} edges")
-        return graph
+        return send_payload(plan_session_route(session, resolve_segments(request.json)))
+    except BestPathError as e:
+        return jsonify({'error': str(e)}), e.status
     except Exception as e:
-        print(f"Could not get point-based graph: {e}")
-        print("Falling back to bounding box method...")
-        
-        # Fall back to bounding box method
-        bbox = (north, south, east, west)
-        graph = ox.graph.graph_from_bbox(*bbox, network_type=network_type)
-        return graph
+        print(f"Error in route session {session_id}: {str(e)}")
+        return jsonify({'error': f'Error finding best path: {str(e)}'}), 500
 
-def find_best_path_through_segments(graph, segments):
+@app.route('/route-sessions/<session_id>/jobs', methods=['POST'])
+def submit_route_session_job(session_id):
+    """
+    Update a session in the background; progress streams from
+    /best-path/jobs/<job_id>/events and a newer update cancels this one.
+    """
+    session = route_sessions.get(session_id)
+    if session is None:
+        return jsonify({'error': 'Unknown route session'}), 404
+    try:
+        data = resolve_segments(request.json)
+    except BestPathError as e:
+        return jsonify({'error': str(e)}), e.status
+    job = best_path_jobs.submit(plan_session_route, session, data, client_id=session.id)
+    return jsonify({'job_id': job.id, 'status': job.status}), 202
+
+@app.route('/route-sessions/<session_id>', methods=['DELETE'])
+def delete_route_session(session_id):
+    if not route_sessions.delete(session_id):
+        return jsonify({'error': 'Unknown route session'}), 404
+    return jsonify({'session_id': session_id, 'status': 'deleted'})
+
+@metrics.profiled('route_session')
+def plan_session_route(session, data, progress=None):
+    """
+    Update a route session with the segments of a request and plan the route.
+    
+    Only segments the session has not matched yet are matched and connected;
+    the graph is reloaded only when the route grows outside of it.
+    
+    Args:
+        session: RouteSession
+        data: request body with 'segments' and optional 'start', 'end' and 'loop'
+        progress: optional callable(stage, **details) run after each step
+    
+    Returns:
+        Dictionary for the JSON response, as for /best-path
+    """
+    segments = data.get('segments')
+    start = data.get('start')  # optional {'lat': value, 'lng': value}
+    end = data.get('end')  # optional {'lat': value, 'lng': value}
+    loop = bool(data.get('loop', False))
+
+    if not segments:
+        raise BestPathError('No segments provided', 400)
+
+    # A cancelled update leaves the session consistent, the next one waits for it
+    with session.lock:
+        north, south, east, west = route_bounds(segments, start, end)
+        if session.covers(north, south, east, west):
+            graph = session.graph
+        else:
+            print(f"Building graph for bbox: {north}, {south}, {east}, {west}")
+            graph = get_graph_from_smallest_boundary(north, south, east, west, 'walk')
+            if graph.n_nodes == 0:
+                raise BestPathError('No road network found in the specified area', 404)
+        if progress is not None:
+            progress('graph_loaded', nodes=graph.n_nodes)
+
+        route = session.update(graph, segments, start, loop, cache=match_results, progress=progress, end=end)
+        route_sessions.save(session)
+        plan = route['plan']
+        with metrics.timed('assemble'):
+            complete_path, segment_info = assemble_route(graph, route['segments'], route['paths'],
+                                                         route['connectors'], plan['order'], loop)
+
+    result = {
+        'path': complete_path,
+        'segments': segment_info,
+        'total_distance': plan['cost'],
+        'baseline_distance': plan['baseline_cost'],
+        'optimal_order': plan['order'],
+        'segments_covered': len(route['segments'])
+    }
+    if route_cache is not None:
+        # Same route as /best-path plans for the session's segment order
+        result['route_id'] = route_key(route['segments'], start, loop, end)
+        route_cache.put(result['route_id'], result)
+    return simplify_for_request(result, data)
+
+@metrics.profiled('best_path')
+def plan_best_path(data, progress=None):
+    """
+    Plan the best route through the segments of a /best-path request.
+    
+    Results come from route_cache when the same segments and options were
+    planned before or are being planned right now.
+    
+    Args:
+        data: request body with 'segments' and optional 'start', 'end' and 'loop'
+        progress: optional callable(stage, **details) run after each step
+    
+    Returns:
+        Dictionary for the JSON response
+    """
+    if not data.get('segments'):
+        raise BestPathError('No segments provided', 400)
+    if route_cache is None:
+        return simplify_for_request(compute_best_path(data, progress), data)
+
+    key = route_key(data['segments'], data.get('start'), data.get('loop', False), data.get('end'))
+    result, how = route_cache.get_or_compute(key, lambda: dict(compute_best_path(data, progress), route_id=key))
+    if how != 'miss' and progress is not None:
+        progress('cached', result=how)
+    return simplify_for_request(result, data)
+
+def compute_best_path(data, progress=None):
+    """
+    Plan a /best-path request from scratch, see plan_best_path.
+    """
+    segments = data.get('segments')
+    start = data.get('start')  # optional {'lat': value, 'lng': value}
+    end = data.get('end')  # optional {'lat': value, 'lng': value}
+    loop = bool(data.get('loop', False))
+
+    north, south, east, west = route_bounds(segments, start, end)
+    print(f"Building graph for bbox: {north}, {south}, {east}, {west}")
+
+    # Get the OSMnx graph for the area using smallest boundary
+    graph = get_graph_from_smallest_boundary(north, south, east, west, 'walk')
+    
+    if graph.n_nodes == 0:
+        raise BestPathError('No road network found in the specified area', 404)
+    if progress is not None:
+        progress('graph_loaded', nodes=graph.n_nodes)
+
+    # Find the best path through all segments
+    result = find_best_path_through_segments(graph, segments, start, loop, progress, end)
+
+    return {
+        'path': result['path'],
+        'segments': result['segments'],
+        'total_distance': result['total_distance'],
+        'baseline_distance': result['baseline_distance'],
+        'optimal_order': result['optimal_order'],
+        'segments_covered': len(segments)
+    }
+
+def get_graph_from_smallest_boundary(north, south, east, west, network_type='walk'):
+    """
+    Get a graph covering the bounding box from the road-network tile store.
+    
+    Tiles already on disk are memory-mapped and stitched together, so a warm
+    request never touches Overpass. Missing tiles are downloaded once and
+    saved unless the store runs offline from a pre-seeded directory.
+    
+    Args:
+        north, south, east, west: bounding box coordinates
+        network_type: 'walk', 'bike', 'drive', etc.
+    
+    Returns:
+        CSRGraph of the road network
+    """
+    # Regions precomputed by precompute.py load with the bounds their
+    # connectors were cached for, others inside a warm-up region with the
+    # graph the warm-up loaded and indexed
+    bounds = None
+    if match_results is not None:
+        bounds = match_results.find_viewport(north, south, east, west)
+    if bounds is None:
+        bounds = warm_up.find_bounds(north, south, east, west)
+    if bounds is not None:
+        north, south, east, west = bounds
+    with metrics.timed('graph'):
+        graph = graph_tiles.get_csr(north, south, east, west, network_type)
+    print(f"Found graph with {graph.n_nodes} nodes and {graph.n_edges} edges")
+    return graph
+
+def find_best_path_through_segments(graph, segments, start=None, loop=False, progress=None, end=None):
     """
     Find the best path through all segments using the road network with optimal ordering.
     
     Args:
-        graph: OSMnx graph object
+        graph: OSMnx graph object or CSRGraph
         segments: List of segment objects with 'points' field
+        start: optional {'lat': value, 'lng': value} the route must start from
+        loop: finish back at the start (or at the first segment without a start)
+            when there is no end point
+        progress: optional callable(stage, **details) run after each step
+        end: optional {'lat': value, 'lng': value} the route must finish at
     
     Returns:
         Dictionary containing path coordinates and segment information
     """
+    full_graph = as_csr(graph)
+    if progress is None:
+        progress = lambda stage, **details: None
+    
     # Find the best path nodes for each segment
-    paths = []
-    for segment in segments:
-        points = segment['points']
-        path_nodes = strava_api.find_best_path_nodes(graph, points)
-        paths.append(path_nodes)
+    with metrics.timed('match'):
+        paths = strava_api.find_segment_path_nodes(
+            full_graph, [segment['points'] for segment in segments],
+            progress=lambda matched, total: progress('segment_matched', matched=matched, total=total),
+            segment_ids=[segment.get('id', '') for segment in segments],
+            cache=match_results)
+    
+    # Snap the start and end points to the road network, a loop without an
+    # end point also ends at the start
+    with metrics.timed('snap'):
+        start_node, end_node = spatial_index.snap_endpoints(full_graph, start, end, loop)
+    
+    # Connectors are searched only in a corridor around the segments and the
+    # gaps between them, which always keeps the matched nodes; the ones
+    # proven shortest on the full graph are shared with every other corridor
+    corridor_points = [segment['points'] for segment in segments]
+    keep_nodes = [node for path in paths for node in path]
+    for point, node in ((start, start_node), (end, end_node)):
+        if point is not None:
+            corridor_points.append([(point['lat'], point['lng'])])
+            keep_nodes.append(node)
+    width = corridor.CORRIDOR_WIDTH
+    with metrics.timed('corridor'):
+        graph = corridor.corridor_graph(full_graph, corridor_points, width, keep_nodes)
+    
+    # Find the optimal order to traverse the segments, widening the corridor
+    # while some connector cannot be found inside it
+    for widening in range(corridor.MAX_WIDENINGS + 1):
+        with metrics.timed('matrix'):
+            connectors = ConnectorMatrix(graph, paths, start_node=start_node, end_node=end_node,
+                                         cache=match_results, full_graph=full_graph)
+        if graph is full_graph or not corridor.has_missing_connectors(connectors):
+            break
+        width *= 2
+        with metrics.timed('corridor'):
+            if widening < corridor.MAX_WIDENINGS - 1:
+                graph = corridor.corridor_graph(full_graph, corridor_points, width, keep_nodes)
+            else:
+                print("Connectors still missing, searching the whole graph")
+                graph = full_graph
+    progress('connectors_built')
+    with metrics.timed('order'):
+        plan = strava_api.plan_path_order(graph, paths, connectors, loop=loop)
+    optimal_order, total_distance = plan['order'], plan['cost']
+    progress('order_solved', method=plan['method'], total_distance=total_distance)
+    
+    with metrics.timed('assemble'):
+        complete_path, segment_info = assemble_route(full_graph, segments, paths, connectors, optimal_order, loop)
+    
+    return {
+        'path': complete_path,
+        'segments': segment_info,
+        'total_distance': total_distance,
+        'baseline_distance': plan['baseline_cost'],
+        'optimal_order': optimal_order
+    }
+
+def assemble_route(graph, segments, paths, connectors, optimal_order, loop=False):
+    """
+    Join the matched segments and their connectors into one route.
     
-    # Find the optimal order to traverse the segments
-    optimal_order, total_distance = strava_api.find_optimal_path_order(graph, paths)
+    Args:
+        graph: CSRGraph
+        segments: List of segment objects, in the same order as paths
+        paths: List of lists of OSM node IDs
+        connectors: ConnectorMatrix or IncrementalConnectors over the paths
+        optimal_order: order to traverse the paths in
+        loop: close the loop back to the first segment if there is no start or end
+    
+    Returns:
+        Tuple of (list of [lat, lon] coordinates, list of segment info dictionaries)
+    """
+    start_node, end_node = connectors.start_node, connectors.end_node
     
     # Define colors for segments
     colors = ['#FF6B6B', '#4ECDC4', '#45B7D1', '#96CEB4', '#FFEAA7', '#DDA0DD', '#98D8C8', '#F7DC6F', '#BB8FCE', '#85C1E9']
@@ -235,13 +731,16 @@ def find_best_path_through_segments(graph, segments):
     # Build the complete path in optimal order with segment information
     complete_path = []
     segment_info = []
-    current_segment_idx = 0
+    
+    if start_node is not None and optimal_order:
+        append_route(graph, complete_path, connectors.path_from_start(optimal_order[0]),
+                     start_node, paths[optimal_order[0]][0])
     
     for i, path_idx in enumerate(optimal_order):
         path_nodes = paths[path_idx]
         segment = segments[path_idx]
         color = colors[i % len(colors)]
-        
+    
         # Add segment info
         segment_info.append({
             'segment_id': segment.get('id', f'segment_{path_idx}'),
@@ -250,45 +749,45 @@ def find_best_path_through_segments(graph, segments):
             'color': color,
             'start_idx': len(complete_path)
         })
-        
+    
         # Add the segment path
-        for node in path_nodes:
-            if node in graph.nodes:
-                complete_path.append([graph.nodes[node]['y'], graph.nodes[node]['x']])
-        
+        complete_path.extend(graph.coordinates(graph.index(path_nodes)))
+    
         # Add connecting path to next segment (except for the last segment)
         if i < len(optimal_order) - 1:
-            end_node = path_nodes[-1]
-            next_path_nodes = paths[optimal_order[i + 1]]
-            start_node = next_path_nodes[0]
-            
-            try:
-                # Find the shortest path between segments
-                connecting_path = nx.astar_path(graph, end_node, start_node,
-                                              heuristic=lambda u, v: ox.distance.great_circle(
-                                                  graph.nodes[u]['y'], graph.nodes[u]['x'],
-                                                  graph.nodes[v]['y'], graph.nodes[v]['x']
-                                              ),
-                                              weight='length')
-                
-                # Add the connecting path coordinates (in gray)
-                for node in connecting_path:
-                    if node in graph.nodes:
-                        complete_path.append([graph.nodes[node]['y'], graph.nodes[node]['x']])
-            except nx.NetworkXNoPath:
-                # If no path found, add a straight line
-                complete_path.append([graph.nodes[end_node]['y'], graph.nodes[end_node]['x']])
-                complete_path.append([graph.nodes[start_node]['y'], graph.nodes[start_node]['x']])
-        
+            # Reuse the connector found while building the distance matrix
+            next_idx = optimal_order[i + 1]
+            append_route(graph, complete_path, connectors.path(path_idx, next_idx),
+                         path_nodes[-1], paths[next_idx][0])
+        elif loop and start_node is None and end_node is None:
+            # Close the loop back to the first segment
+            append_route(graph, complete_path, connectors.path(path_idx, optimal_order[0]),
+                         path_nodes[-1], paths[optimal_order[0]][0])
+    
         # Update end index for this segment
         segment_info[-1]['end_idx'] = len(complete_path) - 1
     
-    return {
-        'path': complete_path,
-        'segments': segment_info,
-        'total_distance': total_distance,
-        'optimal_order': optimal_order
-    }
+    if end_node is not None and optimal_order:
+        append_route(graph, complete_path, connectors.path_to_end(optimal_order[-1]),
+                     paths[optimal_order[-1]][-1], end_node)
+    
+    return complete_path, segment_info
+
+def append_route(graph, complete_path, route, from_node, to_node):
+    """
+    Append the coordinates of a connecting route to the complete path.
+    
+    Args:
+        graph: CSRGraph
+        complete_path: list of [lat, lon] coordinates to extend
+        route: list of node IDs, or None if no route was found
+        from_node, to_node: ends of the connection, joined by a straight
+            line when there is no route
+    """
+    if route is None:
+        # If no path found, add a straight line
+        route = [from_node, to_node]
+    complete_path.extend(graph.coordinates(graph.index(route)))
 
 if __name__ == '__main__':
     app.run(debug=True)
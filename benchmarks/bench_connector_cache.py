@@ -0,0 +1,97 @@
+"""
+Check and time connectors shared between corridors through the MatchCache.
+
+Plans connectors for random segment sets on synthetic city graphs, each
+searched in its own corridor with one shared cache, as /best-path does.
+Checks that every cached distance is the full graph's shortest distance
+and that every connector distance a later request uses matches the length
+of the route it draws. Exits with status 1 if a check fails. Run from the
+repository root:
+
+    python benchmarks/bench_connector_cache.py
+"""
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import corridor  # noqa: E402
+from connectors import ConnectorMatrix  # noqa: E402
+from csr_graph import CSRGraph  # noqa: E402
+from match_cache import MatchCache  # noqa: E402
+from shortest_paths import dijkstra_rows  # noqa: E402
+from synthetic import city_graph  # noqa: E402
+
+REQUESTS = 20
+SEGMENTS = 8
+# Meters two distances may differ by and still be the same
+TOLERANCE = 1e-6
+
+
+def route_length(graph, nodes):
+    indices = graph.index(nodes)
+    return sum(graph.edge_length(int(u), int(v)) for u, v in zip(indices[:-1], indices[1:]))
+
+
+def random_paths(graph, rng):
+    # A short stretch of road around each of a few nearby nodes stands in
+    # for a matched segment
+    centre = rng.integers(graph.n_nodes)
+    distances, _ = dijkstra_rows(graph, [centre], 2500.0)
+    nearby = np.flatnonzero(np.isfinite(distances[0]))
+    paths = []
+    for node in rng.choice(nearby, min(SEGMENTS, len(nearby)), replace=False).tolist():
+        targets, _ = graph.neighbours(node)
+        if len(targets):
+            paths.append(graph.node_ids[[node, int(targets[0])]].tolist())
+    return paths
+
+
+def main():
+    rng = np.random.default_rng(17)
+    failed = False
+    print(f"{'nodes':>7} | {'cached':>7} {'wrong':>6} | {'reused':>7} {'mismatched':>10} | {'ms/request':>10}")
+    for size in (40, 80):
+        full = CSRGraph.from_networkx(city_graph(size, seed=size))
+        full.version = f"city-{size}"
+        cache = MatchCache(os.path.join(tempfile.mkdtemp(prefix='bench-connectors-'), 'cache.sqlite'))
+        wrong = mismatched = reused = 0
+        durations = []
+        for _ in range(REQUESTS):
+            paths = random_paths(full, rng)
+            points = [[(float(full.lat[i]), float(full.lon[i])) for i in full.index(path)] for path in paths]
+            start = time.perf_counter()
+            graph = corridor.corridor_graph(full, points, keep_nodes=[node for path in paths for node in path])
+            connectors = ConnectorMatrix(graph, paths, cache=cache, full_graph=full)
+            durations.append((time.perf_counter() - start) * 1000)
+
+            reused += len(connectors._known)
+            for i in range(len(paths)):
+                for j in range(len(paths)):
+                    route = connectors.path(i, j) if i != j else None
+                    if route is not None and abs(route_length(full, route) - connectors.distances[i, j]) > TOLERANCE:
+                        mismatched += 1
+
+        # Every cached distance must be the shortest on the full graph
+        rows = cache._db.execute('SELECT source, target, distance, cutoff FROM connectors').fetchall()
+        sources = sorted(set(row[0] for row in rows))
+        exact, _ = dijkstra_rows(full, full.index(sources))
+        source_rows = {source: k for k, source in enumerate(sources)}
+        for source, target, distance, cutoff in rows:
+            expected = exact[source_rows[source], full.index([target])[0]]
+            if expected > cutoff:
+                expected = np.inf
+            if not (distance == expected or abs(distance - expected) <= TOLERANCE):
+                wrong += 1
+        failed |= wrong > 0 or mismatched > 0
+        print(f"{full.n_nodes:>7} | {len(rows):>7} {wrong:>6} | {reused:>7} {mismatched:>10} | "
+              f"{np.median(durations):>10.1f}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Check and time A* with the landmark (ALT) heuristic against the great-circle one.
+
+Builds a LandmarkIndex on synthetic city graphs, checks its point-to-point
+distances against networkx and reports the query times of both
+heuristics. Exits with status 1 if any distance differs. Run from the
+repository root:
+
+    python benchmarks/bench_landmarks.py
+"""
+import os
+import sys
+import tempfile
+import time
+
+import networkx as nx
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from csr_graph import CSRGraph  # noqa: E402
+from landmarks import LandmarkIndex  # noqa: E402
+from shortest_paths import astar  # noqa: E402
+from synthetic import city_graph  # noqa: E402
+
+PAIRS = 200
+
+
+def query_times(csr, pairs):
+    """
+    Returns:
+        Tuple of (distances, query durations in ms)
+    """
+    distances, durations = [], []
+    for source, target in pairs:
+        start = time.perf_counter()
+        distance, _ = astar(csr, source, target)
+        durations.append((time.perf_counter() - start) * 1000)
+        distances.append(distance)
+    return np.array(distances), np.array(durations)
+
+
+def main():
+    rng = np.random.default_rng(3)
+    failed = False
+    print(f"{'nodes':>7} {'build s':>8} {'MB':>6} | {'heuristic':>12} {'p50 ms':>8} {'p90 ms':>8} | mismatches")
+    for size in (40, 100, 200):
+        graph = city_graph(size, seed=size)
+        csr = CSRGraph.from_networkx(graph)
+        pairs = rng.integers(0, csr.n_nodes, (PAIRS, 2)).tolist()
+        expected = np.array([nx.shortest_path_length(graph, int(csr.node_ids[s]), int(csr.node_ids[t]),
+                                                     weight='length') for s, t in pairs])
+
+        start = time.perf_counter()
+        index = LandmarkIndex.build(csr)
+        build_seconds = time.perf_counter() - start
+        # Round trip through the file format the tile store uses
+        path = os.path.join(tempfile.mkdtemp(prefix='bench-landmarks-'), 'landmarks.npz')
+        index.save(path)
+        index = LandmarkIndex.load(path, csr)
+
+        for name in ('great-circle', 'landmarks'):
+            csr.cache.pop('landmarks', None)
+            if name == 'landmarks':
+                csr.cache['landmarks'] = index
+            distances, durations = query_times(csr, pairs)
+            mismatches = int((~np.isclose(distances, expected, rtol=1e-5, atol=0.01)).sum())
+            failed |= mismatches > 0
+            print(f"{csr.n_nodes:>7} {build_seconds:>8.2f} {index.nbytes / 1e6:>6.1f} | {name:>12} "
+                  f"{np.median(durations):>8.2f} {np.percentile(durations, 90):>8.2f} | {mismatches}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
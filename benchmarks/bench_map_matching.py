@@ -0,0 +1,49 @@
+"""
+Compare the HMM map matcher with the original greedy node-removal search.
+
+The greedy search snaps through the same KD-tree index, so on short traces
+it is faster than the HMM matcher. The longer traces show where the HMM
+matcher wins: the greedy search grows much faster than linearly with the
+number of points and drifts further from the trace.
+
+Run from the repository root:
+
+    python benchmarks/bench_map_matching.py
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# Benchmarks run offline, so keyring lookups must not fail at import
+os.environ.setdefault('PYTHON_KEYRING_BACKEND', 'keyring.backends.null.Keyring')
+
+import strava_api  # noqa: E402
+from synthetic import deviation_from_nodes, grid_graph, random_route, trace_from_route  # noqa: E402
+
+
+def run(matcher, graph, points):
+    start = time.perf_counter()
+    nodes = matcher(graph, points)
+    elapsed = time.perf_counter() - start
+    return elapsed, deviation_from_nodes(graph, points, nodes)
+
+
+def main():
+    rng = np.random.default_rng(42)
+    print(f"{'grid':>6} {'points':>7} | {'hmm s':>8} {'hmm dev':>8} | {'greedy s':>9} {'greedy dev':>10}")
+    for size, route_edges in ((20, 5), (20, 10), (30, 20), (40, 60), (60, 150)):
+        graph = grid_graph(size)
+        route = random_route(graph, route_edges, rng)
+        points = trace_from_route(graph, route, rng=rng)
+
+        hmm_time, hmm_dev = run(strava_api.find_best_path_nodes, graph, points)
+        greedy_time, greedy_dev = run(strava_api.find_best_path_nodes_greedy, graph, points)
+        print(f"{size:>6} {len(points):>7} | {hmm_time:>8.3f} {hmm_dev.mean():>8.1f} |"
+              f" {greedy_time:>9.3f} {greedy_dev.mean():>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
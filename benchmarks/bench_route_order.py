@@ -0,0 +1,50 @@
+"""
+Compare the route ordering engines on random instances.
+
+Reports cost relative to the original nearest-neighbour heuristic and the
+solve time for each instance size. Run from the repository root:
+
+    python benchmarks/bench_route_order.py
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import route_order  # noqa: E402
+
+
+def random_instance(n, rng):
+    """
+    Segments scattered over a 5 km square; connectors follow a Manhattan
+    street grid plus the asymmetry of segments only run in one direction.
+    """
+    starts = rng.uniform(0, 5000, (n, 2))
+    ends = starts + rng.normal(0, 400, (n, 2))
+    distances = np.abs(ends[:, None, :] - starts[None, :, :]).sum(axis=2)
+    np.fill_diagonal(distances, 0)
+    return distances
+
+
+def main():
+    rng = np.random.default_rng(7)
+    print(f"{'n':>4} {'method':>18} | {'mean gap':>8} {'max gap':>8} | {'p50 ms':>8} {'max ms':>8}")
+    for n in (5, 8, 12, 20, 30, 50):
+        instances = [random_instance(n, rng) for _ in range(10)]
+        methods = ['held-karp', 'local-search'] if n <= route_order.EXACT_LIMIT else ['local-search']
+        for method in methods:
+            gaps, times = [], []
+            for distances in instances:
+                start = time.perf_counter()
+                result = route_order.solve_order(distances, method=method)
+                times.append((time.perf_counter() - start) * 1000)
+                gaps.append(result['gap'] * 100)
+            print(f"{n:>4} {method:>18} | {np.mean(gaps):>7.1f}% {np.max(gaps):>7.1f}% | "
+                  f"{np.median(times):>8.1f} {np.max(times):>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""
+Check and time the Strava segment-explore cache.
+
+Replays a synthetic explore endpoint that, like Strava, returns at most
+EXPLORE_LIMIT segments. Checks refetches after the TTL, capped results and
+world-sized viewports, then times cold and warm viewport lookups. Exits
+with status 1 if a check fails. Run from the repository root:
+
+    python benchmarks/bench_segment_cache.py
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import polyline
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from segment_cache import EXPLORE_LIMIT, SEGMENT_TILE_DEG, SegmentCache  # noqa: E402
+from synthetic import ORIGIN  # noqa: E402
+
+# Seconds a tile stays fresh in the TTL checks
+SHORT_TTL = 0.05
+LOOKUPS = 200
+
+
+def make_segment(segment_id, lat, lon, length=0.001):
+    points = [(lat, lon), (lat + length, lon + length)]
+    return {'id': segment_id, 'points': polyline.encode(points), 'start_latlng': [lat, lon]}
+
+
+class Explore:
+    """
+    Stand-in for the explore endpoint, counting calls.
+    """
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.calls = 0
+
+    def __call__(self, lat_min, lon_min, lat_max, lon_max):
+        self.calls += 1
+        inside = [segment for segment in self.segments
+                  if lat_min <= segment['start_latlng'][0] <= lat_max
+                  and lon_min <= segment['start_latlng'][1] <= lon_max]
+        return inside[:EXPLORE_LIMIT]
+
+
+def ids(segments):
+    return sorted(segment['id'] for segment in segments)
+
+
+def checks():
+    """
+    Returns:
+        List of (name, passed, detail)
+    """
+    results = []
+    lat, lon = (np.floor(np.array(ORIGIN) / SEGMENT_TILE_DEG) + 0.5) * SEGMENT_TILE_DEG
+
+    # One tile refetched after the TTL keeps its only segment
+    explore = Explore([make_segment(1, lat, lon)])
+    cache = SegmentCache(ttl=SHORT_TTL)
+    viewport = (lat - 0.001, lon - 0.001, lat + 0.001, lon + 0.001)
+    cache.get_segments(*viewport, explore)
+    time.sleep(2 * SHORT_TTL)
+    found = cache.get_segments(*viewport, explore)
+    results.append(('one tile refetched after the TTL',
+                    ids(found) == [1] and cache.get_segment(1) is not None and explore.calls == 2,
+                    f"segments {ids(found)}, get_segment {cache.get_segment(1) is not None}, "
+                    f"{explore.calls} calls"))
+
+    # Two tiles refetched, the segment of the first is needed to fill the second
+    explore = Explore([make_segment(2, lat, lon)])
+    cache = SegmentCache(ttl=SHORT_TTL)
+    viewport = (lat - 0.001, lon - 0.001, lat + 0.001, lon + SEGMENT_TILE_DEG)
+    cache.get_segments(*viewport, explore)
+    time.sleep(2 * SHORT_TTL)
+    try:
+        found, error = cache.get_segments(*viewport, explore), None
+    except Exception as e:
+        found, error = [], e
+    results.append(('two tiles refetched after the TTL', error is None and ids(found) == [2],
+                    f"segments {ids(found)}" + (f", {type(error).__name__}: {error}" if error else '')))
+
+    # A capped fetch must not stand in for the smaller viewports inside it
+    rng = np.random.default_rng(7)
+    dense = [make_segment(100 + i, lat + rng.random() * 0.05, lon + rng.random() * 0.05) for i in range(200)]
+    explore = Explore(dense)
+    cache = SegmentCache()
+    cache.get_segments(lat, lon, lat + 0.05, lon + 0.05, explore)
+    inner = (lat + 0.021, lon + 0.021, lat + 0.029, lon + 0.029)
+    found = set(ids(cache.get_segments(*inner, explore)))
+    direct = set(ids(Explore(dense)(*inner)))
+    results.append(('capped fetch not reused for a smaller viewport', direct <= found,
+                    f"{len(found)} segments, {len(direct - found)} of a direct query missing"))
+
+    # A world-sized viewport is one entry, not one per tile
+    cache = SegmentCache()
+    start = time.perf_counter()
+    cache.get_segments(-60, -180, 60, 180, Explore(dense))
+    seconds = time.perf_counter() - start
+    results.append(('world viewport is one entry', len(cache._tiles) == 1 and seconds < 0.1,
+                    f"{len(cache._tiles)} entries in {seconds * 1000:.1f} ms"))
+    return results
+
+
+def main():
+    failed = False
+    for name, passed, detail in checks():
+        failed |= not passed
+        print(f"{'ok' if passed else 'FAIL':>4} {name}: {detail}")
+
+    # Sparse area so tiles are cached, panned around one spot
+    rng = np.random.default_rng(11)
+    lat, lon = ORIGIN
+    sparse = [make_segment(i, lat + rng.random() * 0.1, lon + rng.random() * 0.1) for i in range(150)]
+    explore = Explore(sparse)
+    cache = SegmentCache()
+    durations = []
+    for _ in range(LOOKUPS):
+        south, west = lat + rng.random() * 0.08, lon + rng.random() * 0.08
+        start = time.perf_counter()
+        cache.get_segments(south, west, south + 0.02, west + 0.02, explore)
+        durations.append((time.perf_counter() - start) * 1000)
+    print(f"\n{LOOKUPS} panned viewports: {explore.calls} explore calls, {cache.hits} hits, "
+          f"p50 {np.median(durations):.2f} ms, p90 {np.percentile(durations, 90):.2f} ms")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
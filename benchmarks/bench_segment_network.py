@@ -0,0 +1,110 @@
+"""
+Check and time the /find-path segment network.
+
+Checks that a densely sampled segment keeps every point as a node and that
+two crossing segments join at one junction, then times building networks
+from the explore fixtures and routing between random segment points.
+Exits with status 1 if a check fails. Run from the repository root:
+
+    python benchmarks/bench_segment_network.py
+"""
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import polyline
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+from segment_network import SegmentNetwork  # noqa: E402
+from synthetic import ORIGIN  # noqa: E402
+
+METERS_PER_DEGREE = 111320.0
+QUERIES = 200
+# Relative error allowed between routed and expected distances
+DISTANCE_TOLERANCE = 0.02
+
+
+def straight_segment(segment_id, n_points, spacing, heading):
+    """
+    Segment of evenly spaced points through ORIGIN.
+
+    Args:
+        spacing: meters between consecutive points
+        heading: 'north' or 'east'
+    """
+    offsets = (np.arange(n_points) - n_points // 2) * spacing / METERS_PER_DEGREE
+    lat, lon = ORIGIN
+    if heading == 'north':
+        points = [[lat + offset, lon] for offset in offsets]
+    else:
+        points = [[lat, lon + offset / np.cos(np.radians(lat))] for offset in offsets]
+    return {'id': segment_id, 'points': points}
+
+
+def checks():
+    """
+    Returns:
+        List of (name, passed, detail)
+    """
+    results = []
+    dense = straight_segment(1, 200, 5.5, 'north')
+    network = SegmentNetwork([dense])
+    path, distance = network.shortest_path(dense['points'][0], dense['points'][-1])
+    results.append(('dense segment keeps its points', network.graph.n_nodes == 200,
+                    f"{network.graph.n_nodes} nodes of 200"))
+    expected = 199 * 5.5
+    results.append(('dense segment routes end to end',
+                    path is not None and abs(distance - expected) < DISTANCE_TOLERANCE * expected,
+                    f"{distance:.1f} m, about {expected:.1f} expected"))
+
+    crossing = straight_segment(2, 200, 5.5, 'east')
+    network = SegmentNetwork([dense, crossing])
+    path, distance = network.shortest_path(dense['points'][0], crossing['points'][-1])
+    expected = 100 * 5.5 + 99 * 5.5
+    # Only the few points within the tolerance of the crossing are merged
+    results.append(('crossing segments join at one junction',
+                    network.n_junctions == 1 and network.graph.n_nodes >= 400 - 4,
+                    f"{network.graph.n_nodes} nodes of 400, {network.n_junctions} junctions"))
+    results.append(('crossing segments connect',
+                    path is not None and abs(distance - expected) < DISTANCE_TOLERANCE * expected,
+                    f"{distance:.1f} m, about {expected:.1f} expected"))
+    return results
+
+
+def main():
+    failed = False
+    for name, passed, detail in checks():
+        failed |= not passed
+        print(f"{'ok' if passed else 'FAIL':>4} {name}: {detail}")
+
+    rng = np.random.default_rng(5)
+    print(f"\n{'fixture':>10} {'segments':>9} {'nodes':>7} {'junctions':>10} {'build ms':>9} | "
+          f"{'p50 ms':>7} {'p90 ms':>7} {'routed':>7}")
+    for name in sorted(os.listdir(os.path.join(BENCH_DIR, 'fixtures'))):
+        with open(os.path.join(BENCH_DIR, 'fixtures', name)) as f:
+            fixture = json.load(f)
+        segments = [dict(segment, points=polyline.decode(segment['points']))
+                    for segment in fixture['explore']['segments']]
+        start = time.perf_counter()
+        network = SegmentNetwork(segments)
+        build_ms = (time.perf_counter() - start) * 1000
+
+        points = [point for segment in segments for point in segment['points']]
+        durations, routed = [], 0
+        for source, target in rng.integers(0, len(points), (QUERIES, 2)).tolist():
+            start = time.perf_counter()
+            path, _ = network.shortest_path(points[source], points[target])
+            durations.append((time.perf_counter() - start) * 1000)
+            routed += path is not None
+        print(f"{name[:-5]:>10} {len(segments):>9} {network.graph.n_nodes:>7} {network.n_junctions:>10} "
+              f"{build_ms:>9.1f} | {np.median(durations):>7.2f} {np.percentile(durations, 90):>7.2f} "
+              f"{routed / QUERIES:>7.0%}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Measure cold start and first-request latency of the web app.
+
+Seeds a scratch tile directory with a fixture's road graph, precomputes
+its viewport, then starts fresh interpreters that import the app and
+send the same /best-path request twice. It runs without warm-up and with
+WARMUP_REGIONS covering the fixture, where the first request waits for
+/ready, each with and without the precomputed viewport. Besides the
+latencies it reports the first request's graph loading and indexing,
+the graph, match and snap stages of its Server-Timing header. Run from
+the repository root:
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --fixture grid-40 --runs 5
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+# Degrees added around the fixture graph for the warm-up region
+REGION_MARGIN = 0.05
+# Server-Timing stages where a request loads its graph and builds indexes
+LOAD_STAGES = ('graph', 'match', 'snap')
+
+
+def child(fixture_path):
+    """
+    Import the app, optionally wait for warm-up, and time two requests.
+    """
+    started = time.perf_counter()
+    import app
+    imported = time.perf_counter() - started
+
+    import polyline
+
+    with open(fixture_path) as f:
+        fixture = json.load(f)
+    segments = [dict(segment, points=polyline.decode(segment['points']))
+                for segment in fixture['explore']['segments']]
+    client = app.app.test_client()
+
+    start = time.perf_counter()
+    while client.get('/ready').status_code != 200:
+        time.sleep(0.01)
+    ready = time.perf_counter() - start
+
+    requests = []
+    loads = []
+    for _ in range(2):
+        start = time.perf_counter()
+        response = client.post('/best-path', json={'segments': segments})
+        requests.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.get_data(as_text=True)
+        stages = dict(part.strip().split(';dur=') for part in response.headers['Server-Timing'].split(','))
+        loads.append(sum(float(stages.get(stage, 0)) for stage in LOAD_STAGES) / 1000)
+    print(json.dumps({'import': imported, 'ready': ready, 'first': requests[0], 'second': requests[1],
+                      'load': loads[0]}))
+
+
+def prepare(fixture_path, workdir):
+    """
+    Seed the tiles and precompute the fixture's viewport.
+
+    Returns:
+        Environment for the app processes and the warm-up region
+    """
+    sys.path.insert(0, REPO_DIR)
+    sys.path.insert(0, BENCH_DIR)
+    from graph_store import GraphTileStore
+    from record_fixtures import load_graph
+
+    with open(fixture_path) as f:
+        graph = load_graph(json.load(f)['graph'])
+    tile_dir = os.path.join(workdir, 'tiles')
+    cache_path = os.path.join(workdir, 'match_cache.sqlite')
+    GraphTileStore(tile_dir).write_graph(graph)
+    lats = [data['y'] for _, data in graph.nodes(data=True)]
+    lons = [data['x'] for _, data in graph.nodes(data=True)]
+    region = (min(lats) - REGION_MARGIN, min(lons) - REGION_MARGIN,
+              max(lats) + REGION_MARGIN, max(lons) + REGION_MARGIN)
+
+    env = dict(os.environ, PYTHON_KEYRING_BACKEND='keyring.backends.null.Keyring',
+               GRAPH_TILE_DIR=tile_dir, GRAPH_TILE_OFFLINE='1', MATCH_CACHE_PATH=cache_path,
+               ROUTE_CACHE_MB='0', SERVER_TIMING='1')
+    env.pop('WARMUP_REGIONS', None)
+    subprocess.run([sys.executable, 'precompute.py', '--bbox', *map(str, region), '--segments', fixture_path,
+                    '--viewport-deg', '1', '--workers', '1', '--tile-dir', tile_dir, '--cache', cache_path,
+                    '--offline', '--landmarks', '0'],
+                   cwd=REPO_DIR, env=env, check=True, stdout=subprocess.DEVNULL)
+    return env, region
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure app cold start and first-request latency')
+    parser.add_argument('--fixture', default='city-100')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        sys.path.insert(0, REPO_DIR)
+        return child(args.child)
+
+    fixture_path = os.path.join(BENCH_DIR, 'fixtures', f'{args.fixture}.json')
+    workdir = tempfile.mkdtemp(prefix='bench-startup-')
+    env, region = prepare(fixture_path, workdir)
+    warm = ','.join(map(str, region))
+    # Same tiles and matches, but requests stitch graphs for their own bounds
+    plain = dict(env, MATCH_CACHE_PATH=os.path.join(workdir, 'no_viewports.sqlite'))
+    shutil.copy(env['MATCH_CACHE_PATH'], plain['MATCH_CACHE_PATH'])
+    with sqlite3.connect(plain['MATCH_CACHE_PATH']) as db:
+        db.execute('DELETE FROM viewports')
+    modes = {'cold': env, 'warm-up': dict(env, WARMUP_REGIONS=warm),
+             'cold, no viewport': plain, 'warm-up, no viewport': dict(plain, WARMUP_REGIONS=warm)}
+
+    print(f"{'mode':>20} | {'import s':>8} {'ready s':>8} {'first s':>8} {'second s':>8} | {'first load ms':>13}")
+    for mode, mode_env in modes.items():
+        runs = []
+        for _ in range(args.runs):
+            output = subprocess.run([sys.executable, __file__, '--child', fixture_path], cwd=REPO_DIR,
+                                    env=mode_env, check=True, capture_output=True, text=True).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        median = {key: float(np.median([run[key] for run in runs])) for key in runs[0]}
+        print(f"{mode:>20} | {median['import']:>8.2f} {median['ready']:>8.2f} "
+              f"{median['first']:>8.2f} {median['second']:>8.2f} | {median['load'] * 1000:>13.1f}")
+
+
+if __name__ == '__main__':
+    main()
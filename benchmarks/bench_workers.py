@@ -0,0 +1,151 @@
+"""
+Check that server worker processes share route jobs, sessions and caches.
+
+Starts two app processes on one SERVER_STATE_PATH, as serve.py runs its
+workers, and sends each step of the bundled page's flow to a different
+one: a route session created by one is updated through a job on the
+other, whose progress streams from the first; segments fetched by one
+are planned by id on the other, and routes and job results are read back
+across them. Exits with status 1 if a check fails. Run from the
+repository root:
+
+    python benchmarks/bench_workers.py
+"""
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+FIXTURE = os.path.join(BENCH_DIR, 'fixtures', 'city-60.json')
+
+
+def worker(env, commands, replies):
+    """
+    Import the app and answer (method, url, body) requests until None.
+    """
+    os.environ.update(env)
+    sys.path.insert(0, REPO_DIR)
+    import app
+
+    client = app.app.test_client()
+    for command in iter(commands.get, None):
+        method, url, body = command
+        if method == 'FETCH':
+            # Segments the page got from /update-segments, with Strava stubbed out
+            segments = app.segment_cache.get_segments(*url, lambda *bounds: body)
+            replies.put((200, [segment['id'] for segment in segments], 0.0))
+            continue
+        start = time.perf_counter()
+        response = client.open(url, method=method, json=body)
+        text = response.get_data(as_text=True)
+        try:
+            payload = json.loads(text)
+        except ValueError:
+            payload = text
+        replies.put((response.status_code, payload, time.perf_counter() - start))
+    app.best_path_jobs.shutdown()
+
+
+class Worker:
+    def __init__(self, context, env):
+        self.commands = context.Queue()
+        self.replies = context.Queue()
+        self.process = context.Process(target=worker, args=(env, self.commands, self.replies), daemon=True)
+        self.process.start()
+
+    def request(self, method, url, body=None):
+        self.commands.put((method, url, body))
+        return self.replies.get(timeout=120)
+
+    def stop(self):
+        self.commands.put(None)
+        self.process.join(30)
+
+
+def stream_events(text):
+    return [json.loads(line[len('data: '):]) for line in text.splitlines() if line.startswith('data: ')]
+
+
+def main():
+    sys.path.insert(0, REPO_DIR)
+    sys.path.insert(0, BENCH_DIR)
+    import polyline
+    from graph_store import GraphTileStore
+    from record_fixtures import load_graph
+
+    with open(FIXTURE) as f:
+        fixture = json.load(f)
+    workdir = tempfile.mkdtemp(prefix='bench-workers-')
+    tile_dir = os.path.join(workdir, 'tiles')
+    GraphTileStore(tile_dir).write_graph(load_graph(fixture['graph']))
+    env = {'PYTHON_KEYRING_BACKEND': 'keyring.backends.null.Keyring', 'GRAPH_TILE_DIR': tile_dir,
+           'GRAPH_TILE_OFFLINE': '1', 'MATCH_CACHE_PATH': '', 'SERVER_TIMING': '0',
+           'SERVER_STATE_PATH': os.path.join(workdir, 'state.sqlite'), 'BEST_PATH_WORKERS': '1'}
+
+    raw = fixture['explore']['segments']
+    segments = [dict(segment, points=polyline.decode(segment['points'])) for segment in raw]
+    points = [point for segment in segments for point in segment['points']]
+    bounds = (min(p[0] for p in points), min(p[1] for p in points),
+              max(p[0] for p in points), max(p[1] for p in points))
+
+    context = multiprocessing.get_context('spawn')
+    first, second = Worker(context, env), Worker(context, env)
+    results = []
+    try:
+        # A session made on one worker, updated through a job on the other,
+        # its progress streamed from the first
+        _, created, _ = first.request('POST', '/route-sessions')
+        session_id = created['session_id']
+        status, job, _ = second.request('POST', f'/route-sessions/{session_id}/jobs', {'segments': segments})
+        status, stream, seconds = first.request('GET', f"/best-path/jobs/{job['job_id']}/events")
+        events = stream_events(stream)
+        stages = [event['stage'] for event in events]
+        done = events[-1] if events else {}
+        results.append(('job streamed from another worker',
+                        status == 200 and 'segment_matched' in stages and stages[-1:] == ['done']
+                        and (done.get('result') or {}).get('segments_covered') == len(segments),
+                        f"status {status}, stages {' > '.join(dict.fromkeys(stages))}, {seconds:.2f} s"))
+
+        status, update, seconds = first.request('PUT', f'/route-sessions/{session_id}', {'segments': segments[1:]})
+        results.append(('session updated on another worker',
+                        status == 200 and update.get('segments_covered') == len(segments) - 1,
+                        f"status {status}, {update.get('segments_covered') if status == 200 else update}, "
+                        f"{seconds:.2f} s without matching again"))
+
+        status, route, _ = second.request('GET', f"/routes/{update.get('route_id')}")
+        results.append(('route read back from another worker',
+                        status == 200 and route.get('total_distance') == update.get('total_distance'),
+                        f"status {status}"))
+
+        # Segments sent by one worker, planned by id on the other
+        _, fetched, _ = first.request('FETCH', bounds, raw)
+        status, planned, _ = second.request('POST', '/best-path', {'segment_ids': fetched[:5]})
+        results.append(('segment ids resolved on another worker',
+                        status == 200 and planned.get('segments_covered') == 5,
+                        f"status {status}, {len(fetched)} segments fetched"))
+
+        # A queued job is cancelled by a newer one for its client from the
+        # other worker; the first worker is kept busy so it is still queued
+        first.request('POST', '/best-path/jobs', {'segments': segments, 'client_id': 'busy', 'loop': True})
+        _, queued, _ = first.request('POST', '/best-path/jobs', {'segments': segments[:3], 'client_id': 'page'})
+        second.request('POST', '/best-path/jobs', {'segments': segments[:3], 'client_id': 'page'})
+        _, state, _ = second.request('GET', f"/best-path/jobs/{queued['job_id']}")
+        results.append(('job superseded from another worker', state.get('status') == 'cancelled',
+                        f"status {state.get('status')}"))
+    finally:
+        first.stop()
+        second.stop()
+
+    failed = False
+    for name, passed, detail in results:
+        failed |= not passed
+        print(f"{'ok' if passed else 'FAIL':>4} {name}: {detail}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Create the /segments/explore fixtures the benchmark runner replays.
+
+Regenerate the synthetic fixtures checked into benchmarks/fixtures:
+
+    python benchmarks/record_fixtures.py synthetic
+
+Record a real area once, with network access and Strava credentials. This
+saves the explore response and the road tiles it needs, so the fixture
+replays offline afterwards:
+
+    python benchmarks/record_fixtures.py record central-park --bounds 40.764 -73.982 40.800 -73.949
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+import polyline
+
+import synthetic
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# (name, graph type, graph size, number of segments)
+SYNTHETIC_FIXTURES = [
+    ('grid-20', 'grid', 20, 5),
+    ('grid-40', 'grid', 40, 10),
+    ('city-60', 'city', 60, 15),
+    ('city-100', 'city', 100, 25),
+]
+
+
+def load_graph(spec, fixture_dir=FIXTURE_DIR):
+    """
+    Build or load the road graph a fixture was made on.
+
+    Args:
+        spec: the fixture's 'graph' entry
+        fixture_dir: directory tile paths are relative to
+
+    Returns:
+        OSMnx-compatible MultiDiGraph
+    """
+    if spec['type'] == 'grid':
+        return synthetic.grid_graph(spec['size'])
+    if spec['type'] == 'city':
+        return synthetic.city_graph(spec['size'], seed=spec['seed'])
+    if spec['type'] == 'tiles':
+        # Recorded areas replay from their tiles without network access
+        from graph_store import GraphTileStore
+        store = GraphTileStore(os.path.join(fixture_dir, spec['path']), offline=True)
+        return store.get_graph(*spec['bounds'], network_type=spec['network_type'])
+    raise ValueError(f"Unknown graph type {spec['type']}")
+
+
+def write_fixture(name, graph_spec, explore):
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    path = os.path.join(FIXTURE_DIR, f"{name}.json")
+    with open(path, 'w') as f:
+        json.dump({'name': name, 'graph': graph_spec, 'explore': explore}, f, indent=1)
+    print(f"Wrote {len(explore['segments'])} segments to {path}")
+
+
+def make_synthetic():
+    for name, graph_type, size, n_segments in SYNTHETIC_FIXTURES:
+        spec = {'type': graph_type, 'size': size, 'seed': 0}
+        graph = load_graph(spec)
+        rng = np.random.default_rng(size)
+        write_fixture(name, spec, synthetic.explore_response(graph, n_segments, rng))
+
+
+def record(name, bounds, network_type):
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    import strava_api
+    from graph_store import GraphTileStore
+
+    lat_min, lon_min, lat_max, lon_max = bounds
+    explore = strava_api.search_segments(lat_min, lon_min, lat_max, lon_max,
+                                         strava_api.token_manager.get_token())
+
+    # Download every tile the routes can touch, with the same padding as /best-path
+    points = [point for segment in explore['segments']
+              for point in polyline.decode(segment['points'])]
+    lats = [p[0] for p in points] + [lat_min, lat_max]
+    lons = [p[1] for p in points] + [lon_min, lon_max]
+    graph_bounds = [max(lats) + 0.001, min(lats) - 0.001, max(lons) + 0.001, min(lons) - 0.001]
+    tiles = f"{name}_tiles"
+    GraphTileStore(os.path.join(FIXTURE_DIR, tiles)).get_graph(*graph_bounds, network_type=network_type)
+    write_fixture(name, {'type': 'tiles', 'path': tiles, 'bounds': graph_bounds,
+                         'network_type': network_type}, explore)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('synthetic', help='regenerate the synthetic fixtures')
+    recorder = commands.add_parser('record', help='record a real area from Strava and Overpass')
+    recorder.add_argument('name')
+    recorder.add_argument('--bounds', nargs=4, type=float, required=True,
+                          metavar=('LAT_MIN', 'LON_MIN', 'LAT_MAX', 'LON_MAX'))
+    recorder.add_argument('--network-type', default='walk')
+    args = parser.parse_args()
+
+    if args.command == 'synthetic':
+        make_synthetic()
+    else:
+        record(args.name, args.bounds, args.network_type)
+
+
+if __name__ == '__main__':
+    main()
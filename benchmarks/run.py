@@ -0,0 +1,258 @@
+"""
+Offline benchmark runner for the routing pipeline.
+
+Replays the explore fixtures in benchmarks/fixtures through each stage,
+matching, ordering and the full /best-path pipeline, and reports latency
+percentiles, peak traced memory and route quality. Run from the
+repository root:
+
+    python benchmarks/run.py
+    python benchmarks/run.py --fixtures grid-20 city-60 --repeat 10 --json results.json
+
+Compare two commits, or a commit with the working tree, on the same
+fixtures. Each side runs in its own git worktree and process; the exit
+status is 1 if the second side regressed:
+
+    python benchmarks/run.py --compare main
+    python benchmarks/run.py --compare v1.0 main --threshold 0.2
+"""
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import polyline
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+STAGES = ('match', 'order', 'end_to_end')
+# Differences below this many milliseconds are noise, never a regression
+NOISE_MS = 5.0
+# Route distances or deviations this much worse count as a quality regression
+QUALITY_TOLERANCE = 0.01
+
+
+def load_pipeline(code_dir):
+    """
+    Import the application modules from a checkout.
+
+    Returns:
+        Tuple of (strava_api module, app module or None)
+    """
+    sys.path.insert(0, code_dir)
+    # Runs offline: no keyring lookups, no persistent caches, tiles in a scratch dir
+    os.environ.setdefault('PYTHON_KEYRING_BACKEND', 'keyring.backends.null.Keyring')
+    os.environ['GRAPH_TILE_DIR'] = tempfile.mkdtemp(prefix='bench-tiles-')
+    os.environ['MATCH_CACHE_PATH'] = ''
+    os.environ['SERVER_TIMING'] = '0'
+    import strava_api
+    try:
+        import app
+    except Exception as e:
+        print(f"Skipping end-to-end stage, app failed to import: {e}")
+        app = None
+    return strava_api, app
+
+
+def run_match(strava_api, graph, segment_points):
+    if hasattr(strava_api, 'find_segment_path_nodes'):
+        return strava_api.find_segment_path_nodes(graph, segment_points)
+    return [strava_api.find_best_path_nodes(graph, points) for points in segment_points]
+
+
+def measure(func, repeat, max_seconds):
+    """
+    Time repeated calls after one warm-up call, then trace one more for memory.
+
+    Returns:
+        Tuple of (last result, list of durations in ms, peak memory in MB)
+    """
+    result = func()
+    durations = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        durations.append((time.perf_counter() - start) * 1000)
+        if time.perf_counter() - started > max_seconds:
+            break
+
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+    return result, durations, peak
+
+
+def summarize(durations, peak, quality):
+    return {
+        'runs': len(durations),
+        'p50_ms': float(np.percentile(durations, 50)),
+        'p90_ms': float(np.percentile(durations, 90)),
+        'p99_ms': float(np.percentile(durations, 99)),
+        'peak_mb': peak,
+        'quality': quality,
+    }
+
+
+def benchmark_fixture(fixture, strava_api, app, repeat, max_seconds):
+    from record_fixtures import load_graph
+    from synthetic import deviation_from_nodes
+
+    graph = load_graph(fixture['graph'])
+    segments = [dict(segment, points=polyline.decode(segment['points']))
+                for segment in fixture['explore']['segments']]
+    segment_points = [segment['points'] for segment in segments]
+    results = {}
+
+    paths, durations, peak = measure(lambda: run_match(strava_api, graph, segment_points), repeat, max_seconds)
+    deviations = np.concatenate([deviation_from_nodes(graph, points, nodes)
+                                 for points, nodes in zip(segment_points, paths)])
+    results['match'] = summarize(durations, peak, {'mean_deviation_m': float(deviations.mean()),
+                                                   'p95_deviation_m': float(np.percentile(deviations, 95))})
+
+    (_, distance), durations, peak = measure(lambda: strava_api.find_optimal_path_order(graph, paths),
+                                             repeat, max_seconds)
+    results['order'] = summarize(durations, peak, {'connector_distance_m': float(distance)})
+
+    if app is not None:
+        route, durations, peak = measure(lambda: app.find_best_path_through_segments(graph, segments),
+                                         repeat, max_seconds)
+        results['end_to_end'] = summarize(durations, peak, {'total_distance_m': float(route['total_distance']),
+                                                            'route_points': len(route['path'])})
+    return results
+
+
+def print_results(results):
+    print(f"{'fixture':>10} {'stage':>10} | {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'peak MB':>8} | quality")
+    for name, stages in results.items():
+        for stage, result in stages.items():
+            quality = ', '.join(f"{key}={value:.1f}" if isinstance(value, float) else f"{key}={value}"
+                                for key, value in result['quality'].items())
+            print(f"{name:>10} {stage:>10} | {result['p50_ms']:>9.1f} {result['p90_ms']:>9.1f} "
+                  f"{result['p99_ms']:>9.1f} {result['peak_mb']:>8.1f} | {quality}")
+
+
+def fixture_paths(names):
+    paths = sorted(glob.glob(os.path.join(BENCH_DIR, 'fixtures', '*.json')))
+    if names:
+        paths = [path for path in paths if os.path.splitext(os.path.basename(path))[0] in names]
+    return paths
+
+
+def run(args):
+    strava_api, app = load_pipeline(os.path.abspath(args.code))
+    results = {}
+    for path in fixture_paths(args.fixtures):
+        with open(path) as f:
+            fixture = json.load(f)
+        print(f"Running {fixture['name']} ({len(fixture['explore']['segments'])} segments)")
+        results[fixture['name']] = benchmark_fixture(fixture, strava_api, app, args.repeat, args.max_seconds)
+
+    # Keep the report readable among the pipeline's own progress prints
+    print()
+    print_results(results)
+    if args.json:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=args.code,
+                                capture_output=True, text=True).stdout.strip()
+        with open(args.json, 'w') as f:
+            json.dump({'code': os.path.abspath(args.code), 'commit': commit, 'results': results}, f, indent=1)
+
+
+def run_ref(ref, args, output):
+    """
+    Benchmark a git ref in a temporary worktree, or the working tree if ref is None.
+    """
+    command = [sys.executable, os.path.abspath(__file__), '--json', output,
+               '--repeat', str(args.repeat), '--max-seconds', str(args.max_seconds)]
+    if args.fixtures:
+        command += ['--fixtures'] + args.fixtures
+    if ref is None:
+        subprocess.run(command + ['--code', REPO_DIR], check=True)
+        return
+
+    worktree = tempfile.mkdtemp(prefix='bench-worktree-')
+    subprocess.run(['git', 'worktree', 'add', '--detach', worktree, ref], cwd=REPO_DIR, check=True)
+    try:
+        subprocess.run(command + ['--code', worktree], check=True)
+    finally:
+        subprocess.run(['git', 'worktree', 'remove', '--force', worktree], cwd=REPO_DIR)
+
+
+def compare(args):
+    base_ref = args.compare[0]
+    head_ref = args.compare[1] if len(args.compare) > 1 else None
+    outputs = []
+    for ref in (base_ref, head_ref):
+        output = tempfile.mktemp(suffix='.json', prefix='bench-')
+        print(f"=== Benchmarking {ref or 'working tree'}")
+        run_ref(ref, args, output)
+        with open(output) as f:
+            outputs.append(json.load(f)['results'])
+    base, head = outputs
+
+    regressions = []
+    print()
+    print(f"{'fixture':>10} {'stage':>10} | {'base ms':>9} {'head ms':>9} {'change':>8} | quality change")
+    for name in head:
+        for stage in STAGES:
+            if stage not in head[name] or stage not in base.get(name, {}):
+                continue
+            before, after = base[name][stage], head[name][stage]
+            change = after['p50_ms'] / max(before['p50_ms'], 1e-9) - 1
+            slower = change > args.threshold and after['p50_ms'] - before['p50_ms'] > NOISE_MS
+
+            quality = []
+            worse = False
+            for key, value in after['quality'].items():
+                old = before['quality'].get(key)
+                if old is None or key == 'route_points':
+                    continue
+                relative = value / old - 1 if old else 0.0
+                quality.append(f"{key} {relative * 100:+.1f}%")
+                # Every quality figure is a distance or deviation, lower is better
+                worse |= relative > QUALITY_TOLERANCE
+
+            flag = '  SLOWER' if slower else ''
+            flag += '  WORSE' if worse else ''
+            if slower or worse:
+                regressions.append((name, stage))
+            print(f"{name:>10} {stage:>10} | {before['p50_ms']:>9.1f} {after['p50_ms']:>9.1f} "
+                  f"{change * 100:>+7.1f}% | {', '.join(quality)}{flag}")
+
+    if regressions:
+        print(f"{len(regressions)} regressions against {base_ref}")
+        sys.exit(1)
+    print(f"No regressions against {base_ref}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks for the routing pipeline')
+    parser.add_argument('--fixtures', nargs='+', help='fixture names, default all')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per stage')
+    parser.add_argument('--max-seconds', type=float, default=60.0,
+                        help='stop repeating a stage after this long')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--code', default=REPO_DIR, help='checkout to benchmark')
+    parser.add_argument('--compare', nargs='+', metavar='REF',
+                        help='compare BASE with HEAD, or with the working tree if HEAD is omitted')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative p50 slowdown reported as a regression')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args)
+    else:
+        run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+"""
+Synthetic road graphs, GPS traces and Strava responses for offline benchmarks.
+
+Nothing here imports the application modules, so the benchmark runner can
+load these graphs before pointing its imports at an older commit.
+"""
+import math
+
+import networkx as nx
+import numpy as np
+import polyline
+
+
+ORIGIN = (40.7306, -73.9352)
+EARTH_RADIUS = 6371008.8
+# Large ids like real OSM nodes, so int64 handling is exercised
+CITY_NODE_OFFSET = 4200000000
+
+
+class LocalProjection:
+    """
+    Equirectangular projection to meters around a reference point.
+    """
+
+    def __init__(self, lat0, lon0):
+        self.lat0 = lat0
+        self.lon0 = lon0
+        self.kx = math.radians(1) * EARTH_RADIUS * math.cos(math.radians(lat0))
+        self.ky = math.radians(1) * EARTH_RADIUS
+
+    def to_xy(self, lats, lons):
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        return np.column_stack(((lons - self.lon0) * self.kx, (lats - self.lat0) * self.ky))
+
+
+def grid_graph(size, spacing=100.0, origin=ORIGIN):
+    """
+    Build a square grid road network with two-way streets.
+
+    Args:
+        size: number of nodes along each side
+        spacing: block length in meters
+        origin: (lat, lon) of the south-west corner
+
+    Returns:
+        OSMnx-compatible MultiDiGraph
+    """
+    lat0, lon0 = origin
+    dlat = spacing / 111195.0
+    dlon = dlat / math.cos(math.radians(lat0))
+
+    graph = nx.MultiDiGraph(crs='epsg:4326')
+    for i in range(size):
+        for j in range(size):
+            graph.add_node(i * size + j, y=lat0 + i * dlat, x=lon0 + j * dlon)
+    for i in range(size):
+        for j in range(size):
+            for di, dj in ((0, 1), (1, 0)):
+                if i + di < size and j + dj < size:
+                    u, v = i * size + j, (i + di) * size + j + dj
+                    graph.add_edge(u, v, 0, length=spacing)
+                    graph.add_edge(v, u, 0, length=spacing)
+    return graph
+
+
+def city_graph(size, spacing=100.0, seed=0, origin=ORIGIN):
+    """
+    Build an irregular street network that behaves more like OSM data.
+
+    Starts from a grid, jitters every intersection, removes some blocks,
+    adds diagonal avenues and one-way streets and makes street lengths
+    longer than the straight line between their ends. Only the largest
+    strongly connected part is kept, as for a routable OSM extract.
+
+    Args:
+        size: number of intersections along each side before pruning
+        spacing: typical block length in meters
+        seed: random seed, the same seed always gives the same graph
+        origin: (lat, lon) of the south-west corner
+
+    Returns:
+        OSMnx-compatible MultiDiGraph with OSM-sized node ids
+    """
+    rng = np.random.default_rng(seed)
+    lat0, lon0 = origin
+    dlat = spacing / 111195.0
+    dlon = dlat / math.cos(math.radians(lat0))
+    jitter = rng.normal(0, 0.15, (size, size, 2))
+
+    graph = nx.MultiDiGraph(crs='epsg:4326')
+    node_id = lambda i, j: CITY_NODE_OFFSET + i * size + j
+    for i in range(size):
+        for j in range(size):
+            graph.add_node(node_id(i, j), y=lat0 + (i + jitter[i, j, 0]) * dlat,
+                           x=lon0 + (j + jitter[i, j, 1]) * dlon)
+
+    projection = LocalProjection(lat0, lon0)
+    for i in range(size):
+        for j in range(size):
+            steps = [(0, 1), (1, 0)] + ([(1, 1)] if rng.random() < 0.05 else [])
+            for di, dj in steps:
+                if i + di >= size or j + dj >= size or rng.random() < 0.12:
+                    continue
+                u, v = node_id(i, j), node_id(i + di, j + dj)
+                xy = projection.to_xy([graph.nodes[u]['y'], graph.nodes[v]['y']],
+                                      [graph.nodes[u]['x'], graph.nodes[v]['x']])
+                length = float(np.hypot(*(xy[1] - xy[0]))) * rng.uniform(1.0, 1.25)
+                one_way = rng.random() < 0.1
+                if one_way and rng.random() < 0.5:
+                    u, v = v, u
+                graph.add_edge(u, v, 0, length=length)
+                if not one_way:
+                    graph.add_edge(v, u, 0, length=length)
+
+    largest = max(nx.strongly_connected_components(graph), key=len)
+    return graph.subgraph(largest).copy()
+
+
+def random_route(graph, n_edges, rng):
+    """
+    Random walk along the graph without immediate U-turns.
+
+    Returns:
+        List of node IDs
+    """
+    nodes = list(graph.nodes)
+    route = [nodes[rng.integers(len(nodes))]]
+    while len(route) <= n_edges:
+        options = [v for v in graph.successors(route[-1]) if len(route) < 2 or v != route[-2]]
+        if not options:
+            break
+        route.append(options[rng.integers(len(options))])
+    return route
+
+
+def trace_from_route(graph, route, spacing=10.0, noise=5.0, rng=None):
+    """
+    Sample noisy GPS points along a node route.
+
+    Args:
+        graph: graph the route belongs to
+        route: list of node IDs
+        spacing: distance between samples in meters
+        noise: standard deviation of the GPS noise in meters
+
+    Returns:
+        List of (lat, lon) tuples
+    """
+    rng = rng or np.random.default_rng(0)
+    lats = np.array([graph.nodes[n]['y'] for n in route])
+    lons = np.array([graph.nodes[n]['x'] for n in route])
+    projection = LocalProjection(lats.mean(), lons.mean())
+    xy = projection.to_xy(lats, lons)
+
+    cumulative = np.concatenate(([0.0], np.cumsum(np.hypot(*np.diff(xy, axis=0).T))))
+    samples = np.arange(0.0, cumulative[-1] + 1e-9, spacing)
+    x = np.interp(samples, cumulative, xy[:, 0]) + rng.normal(0, noise, len(samples))
+    y = np.interp(samples, cumulative, xy[:, 1]) + rng.normal(0, noise, len(samples))
+    return list(zip((y / projection.ky + projection.lat0).tolist(),
+                    (x / projection.kx + projection.lon0).tolist()))
+
+
+def deviation_from_nodes(graph, points, nodes):
+    """
+    Distance in meters from each point to the polyline through the nodes.
+    """
+    points = np.asarray(points)
+    projection = LocalProjection(points[:, 0].mean(), points[:, 1].mean())
+    xy = projection.to_xy(points[:, 0], points[:, 1])
+    path = projection.to_xy([graph.nodes[n]['y'] for n in nodes], [graph.nodes[n]['x'] for n in nodes])
+    if len(path) == 1:
+        return np.hypot(*(xy - path[0]).T)
+
+    start, end = path[:-1], path[1:]
+    direction = end - start
+    squared = np.maximum((direction ** 2).sum(axis=1), 1e-12)
+    relative = xy[:, None, :] - start[None, :, :]
+    fractions = np.clip((relative * direction[None]).sum(axis=2) / squared, 0, 1)
+    closest = start[None] + fractions[..., None] * direction[None]
+    return np.hypot(*(closest - xy[:, None, :]).transpose(2, 0, 1)).min(axis=1)
+
+
+def explore_response(graph, n_segments, rng, route_edges=(4, 15), first_id=1000):
+    """
+    Fake a Strava /segments/explore response for segments on a graph.
+
+    Each segment is a random walk on the graph traced with GPS noise and
+    encoded like Strava's polylines, so fixtures built from it exercise the
+    same decoding and matching path as real responses.
+
+    Args:
+        graph: graph the segments run along
+        n_segments: number of segments
+        rng: numpy random generator
+        route_edges: (min, max) number of streets per segment
+        first_id: id of the first segment
+
+    Returns:
+        Dictionary with a 'segments' list in the explore response format
+    """
+    segments = []
+    for k in range(n_segments):
+        route = random_route(graph, int(rng.integers(*route_edges)), rng)
+        points = trace_from_route(graph, route, rng=rng)
+        projection = LocalProjection(points[0][0], points[0][1])
+        xy = projection.to_xy([p[0] for p in points], [p[1] for p in points])
+        distance = float(np.hypot(*np.diff(xy, axis=0).T).sum())
+        segments.append({
+            'id': first_id + k,
+            'resource_state': 2,
+            'name': f"Synthetic segment {k + 1}",
+            'climb_category': 0,
+            'climb_category_desc': 'NC',
+            'avg_grade': round(float(rng.normal(0, 2)), 1),
+            'start_latlng': [round(points[0][0], 6), round(points[0][1], 6)],
+            'end_latlng': [round(points[-1][0], 6), round(points[-1][1], 6)],
+            'elev_difference': round(float(abs(rng.normal(0, 8))), 1),
+            'distance': round(distance, 1),
+            'points': polyline.encode(points),
+            'starred': False,
+        })
+    return {'segments': segments}
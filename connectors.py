@@ -0,0 +1,343 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from csr_graph import CSRGraph, as_csr
+from shortest_paths import NO_PREDECESSOR, astar, dijkstra_rows, reconstruct_path
+from spatial_index import great_circle
+
+
+# Connector searches stop this many times the straight-line spread of the
+# segments, plus a fixed margin, away from each source
+DETOUR_FACTOR = 4.0
+DETOUR_MARGIN = 2000.0
+
+_worker_graph = None
+
+
+def _attach_worker(handle):
+    global _worker_graph
+    _worker_graph = CSRGraph.attach(handle)
+
+
+def _worker_rows(sources, limit):
+    graph, _ = _worker_graph
+    return dijkstra_rows(graph, sources, limit)
+
+
+class ConnectorMatrix:
+    """
+    Shortest connecting routes from the end of each segment to every start.
+
+    Runs one bounded Dijkstra per distinct segment end, all sharing a single
+    call into scipy's C implementation, instead of one A* per ordered pair.
+    The predecessor trees are kept so the connector between any two segments
+    can be rebuilt without searching again.
+    """
+
+    def __init__(self, graph, paths, cutoff=None, start_node=None, end_node=None, workers=None, cache=None,
+                 full_graph=None):
+        """
+        Args:
+            graph: OSMnx graph object or CSRGraph
+            paths: List of node ID lists, one per segment
+            cutoff: optional maximum connector length in meters; defaults to a
+                bound derived from how far apart the segments are
+            start_node: optional node the route must start from
+            end_node: optional node the route must finish at
+            workers: run the searches in this many processes sharing one copy
+                of the graph
+            cache: optional MatchCache; sources whose distances to every
+                target are cached for this graph version are not searched
+            full_graph: optional graph that graph is a corridor of; the cache
+                is keyed on its version so every corridor shares connectors,
+                and connectors taken from the cache are rebuilt on it. Only
+                corridor distances proven shortest on it are cached
+        """
+        self.graph = as_csr(graph)
+        self.full_graph = as_csr(full_graph) if full_graph is not None else self.graph
+        self.starts = self.graph.index([path[0] for path in paths]) if paths else np.empty(0, dtype=np.int64)
+        self.ends = self.graph.index([path[-1] for path in paths]) if paths else np.empty(0, dtype=np.int64)
+        self.start_node = start_node
+        self.end_node = end_node
+        start_index = int(self.graph.index([start_node])[0]) if start_node is not None else None
+        end_index = int(self.graph.index([end_node])[0]) if end_node is not None else None
+
+        sources = np.unique(np.concatenate((self.ends, [start_index] if start_index is not None else [])))
+        sources = sources.astype(np.int64)
+        targets = np.concatenate((self.starts, [end_index] if end_index is not None else []))
+        targets = targets.astype(np.int64)
+        self.cutoff = cutoff if cutoff is not None else self._default_cutoff(sources, targets)
+
+        # Distances from every source to every target, cached rows first
+        table = np.empty((len(sources), len(targets)))
+        source_ids = self.graph.node_ids[sources].tolist()
+        target_ids = self.graph.node_ids[targets].tolist()
+        known = cache.get_connectors(self.full_graph.version, source_ids, target_ids, self.cutoff) if cache else {}
+        self._known = known
+        searched = []
+        for k, source in enumerate(source_ids):
+            row = [known.get((source, target)) for target in target_ids]
+            if None in row:
+                searched.append(k)
+            else:
+                table[k] = row
+
+        self._row = {int(sources[k]): row for row, k in enumerate(searched)}
+        row_distances, self.predecessors = self._search(sources[searched], workers)
+        if searched:
+            table[searched] = row_distances[:, targets]
+            if cache:
+                # Corridor distances are only upper bounds on the full graph,
+                # so just the ones proven shortest there are shared
+                proven = self._proven(row_distances, targets)
+                cache.put_connectors(self.full_graph.version,
+                                     {(source_ids[k], target): distance
+                                      for k, distances, shortest in zip(searched, table[searched].tolist(),
+                                                                        proven.tolist())
+                                      for target, distance, keep in zip(target_ids, distances, shortest)
+                                      if keep},
+                                     self.cutoff)
+
+        source_rows = {int(source): k for k, source in enumerate(sources.tolist())}
+        ends_rows = [source_rows[int(end)] for end in self.ends]
+        self.distances = table[np.ix_(ends_rows, range(len(paths)))] if len(paths) else np.zeros((0, 0))
+        np.fill_diagonal(self.distances, 0.0)
+        self.start_distances = None
+        self.end_distances = None
+        if start_index is not None:
+            self.start_distances = table[source_rows[start_index], :len(paths)]
+        if end_index is not None:
+            self.end_distances = table[ends_rows, len(paths)]
+
+    def _default_cutoff(self, sources, targets):
+        if len(sources) == 0 or len(targets) == 0:
+            return np.inf
+        lat = self.graph.lat[np.concatenate((sources, targets))]
+        lon = self.graph.lon[np.concatenate((sources, targets))]
+        spread = great_circle(lat.min(), lon.min(), lat.max(), lon.max())
+        return DETOUR_FACTOR * float(spread) + DETOUR_MARGIN
+
+    def _proven(self, row_distances, targets):
+        """
+        Which searched distances are shortest on the full graph as well.
+
+        A full-graph route that leaves the corridor runs inside it up to an
+        exit node and is then at least the straight line from there to the
+        target, since no road is shorter than that. A corridor distance no
+        longer than the best such route is the full graph's too.
+
+        Returns:
+            Boolean array of shape (len(searched sources), len(targets))
+        """
+        distances = row_distances[:, targets]
+        if self.full_graph is self.graph:
+            return np.ones(distances.shape, dtype=bool)
+        exits = self.graph.cache.get('exits')
+        if exits is None:
+            return np.zeros(distances.shape, dtype=bool)
+        if len(exits) == 0:
+            return np.ones(distances.shape, dtype=bool)
+
+        straight = great_circle(self.graph.lat[exits][:, None], self.graph.lon[exits][:, None],
+                                self.graph.lat[targets][None, :], self.graph.lon[targets][None, :])
+        # Exits past the cutoff are at least the cutoff away
+        to_exits = np.minimum(row_distances[:, exits], self.cutoff)
+        bounds = np.array([(row[:, None] + straight).min(axis=0) for row in to_exits])
+        return distances <= bounds.reshape(distances.shape)
+
+    def _search(self, sources, workers):
+        if not workers or workers < 2 or len(sources) < 2:
+            return dijkstra_rows(self.graph, sources, self.cutoff)
+
+        # Workers attach to one shared copy of the CSR arrays
+        handle, blocks = self.graph.share()
+        try:
+            chunks = [chunk for chunk in np.array_split(sources, workers) if len(chunk)]
+            with ProcessPoolExecutor(max_workers=len(chunks), initializer=_attach_worker,
+                                     initargs=(handle,)) as pool:
+                results = list(pool.map(_worker_rows, chunks, [self.cutoff] * len(chunks)))
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+        return (np.concatenate([distances for distances, _ in results]),
+                np.concatenate([predecessors for _, predecessors in results]))
+
+    def _route(self, source, target):
+        row = self._row.get(int(source))
+        if row is None:
+            # Distance came from the cache, search just this connector on
+            # the graph it may have been found on
+            pair = (int(self.graph.node_ids[source]), int(self.graph.node_ids[target]))
+            if self._known.get(pair) == np.inf:
+                return None
+            source, target = self.full_graph.index(list(pair))
+            _, path = astar(self.full_graph, int(source), int(target))
+            return self.full_graph.node_ids[path].tolist() if path is not None else None
+        if source != target and self.predecessors[row, target] == NO_PREDECESSOR:
+            return None
+        path = reconstruct_path(self.predecessors[row], int(target))
+        return self.graph.node_ids[path].tolist()
+
+    def path(self, i, j):
+        """
+        Rebuild the connecting route from the end of segment i to the start of segment j.
+
+        Returns:
+            List of node IDs, or None if segment j is unreachable from segment i
+        """
+        return self._route(self.ends[i], self.starts[j])
+
+    def path_from_start(self, j):
+        """
+        Rebuild the route from the start node to the start of segment j.
+        """
+        return self._route(self.graph.index([self.start_node])[0], self.starts[j])
+
+    def path_to_end(self, i):
+        """
+        Rebuild the route from the end of segment i to the end node.
+        """
+        return self._route(self.ends[i], self.graph.index([self.end_node])[0])
+
+
+class IncrementalConnectors:
+    """
+    Connector distances for a set of segments that changes over time.
+
+    Adding a segment runs one search forward from its end and one backward
+    from its start on the reversed graph, which together fill its row and
+    column of the distance matrix. Removing a segment only drops them, so
+    each change costs two searches however many segments there are. Offers
+    the same attributes and path methods as ConnectorMatrix, with segments
+    numbered in the order of `keys`.
+    """
+
+    def __init__(self, graph):
+        """
+        Args:
+            graph: OSMnx graph object or CSRGraph
+        """
+        self.graph = as_csr(graph)
+        self.keys = []
+        self.start_node = None
+        self.end_node = None
+        self._starts = {}
+        self._ends = {}
+        self._forward = {}
+        self._backward = {}
+        self._distances = {}
+        self._start_row = None
+        self._end_row = None
+
+    def _forward_search(self, source):
+        distances, predecessors = dijkstra_rows(self.graph, [source])
+        return distances[0], predecessors[0]
+
+    def _backward_search(self, target):
+        distances, predecessors = dijkstra_rows(self.graph.reverse(), [target])
+        return distances[0], predecessors[0]
+
+    def add(self, key, path):
+        """
+        Add a segment, or replace the one with the same key.
+
+        Args:
+            key: segment key, e.g. the Strava segment id
+            path: List of node IDs of the matched segment
+        """
+        if key in self._starts:
+            self.remove(key)
+        start, end = (int(node) for node in self.graph.index([path[0], path[-1]]))
+        forward_distances, forward_predecessors = self._forward_search(end)
+        backward_distances, backward_predecessors = self._backward_search(start)
+
+        for other in self.keys:
+            self._distances[(key, other)] = float(forward_distances[self._starts[other]])
+            self._distances[(other, key)] = float(backward_distances[self._ends[other]])
+        self._distances[(key, key)] = 0.0
+
+        # Only the trees are kept; later segments fill their own row and column
+        self.keys.append(key)
+        self._starts[key] = start
+        self._ends[key] = end
+        self._forward[key] = forward_predecessors
+        self._backward[key] = backward_predecessors
+
+    def remove(self, key):
+        """
+        Drop a segment and its connectors.
+        """
+        self.keys.remove(key)
+        for other in self.keys + [key]:
+            self._distances.pop((key, other), None)
+            self._distances.pop((other, key), None)
+        for table in (self._starts, self._ends, self._forward, self._backward):
+            del table[key]
+
+    def set_endpoints(self, start_node=None, end_node=None):
+        """
+        Fix where the route starts and ends; each changed point costs one search.
+        """
+        if start_node != self.start_node:
+            self.start_node = start_node
+            self._start_row = None
+            if start_node is not None:
+                self._start_row = self._forward_search(int(self.graph.index([start_node])[0]))
+        if end_node != self.end_node:
+            self.end_node = end_node
+            self._end_row = None
+            if end_node is not None:
+                self._end_row = self._backward_search(int(self.graph.index([end_node])[0]))
+
+    @property
+    def distances(self):
+        matrix = np.zeros((len(self.keys), len(self.keys)))
+        for i, a in enumerate(self.keys):
+            for j, b in enumerate(self.keys):
+                matrix[i, j] = self._distances[(a, b)]
+        return matrix
+
+    @property
+    def start_distances(self):
+        if self._start_row is None:
+            return None
+        return self._start_row[0][[self._starts[key] for key in self.keys]]
+
+    @property
+    def end_distances(self):
+        if self._end_row is None:
+            return None
+        return self._end_row[0][[self._ends[key] for key in self.keys]]
+
+    def _tree_route(self, predecessors, source, target):
+        if source != target and predecessors[target] == NO_PREDECESSOR:
+            return None
+        return self.graph.node_ids[reconstruct_path(predecessors, int(target))].tolist()
+
+    def path(self, i, j):
+        """
+        Rebuild the connecting route from the end of segment i to the start of segment j.
+
+        Returns:
+            List of node IDs, or None if segment j is unreachable from segment i
+        """
+        return self._tree_route(self._forward[self.keys[i]], self._ends[self.keys[i]],
+                                self._starts[self.keys[j]])
+
+    def path_from_start(self, j):
+        """
+        Rebuild the route from the start node to the start of segment j.
+        """
+        start = int(self.graph.index([self.start_node])[0])
+        return self._tree_route(self._start_row[1], start, self._starts[self.keys[j]])
+
+    def path_to_end(self, i):
+        """
+        Rebuild the route from the end of segment i to the end node.
+        """
+        end = int(self.graph.index([self.end_node])[0])
+        route = self._tree_route(self._end_row[1], end, self._ends[self.keys[i]])
+        # The tree is on the reversed graph, so its path runs from the end node back
+        return route[::-1] if route is not None else None
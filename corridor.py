@@ -0,0 +1,120 @@
+import hashlib
+import math
+
+import numpy as np
+import shapely
+from scipy.sparse.csgraph import minimum_spanning_tree
+from shapely.geometry import LineString, Point
+
+from csr_graph import as_csr
+
+
+# Meters of road network kept on each side of the segments and the gaps
+# between them; doubled each time a connector search fails
+CORRIDOR_WIDTH = 300.0
+MAX_WIDENINGS = 3
+# Besides a spanning tree, each piece is joined to this many nearest pieces
+NEAREST_GAPS = 3
+# Polylines are simplified to this fraction of the width before buffering
+SIMPLIFY_FRACTION = 0.1
+METERS_PER_DEGREE = 111320.0
+
+
+def _project(lat, lon, lat0):
+    """
+    Equirectangular projection to meters around latitude lat0.
+    """
+    x = np.asarray(lon, dtype=np.float64) * METERS_PER_DEGREE * math.cos(math.radians(lat0))
+    y = np.asarray(lat, dtype=np.float64) * METERS_PER_DEGREE
+    return x, y
+
+
+def corridor_shapes(point_lists, lat0):
+    """
+    Projected polylines plus the straight gaps joining them into one tree.
+
+    The gaps are the edges of a minimum spanning tree over the pieces, each
+    joining the closest pair of end points of two pieces.
+
+    Args:
+        point_lists: lists of (lat, lon) points, e.g. segments and a start point
+        lat0: latitude of the projection
+
+    Returns:
+        List of shapely geometries in projected meters
+    """
+    shapes = []
+    ends = []
+    for points in point_lists:
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        x, y = _project(points[:, 0], points[:, 1], lat0)
+        shapes.append(LineString(np.column_stack((x, y))) if len(points) > 1 else Point(x[0], y[0]))
+        ends.append(np.array([[x[0], y[0]], [x[-1], y[-1]]]))
+
+    if len(ends) > 1:
+        # Closest end-to-end distance between every two pieces
+        ends = np.stack(ends)
+        gaps = np.linalg.norm(ends[:, None, :, None, :] - ends[None, :, None, :, :], axis=-1)
+        closest = gaps.reshape(len(ends), len(ends), 4).min(axis=2)
+        # Coincident pieces would vanish from the sparse tree, keep them joined
+        tree = minimum_spanning_tree(np.maximum(closest, 1e-3)).tocoo()
+        pairs = set(zip(tree.row.tolist(), tree.col.tolist()))
+        # Good orders mostly hop to a nearby piece, so those gaps are kept too
+        np.fill_diagonal(closest, np.inf)
+        for i, neighbours in enumerate(np.argsort(closest, axis=1)[:, :NEAREST_GAPS].tolist()):
+            pairs.update((min(i, j), max(i, j)) for j in neighbours if j != i)
+        for i, j in sorted(pairs):
+            a, b = np.unravel_index(np.argmin(gaps[i, j]), (2, 2))
+            shapes.append(LineString([ends[i, a], ends[j, b]]))
+    return shapes
+
+
+def corridor_graph(graph, point_lists, width=CORRIDOR_WIDTH, keep_nodes=None):
+    """
+    Restrict a graph to a buffered corridor around the route.
+
+    Args:
+        graph: OSMnx graph object or CSRGraph
+        point_lists: lists of (lat, lon) points, e.g. segments and a start point
+        width: meters kept on each side
+        keep_nodes: optional OSM node IDs kept even outside the corridor,
+            e.g. the matched segments
+
+    Returns:
+        CSRGraph of the nodes inside the corridor, with its own version and
+        the nodes where it can be left in cache['exits']
+    """
+    graph = as_csr(graph)
+    lat0 = float(np.mean([point[0] for points in point_lists for point in points]))
+    shapes = shapely.simplify(corridor_shapes(point_lists, lat0), width * SIMPLIFY_FRACTION)
+    corridor = shapely.union_all(shapely.buffer(shapes, width, quad_segs=4))
+    shapely.prepare(corridor)
+    x, y = _project(graph.lat, graph.lon, lat0)
+    mask = shapely.contains_xy(corridor, x, y)
+    if keep_nodes is not None and len(keep_nodes):
+        mask[graph.index(keep_nodes)] = True
+
+    version = None
+    if graph.version is not None:
+        version = hashlib.sha1(f"{graph.version}:".encode() + np.packbits(mask).tobytes()).hexdigest()[:16]
+    subgraph = graph.subgraph(mask, version)
+    # Nodes with an edge leaving the corridor; any full-graph route that is
+    # shorter than the corridor's has to pass through one of them
+    sources = np.repeat(np.arange(graph.n_nodes), np.diff(graph.indptr))
+    leaving = np.unique(sources[mask[sources] & ~mask[graph.indices]])
+    subgraph.cache['exits'] = (np.cumsum(mask) - 1)[leaving]
+    print(f"Corridor of {width:.0f} m keeps {subgraph.n_nodes} of {graph.n_nodes} nodes")
+    return subgraph
+
+
+def has_missing_connectors(connectors):
+    """
+    Whether any connector search failed, so a wider corridor could help.
+    """
+    distances = connectors.distances.copy()
+    np.fill_diagonal(distances, 0.0)
+    rows = [distances]
+    for extra in (connectors.start_distances, connectors.end_distances):
+        if extra is not None:
+            rows.append(np.asarray(extra))
+    return any(np.isinf(row).any() for row in rows)
@@ -0,0 +1,252 @@
+import numpy as np
+from multiprocessing import shared_memory
+from scipy.sparse import csr_matrix
+
+
+# Arrays copied by share and attach, with those of a LandmarkIndex if any
+GRAPH_ARRAYS = ('node_ids', 'lat', 'lon', 'indptr', 'indices', 'lengths')
+LANDMARK_ARRAYS = ('landmarks', 'from_landmarks', 'to_landmarks')
+
+
+class CSRGraph:
+    """
+    Road network frozen into flat NumPy arrays.
+
+    Nodes are renumbered 0..n-1 in order of their OSM id. Outgoing edges of
+    node i are indices[indptr[i]:indptr[i + 1]] with lengths in float32;
+    parallel edges are collapsed to the shortest one. Compared with an
+    osmnx MultiDiGraph this takes a small fraction of the memory and lets
+    the routing code work on integer indices instead of dict lookups.
+    """
+
+    def __init__(self, node_ids, lat, lon, indptr, indices, lengths, version=None):
+        self.node_ids = node_ids
+        self.lat = lat
+        self.lon = lon
+        self.indptr = indptr
+        self.indices = indices
+        self.lengths = lengths
+        self.version = version
+        # Version of each (row, col) source tile, set by GraphTileStore
+        self.tile_versions = None
+        # Indexes derived from this graph (spatial, landmarks, ...) live here
+        self.cache = {}
+        self._matrix = None
+        self._reverse = None
+
+    @classmethod
+    def from_edges(cls, node_ids, lat, lon, u, v, lengths, version=None):
+        """
+        Build a CSR graph from node arrays and edges given as OSM ids.
+
+        Args:
+            node_ids, lat, lon: node arrays, possibly with duplicate ids
+            u, v: edge end points as OSM ids
+            lengths: edge lengths in meters
+
+        Returns:
+            CSRGraph
+        """
+        node_ids, first = np.unique(np.asarray(node_ids, dtype=np.int64), return_index=True)
+        lat = np.asarray(lat, dtype=np.float64)[first]
+        lon = np.asarray(lon, dtype=np.float64)[first]
+
+        # Drop edges to unknown nodes and self-loops
+        u_ids = np.asarray(u, dtype=np.int64)
+        v_ids = np.asarray(v, dtype=np.int64)
+        u = np.minimum(np.searchsorted(node_ids, u_ids), max(len(node_ids) - 1, 0))
+        v = np.minimum(np.searchsorted(node_ids, v_ids), max(len(node_ids) - 1, 0))
+        lengths = np.asarray(lengths, dtype=np.float32)
+        if len(node_ids):
+            keep = (node_ids[u] == u_ids) & (node_ids[v] == v_ids) & (u != v)
+        else:
+            keep = np.zeros(len(u), dtype=bool)
+        u, v, lengths = u[keep], v[keep], lengths[keep]
+
+        # Sort by (u, v, length) and keep the shortest of any parallel edges
+        order = np.lexsort((lengths, v, u))
+        u, v, lengths = u[order], v[order], lengths[order]
+        first_of_pair = np.ones(len(u), dtype=bool)
+        first_of_pair[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+        u, v, lengths = u[first_of_pair], v[first_of_pair], lengths[first_of_pair]
+
+        indptr = np.zeros(len(node_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(u, minlength=len(node_ids)), out=indptr[1:])
+        return cls(node_ids, lat, lon, indptr, v.astype(np.int32), lengths, version)
+
+    @classmethod
+    def from_networkx(cls, graph):
+        """
+        Freeze an OSMnx graph into a CSR graph.
+        """
+        node_ids = np.fromiter(graph.nodes, dtype=np.int64, count=len(graph.nodes))
+        lat = np.fromiter((graph.nodes[n]['y'] for n in node_ids.tolist()), dtype=np.float64, count=len(node_ids))
+        lon = np.fromiter((graph.nodes[n]['x'] for n in node_ids.tolist()), dtype=np.float64, count=len(node_ids))
+        u, v, lengths = [], [], []
+        for a, b, data in graph.edges(data=True):
+            u.append(a)
+            v.append(b)
+            lengths.append(data.get('length', 0.0))
+        return cls.from_edges(node_ids, lat, lon, u, v, lengths, graph.graph.get('version'))
+
+    @property
+    def n_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def n_edges(self):
+        return len(self.indices)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.node_ids, self.lat, self.lon, self.indptr, self.indices, self.lengths))
+
+    def index(self, node_ids):
+        """
+        Map OSM node ids to internal indices.
+        """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        positions = np.searchsorted(self.node_ids, node_ids)
+        positions = np.minimum(positions, max(self.n_nodes - 1, 0))
+        if self.n_nodes == 0 or np.any(self.node_ids[positions] != node_ids):
+            raise KeyError("Node not in graph")
+        return positions
+
+    def coordinates(self, indices):
+        """
+        Return [lat, lon] pairs for a sequence of internal node indices.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        return np.column_stack((self.lat[indices], self.lon[indices])).tolist()
+
+    def neighbours(self, node):
+        """
+        Return (targets, lengths) arrays of the edges leaving a node.
+        """
+        start, end = self.indptr[node], self.indptr[node + 1]
+        return self.indices[start:end], self.lengths[start:end]
+
+    def edge_length(self, u, v):
+        """
+        Length of the edge u -> v, or None if there is no such edge.
+        """
+        targets, lengths = self.neighbours(u)
+        match = np.nonzero(targets == v)[0]
+        return float(lengths[match[0]]) if len(match) else None
+
+    @property
+    def matrix(self):
+        """
+        The graph as a scipy sparse matrix for scipy.sparse.csgraph.
+        """
+        if self._matrix is None:
+            self._matrix = csr_matrix((self.lengths, self.indices, self.indptr),
+                                      shape=(self.n_nodes, self.n_nodes))
+        return self._matrix
+
+    def reverse(self):
+        """
+        The same graph with every edge reversed, built once and cached.
+        """
+        if self._reverse is None:
+            transposed = self.matrix.T.tocsr()
+            transposed.sort_indices()
+            self._reverse = CSRGraph(self.node_ids, self.lat, self.lon,
+                                     transposed.indptr.astype(np.int64),
+                                     transposed.indices.astype(np.int32),
+                                     transposed.data.astype(np.float32),
+                                     self.version)
+            self._reverse.tile_versions = self.tile_versions
+            self._reverse._reverse = self
+        return self._reverse
+
+    def subgraph(self, mask, version=None):
+        """
+        The nodes where mask is True and the edges between them.
+
+        Args:
+            mask: boolean array over the internal node indices
+            version: version of the subgraph, e.g. derived from this one's
+
+        Returns:
+            CSRGraph keeping this graph's tile versions
+        """
+        mask = np.asarray(mask, dtype=bool)
+        keep = np.flatnonzero(mask)
+        renumber = np.full(self.n_nodes, -1, dtype=np.int64)
+        renumber[keep] = np.arange(len(keep))
+
+        # Edges are grouped by source already, so filtering keeps the CSR order
+        sources = np.repeat(np.arange(self.n_nodes), np.diff(self.indptr))
+        edges = mask[sources] & mask[self.indices]
+        indptr = np.zeros(len(keep) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(renumber[sources[edges]], minlength=len(keep)), out=indptr[1:])
+        graph = CSRGraph(self.node_ids[keep], self.lat[keep], self.lon[keep], indptr,
+                         renumber[self.indices[edges]].astype(np.int32), self.lengths[edges], version)
+        graph.tile_versions = self.tile_versions
+        if 'landmarks' in self.cache:
+            # Distances on a subgraph are never shorter, so the bounds still hold
+            graph.cache['landmarks'] = self.cache['landmarks'].subset(keep)
+        return graph
+
+    def share(self):
+        """
+        Copy the arrays into shared memory so other processes can attach.
+
+        Returns:
+            Tuple of (handle to pass to CSRGraph.attach, list of SharedMemory
+            blocks the caller must close and unlink when done)
+        """
+        handle = {'version': self.version, 'tile_versions': self.tile_versions, 'arrays': {}}
+        arrays = {name: getattr(self, name) for name in GRAPH_ARRAYS}
+        landmarks = self.cache.get('landmarks')
+        if landmarks is not None:
+            arrays.update({name: getattr(landmarks, name) for name in LANDMARK_ARRAYS})
+        blocks = []
+        for name, array in arrays.items():
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+            handle['arrays'][name] = (block.name, array.shape, array.dtype.str)
+            blocks.append(block)
+        return handle, blocks
+
+    @classmethod
+    def attach(cls, handle):
+        """
+        Attach to a graph shared by CSRGraph.share, without copying.
+
+        Returns:
+            Tuple of (CSRGraph, list of SharedMemory blocks to close when done)
+        """
+        arrays = {}
+        blocks = []
+        for name, (block_name, shape, dtype) in handle['arrays'].items():
+            block = shared_memory.SharedMemory(name=block_name)
+            # frombuffer keeps the mapping open for as long as the array lives
+            arrays[name] = np.frombuffer(block.buf, dtype=np.dtype(dtype),
+                                         count=int(np.prod(shape))).reshape(shape)
+            blocks.append(block)
+        graph = cls(version=handle['version'], **{name: arrays[name] for name in GRAPH_ARRAYS})
+        graph.tile_versions = handle.get('tile_versions')
+        if all(name in arrays for name in LANDMARK_ARRAYS):
+            from landmarks import LandmarkIndex
+
+            graph.cache['landmarks'] = LandmarkIndex(*(arrays[name] for name in LANDMARK_ARRAYS),
+                                                     version=handle['version'])
+        return graph, blocks
+
+
+def as_csr(graph):
+    """
+    Return the CSR form of a graph, freezing and caching it on first use.
+
+    Accepts a CSRGraph (returned as is) or an OSMnx graph, whose CSR copy is
+    cached on the graph so it is only built once.
+    """
+    if isinstance(graph, CSRGraph):
+        return graph
+    csr = graph.graph.get('_csr')
+    if csr is None:
+        csr = CSRGraph.from_networkx(graph)
+        graph.graph['_csr'] = csr
+    return csr
@@ -0,0 +1,199 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing import resource_tracker
+from multiprocessing.connection import Client, Listener
+
+from csr_graph import CSRGraph
+from graph_store import GraphTileStore, tiles_for_bbox
+
+
+# Seconds a replaced graph stays shared, so workers that were just sent its
+# handle can still attach
+UNLINK_DELAY = 60.0
+
+
+class SharedGraphServer:
+    """
+    Loader side of the shared graph store.
+
+    Owns the GraphTileStore, so tiles are downloaded and stitched once,
+    and copies every graph it builds into shared memory. Server worker
+    processes attach to those copies through RemoteGraphStore instead of
+    each keeping graphs of their own.
+    """
+
+    def __init__(self, store, max_graphs=8):
+        """
+        Args:
+            store: GraphTileStore the graphs are built from
+            max_graphs: number of shared graphs kept; older ones are unlinked
+        """
+        self.store = store
+        self.max_graphs = max_graphs
+        self._shared = OrderedDict()
+        self._retired = []
+        self._lock = threading.Lock()
+
+    def get_handle(self, north, south, east, west, network_type='walk'):
+        """
+        Return the shared-memory handle of the graph covering a bounding box.
+        """
+        csr = self.store.get_csr(north, south, east, west, network_type)
+        key = (network_type, tuple(tiles_for_bbox(north, south, east, west)))
+        with self._lock:
+            entry = self._shared.get(key)
+            if entry is not None and entry[0] is csr:
+                self._shared.move_to_end(key)
+                return entry[1]
+
+            # New, or rebuilt by the tile store since it was shared
+            handle, blocks = csr.share()
+            now = time.time()
+            if entry is not None:
+                self._retired.append((now, entry[2]))
+            self._shared[key] = (csr, handle, blocks)
+            while len(self._shared) > self.max_graphs:
+                _, (_, _, old_blocks) = self._shared.popitem(last=False)
+                self._retired.append((now, old_blocks))
+            while self._retired and now - self._retired[0][0] > UNLINK_DELAY:
+                self._unlink(self._retired.pop(0)[1])
+            print(f"Shared graph with {csr.n_nodes} nodes ({csr.nbytes / 1e6:.1f} MB), "
+                  f"{len(self._shared)} graphs shared")
+            return handle
+
+    def _unlink(self, blocks):
+        # Workers still attached keep their mapping until they let go of it
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    def close(self):
+        with self._lock:
+            for _, _, blocks in self._shared.values():
+                self._unlink(blocks)
+            for _, blocks in self._retired:
+                self._unlink(blocks)
+            self._shared.clear()
+            self._retired = []
+
+    def _handle_connection(self, connection):
+        with connection:
+            while True:
+                try:
+                    request = connection.recv()
+                except EOFError:
+                    return
+                try:
+                    connection.send(('ok', self.get_handle(*request)))
+                except Exception as e:
+                    print(f"Error loading graph {request}: {e}")
+                    connection.send(('error', str(e)))
+
+    def serve(self, address, authkey):
+        """
+        Answer graph requests from worker processes until interrupted.
+
+        Args:
+            address: Unix socket path or (host, port) to listen on
+            authkey: bytes shared with the workers
+        """
+        print(f"Graph loader listening on {address}")
+        with Listener(address, authkey=authkey) as listener:
+            try:
+                while True:
+                    connection = listener.accept()
+                    threading.Thread(target=self._handle_connection, args=(connection,), daemon=True).start()
+            finally:
+                self.close()
+
+
+class RemoteGraphStore:
+    """
+    Worker side of the shared graph store, used in place of a GraphTileStore.
+
+    get_csr asks the loader process for a graph and attaches to its shared
+    memory without copying. Graphs stay attached while they are in use, so
+    a loader that has moved on to newer graphs never pulls arrays out from
+    under a request.
+    """
+
+    def __init__(self, address, authkey, memory_graphs=8):
+        """
+        Args:
+            address: address the loader listens on
+            authkey: bytes shared with the loader
+            memory_graphs: number of attached graphs kept
+        """
+        self.address = address
+        self.authkey = authkey
+        self.memory_graphs = memory_graphs
+        self._graphs = OrderedDict()
+        self._retired = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _request(self, message):
+        # One connection per thread, reopened once if the loader restarted
+        for attempt in range(2):
+            connection = getattr(self._local, 'connection', None)
+            if connection is None:
+                connection = self._local.connection = Client(self.address, authkey=self.authkey)
+            try:
+                connection.send(message)
+                return connection.recv()
+            except (EOFError, OSError):
+                self._local.connection = None
+                if attempt:
+                    raise
+
+    def get_csr(self, north, south, east, west, network_type='walk'):
+        """
+        Get the CSR graph covering a bounding box from the loader process.
+
+        Returns:
+            CSRGraph backed by shared memory
+        """
+        status, handle = self._request((north, south, east, west, network_type))
+        if status != 'ok':
+            raise RuntimeError(f"Graph loader failed: {handle}")
+
+        # Block names identify a graph, reattaching would give the same arrays
+        key = handle['arrays']['node_ids'][0]
+        with self._lock:
+            if key in self._graphs:
+                self._graphs.move_to_end(key)
+                return self._graphs[key][0]
+            graph, blocks = CSRGraph.attach(handle)
+            for block in blocks:
+                # The loader owns the blocks; stop this process unlinking them when it exits
+                resource_tracker.unregister(block._name, 'shared_memory')
+            self._graphs[key] = (graph, blocks)
+            while len(self._graphs) > self.memory_graphs:
+                self._retired.extend(self._graphs.popitem(last=False)[1][1])
+            self._close_retired()
+        return graph
+
+    def _close_retired(self):
+        # Dropped graphs are unmapped once no request uses their arrays anymore
+        in_use = []
+        for block in self._retired:
+            try:
+                block.close()
+            except BufferError:
+                in_use.append(block)
+        self._retired = in_use
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve shared road-network graphs to server workers')
+    parser.add_argument('--address', default=os.environ.get('GRAPH_SERVER_ADDRESS', 'graph_server.sock'))
+    parser.add_argument('--dir', default=os.environ.get('GRAPH_TILE_DIR', 'graph_tiles'))
+    parser.add_argument('--offline', action='store_true')
+    args = parser.parse_args()
+
+    server = SharedGraphServer(GraphTileStore(args.dir, offline=args.offline))
+    server.serve(args.address, os.environ.get('GRAPH_SERVER_AUTHKEY', '').encode())
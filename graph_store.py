@@ -0,0 +1,453 @@
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import metrics
+from csr_graph import CSRGraph
+from landmarks import LandmarkIndex
+
+
+# Size of a road-network tile in degrees (~2 km north-south)
+TILE_DEG = 0.02
+
+NODE_DTYPE = np.dtype([('osmid', '<i8'), ('y', '<f8'), ('x', '<f8')])
+EDGE_DTYPE = np.dtype([('u', '<i8'), ('v', '<i8'), ('key', '<u2'), ('length', '<f4')])
+
+
+def tile_index(lat, lon):
+    """
+    Return the (row, col) index of the tile containing a point.
+    """
+    return int(math.floor(lat / TILE_DEG)), int(math.floor(lon / TILE_DEG))
+
+
+def tile_bounds(row, col):
+    """
+    Return the (north, south, east, west) bounds of a tile.
+    """
+    south = row * TILE_DEG
+    west = col * TILE_DEG
+    return south + TILE_DEG, south, west + TILE_DEG, west
+
+
+def tiles_for_bbox(north, south, east, west):
+    """
+    List the tile indices needed to cover a bounding box.
+    """
+    row_min, col_min = tile_index(south, west)
+    row_max, col_max = tile_index(north, east)
+    return [(row, col)
+            for row in range(row_min, row_max + 1)
+            for col in range(col_min, col_max + 1)]
+
+
+def graph_to_arrays(graph):
+    """
+    Convert an OSMnx graph into compact node and edge arrays.
+
+    Args:
+        graph: OSMnx graph object (unprojected)
+
+    Returns:
+        Tuple of (nodes, edges) structured numpy arrays
+    """
+    nodes = np.empty(len(graph.nodes), dtype=NODE_DTYPE)
+    for i, (node, data) in enumerate(graph.nodes(data=True)):
+        nodes[i] = (node, data['y'], data['x'])
+
+    edges = np.empty(len(graph.edges), dtype=EDGE_DTYPE)
+    for i, (u, v, key, data) in enumerate(graph.edges(keys=True, data=True)):
+        edges[i] = (u, v, key, data.get('length', 0.0))
+
+    return nodes, edges
+
+
+def arrays_to_graph(nodes, edges):
+    """
+    Build an OSMnx-compatible MultiDiGraph from node and edge arrays.
+
+    Args:
+        nodes: structured array with osmid, y and x fields
+        edges: structured array with u, v, key and length fields
+
+    Returns:
+        networkx MultiDiGraph usable by osmnx and the routing code
+    """
+    import networkx as nx
+
+    graph = nx.MultiDiGraph(crs='epsg:4326')
+    graph.add_nodes_from(
+        (int(osmid), {'y': float(y), 'x': float(x)})
+        for osmid, y, x in zip(nodes['osmid'].tolist(), nodes['y'].tolist(), nodes['x'].tolist())
+    )
+    graph.add_edges_from(
+        (int(u), int(v), int(key), {'length': float(length)})
+        for u, v, key, length in zip(edges['u'].tolist(), edges['v'].tolist(),
+                                     edges['key'].tolist(), edges['length'].tolist())
+    )
+    return graph
+
+
+def split_into_tiles(nodes, edges):
+    """
+    Split node and edge arrays into per-tile arrays.
+
+    A tile owns the nodes that fall inside it and every edge starting at one
+    of those nodes. The far end of an edge leaving the tile is stored with it
+    so a tile is self-contained; stitching removes the duplicates.
+
+    Returns:
+        Dictionary mapping (row, col) to (nodes, edges) arrays
+    """
+    rows = np.floor(nodes['y'] / TILE_DEG).astype(np.int64)
+    cols = np.floor(nodes['x'] / TILE_DEG).astype(np.int64)
+
+    order = np.argsort(nodes['osmid'])
+    sorted_ids = nodes['osmid'][order]
+    u_pos = order[np.searchsorted(sorted_ids, edges['u'])]
+    v_pos = order[np.searchsorted(sorted_ids, edges['v'])]
+
+    tiles = {}
+    for row, col in set(zip(rows.tolist(), cols.tolist())):
+        owned = (rows == row) & (cols == col)
+        tile_edges = owned[u_pos]
+        node_mask = owned.copy()
+        node_mask[v_pos[tile_edges]] = True
+        tiles[(row, col)] = (nodes[node_mask], edges[tile_edges])
+    return tiles
+
+
+class GraphTileStore:
+    """
+    On-disk store of road-network tiles with an in-memory LRU layer.
+
+    Tiles are fixed TILE_DEG x TILE_DEG cells saved as .npy arrays and
+    memory-mapped when loaded. A request stitches the tiles covering its
+    bounding box into a single graph. Missing tiles are downloaded from
+    Overpass unless the store is offline, in which case only pre-seeded
+    tiles are used.
+
+    Stitched CSR graphs get the landmark index saved for their version, if
+    any, and with landmarks > 0 one is built and saved for graphs without.
+    """
+
+    def __init__(self, root, offline=False, max_bytes=None, memory_tiles=64, memory_graphs=8, landmarks=0):
+        """
+        Args:
+            root: directory holding the tiles
+            offline: never download, only read pre-seeded tiles
+            max_bytes: evict least recently used tiles above this disk size
+            memory_tiles: number of tiles kept in memory
+            memory_graphs: number of stitched graphs kept in memory
+            landmarks: number of landmarks to build for graphs without a
+                saved index; 0 only loads saved ones
+        """
+        self.root = root
+        self.offline = offline
+        self.max_bytes = max_bytes
+        self.memory_tiles = memory_tiles
+        self.memory_graphs = memory_graphs
+        self.landmarks = landmarks
+        self._tiles = OrderedDict()
+        self._graphs = OrderedDict()
+        self._lock = threading.Lock()
+        self._download_locks = {}
+        self._build_locks = {}
+
+    def _tile_path(self, network_type, row, col, suffix):
+        return os.path.join(self.root, network_type, f"{row}_{col}.{suffix}")
+
+    def _landmark_path(self, network_type, version):
+        return os.path.join(self.root, network_type, 'landmarks', f"{version}.npz")
+
+    def has_tile(self, network_type, row, col):
+        return os.path.exists(self._tile_path(network_type, row, col, 'meta.json'))
+
+    def write_tile(self, network_type, row, col, nodes, edges):
+        """
+        Save a tile to disk, replacing any previous version.
+        """
+        os.makedirs(os.path.join(self.root, network_type), exist_ok=True)
+        nodes = np.ascontiguousarray(nodes, dtype=NODE_DTYPE)
+        edges = np.ascontiguousarray(edges, dtype=EDGE_DTYPE)
+        version = hashlib.sha1(nodes.tobytes() + edges.tobytes()).hexdigest()[:16]
+
+        # Write to temporary names first so readers never see half a tile
+        for suffix, array in (('nodes.npy', nodes), ('edges.npy', edges)):
+            path = self._tile_path(network_type, row, col, suffix)
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, array)
+            os.replace(path + '.tmp', path)
+        meta_path = self._tile_path(network_type, row, col, 'meta.json')
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump({'version': version, 'created': time.time(),
+                       'nodes': len(nodes), 'edges': len(edges)}, f)
+        os.replace(meta_path + '.tmp', meta_path)
+
+        with self._lock:
+            self._tiles.pop((network_type, row, col), None)
+            for key in [key for key in self._graphs
+                        if key[1] == network_type and (row, col) in key[2]]:
+                del self._graphs[key]
+        return version
+
+    def write_graph(self, graph, network_type='walk'):
+        """
+        Split a graph into tiles and save every tile it touches.
+
+        Returns:
+            List of (row, col) tiles written
+        """
+        nodes, edges = graph_to_arrays(graph)
+        tiles = split_into_tiles(nodes, edges)
+        for (row, col), (tile_nodes, tile_edges) in tiles.items():
+            self.write_tile(network_type, row, col, tile_nodes, tile_edges)
+        self._enforce_disk_limit()
+        return sorted(tiles)
+
+    def seed_from_file(self, filepath, network_type='walk'):
+        """
+        Pre-seed the store from a local .osm/.xml extract or a .graphml file.
+
+        Returns:
+            List of (row, col) tiles written
+        """
+        import osmnx as ox
+
+        if filepath.endswith('.graphml'):
+            graph = ox.load_graphml(filepath)
+        else:
+            graph = ox.graph_from_xml(filepath, simplify=True, retain_all=True)
+        print(f"Seeding {network_type} tiles from {filepath}: "
+              f"{len(graph.nodes)} nodes, {len(graph.edges)} edges")
+        return self.write_graph(graph, network_type)
+
+    def _download_tile(self, network_type, row, col):
+        # osmnx takes seconds to import and is only needed to download
+        import osmnx as ox
+
+        north, south, east, west = tile_bounds(row, col)
+        print(f"Downloading {network_type} tile {row}_{col}")
+        try:
+            with metrics.timed('tile_download'):
+                graph = ox.graph_from_bbox(north, south, east, west,
+                                           network_type=network_type,
+                                           simplify=True,
+                                           retain_all=True,
+                                           truncate_by_edge=True)
+            nodes, edges = graph_to_arrays(graph)
+        except (ValueError, ox._errors.InsufficientResponseError) as e:
+            # Tiles without any roads are stored empty so they are not retried
+            print(f"No road network in tile {row}_{col}: {e}")
+            nodes = np.empty(0, dtype=NODE_DTYPE)
+            edges = np.empty(0, dtype=EDGE_DTYPE)
+
+        tiles = split_into_tiles(nodes, edges)
+        tile_nodes, tile_edges = tiles.get((row, col), (nodes[:0], edges[:0]))
+        self.write_tile(network_type, row, col, tile_nodes, tile_edges)
+        self._enforce_disk_limit()
+
+    def _load_tile(self, network_type, row, col):
+        key = (network_type, row, col)
+        with self._lock:
+            if key in self._tiles:
+                self._tiles.move_to_end(key)
+                metrics.increment('cache_requests_total', cache='tile', result='hit')
+                return self._tiles[key]
+            download_lock = self._download_locks.setdefault(key, threading.Lock())
+
+        with download_lock:
+            if not self.has_tile(network_type, row, col):
+                metrics.increment('cache_requests_total', cache='tile', result='miss')
+                if self.offline:
+                    print(f"Tile {row}_{col} not seeded, treating as empty (offline)")
+                    return None
+                self._download_tile(network_type, row, col)
+            else:
+                metrics.increment('cache_requests_total', cache='tile', result='disk')
+
+            meta_path = self._tile_path(network_type, row, col, 'meta.json')
+            with open(meta_path) as f:
+                version = json.load(f)['version']
+            # Touch the metadata so disk eviction sees recently used tiles
+            os.utime(meta_path)
+            tile = (
+                np.load(self._tile_path(network_type, row, col, 'nodes.npy'), mmap_mode='r'),
+                np.load(self._tile_path(network_type, row, col, 'edges.npy'), mmap_mode='r'),
+                version,
+            )
+
+        with self._lock:
+            self._tiles[key] = tile
+            while len(self._tiles) > self.memory_tiles:
+                self._tiles.popitem(last=False)
+        return tile
+
+    def _stitch(self, network_type, tiles):
+        """
+        Concatenate the arrays of several tiles, dropping duplicate nodes.
+
+        Returns:
+            Tuple of (nodes, edges, version, tile_versions) where tile_versions
+            maps each (row, col) to its version, or None if it has no data
+        """
+        loaded = []
+        tile_versions = {}
+        for row, col in tiles:
+            tile = self._load_tile(network_type, row, col)
+            tile_versions[(row, col)] = tile[2] if tile is not None else None
+            if tile is not None:
+                loaded.append((row, col, tile))
+        nodes = np.concatenate([tile[0] for _, _, tile in loaded] + [np.empty(0, dtype=NODE_DTYPE)])
+        edges = np.concatenate([tile[1] for _, _, tile in loaded] + [np.empty(0, dtype=EDGE_DTYPE)])
+        _, unique = np.unique(nodes['osmid'], return_index=True)
+
+        version_list = ','.join(f"{row}_{col}:{tile[2]}" for row, col, tile in loaded)
+        version = hashlib.sha1(version_list.encode()).hexdigest()[:16]
+        return nodes[unique], edges, version, tile_versions
+
+    def _cached(self, key, build):
+        with self._lock:
+            if key in self._graphs:
+                self._graphs.move_to_end(key)
+                metrics.increment('cache_requests_total', cache='graph', result='hit')
+                return self._graphs[key]
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
+
+        # Concurrent requests for the same graph wait for one build
+        with build_lock:
+            with self._lock:
+                if key in self._graphs:
+                    metrics.increment('cache_requests_total', cache='graph', result='hit')
+                    return self._graphs[key]
+            metrics.increment('cache_requests_total', cache='graph', result='miss')
+            graph = build()
+            with self._lock:
+                self._graphs[key] = graph
+                while len(self._graphs) > self.memory_graphs:
+                    self._graphs.popitem(last=False)
+        return graph
+
+    def get_graph(self, north, south, east, west, network_type='walk'):
+        """
+        Get a graph covering a bounding box by stitching cached tiles.
+
+        Args:
+            north, south, east, west: bounding box coordinates
+            network_type: 'walk', 'bike', 'drive', etc.
+
+        Returns:
+            OSMnx-compatible graph; graph.graph['version'] identifies the tile data
+        """
+        tiles = tuple(tiles_for_bbox(north, south, east, west))
+
+        def build():
+            nodes, edges, version, _ = self._stitch(network_type, tiles)
+            graph = arrays_to_graph(nodes, edges)
+            graph.graph['version'] = version
+            return graph
+
+        return self._cached(('graph', network_type, tiles), build)
+
+    def get_csr(self, north, south, east, west, network_type='walk'):
+        """
+        Get the CSR form of the graph covering a bounding box.
+
+        Built straight from the tile arrays without an intermediate networkx
+        graph, so this is what the routing code should cache and use.
+
+        Returns:
+            CSRGraph; its version identifies the tile data and its
+            tile_versions the data of each tile
+        """
+        tiles = tuple(tiles_for_bbox(north, south, east, west))
+
+        def build():
+            nodes, edges, version, tile_versions = self._stitch(network_type, tiles)
+            csr = CSRGraph.from_edges(nodes['osmid'], nodes['y'], nodes['x'],
+                                      edges['u'], edges['v'], edges['length'], version)
+            csr.tile_versions = tile_versions
+            self._load_landmarks(csr, network_type)
+            return csr
+
+        return self._cached(('csr', network_type, tiles), build)
+
+    def _load_landmarks(self, csr, network_type):
+        """
+        Attach the saved landmark index of a graph, building it if configured.
+        """
+        if csr.n_nodes == 0:
+            return
+        path = self._landmark_path(network_type, csr.version)
+        index = None
+        if os.path.exists(path):
+            index = LandmarkIndex.load(path, csr)
+            os.utime(path)
+        if index is None and self.landmarks:
+            with metrics.timed('landmarks'):
+                index = LandmarkIndex.build(csr, self.landmarks)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            index.save(path + '.tmp')
+            os.replace(path + '.tmp', path)
+            self._enforce_disk_limit()
+        if index is not None:
+            csr.cache['landmarks'] = index
+
+    def _enforce_disk_limit(self):
+        """
+        Delete least recently used tiles and landmark indexes until the store fits in max_bytes.
+        """
+        if self.max_bytes is None:
+            return
+
+        tiles = []
+        total = 0
+        for network_type in os.listdir(self.root):
+            directory = os.path.join(self.root, network_type)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if not name.endswith('.meta.json'):
+                    continue
+                stem = name[:-len('.meta.json')]
+                paths = [os.path.join(directory, f"{stem}.{suffix}")
+                         for suffix in ('nodes.npy', 'edges.npy', 'meta.json')]
+                size = sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+                tiles.append((os.path.getmtime(paths[-1]), size, paths))
+                total += size
+            # Landmark indexes of stitched graphs are evicted the same way
+            directory = os.path.join(directory, 'landmarks')
+            for name in os.listdir(directory) if os.path.isdir(directory) else []:
+                path = os.path.join(directory, name)
+                size = os.path.getsize(path)
+                tiles.append((os.path.getmtime(path), size, [path]))
+                total += size
+
+        for _, size, paths in sorted(tiles):
+            if total <= self.max_bytes:
+                break
+            print(f"Evicting {paths[-1]}")
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+            total -= size
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Seed the road-network tile store from a local extract')
+    parser.add_argument('extract', help='.osm/.xml or .graphml file')
+    parser.add_argument('--dir', default=os.environ.get('GRAPH_TILE_DIR', 'graph_tiles'))
+    parser.add_argument('--network-type', default='walk')
+    args = parser.parse_args()
+
+    store = GraphTileStore(args.dir)
+    written = store.seed_from_file(args.extract, args.network_type)
+    print(f"Wrote {len(written)} tiles to {args.dir}")
@@ -0,0 +1,258 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Finished jobs are kept this many seconds so late clients can fetch the result
+JOB_RETENTION = 300
+# Seconds between checks for new events of a job run by another process
+JOB_POLL_INTERVAL = 0.05
+
+
+class JobCancelled(Exception):
+    """
+    Raised inside a job's work function when the job has been cancelled.
+    """
+
+
+class Job:
+    """
+    One unit of background work with a log of progress events.
+
+    The job's state lives in its JobQueue's database, so any server process
+    sharing that database can follow, cancel or fetch a job whichever
+    process runs it. The work function receives the job's report method as
+    its progress callback. Reporting is also where cancellation takes
+    effect: once the job is cancelled the next report raises JobCancelled,
+    so long-running work stops at its next checkpoint.
+    """
+
+    def __init__(self, queue, job_id, client_id=None):
+        self.queue = queue
+        self.id = job_id
+        self.client_id = client_id
+
+    def _row(self):
+        return self.queue._fetch('SELECT status, result, error, cancelled FROM jobs WHERE id = ?', (self.id,))
+
+    @property
+    def status(self):
+        row = self._row()
+        return row[0] if row is not None else 'cancelled'
+
+    @property
+    def done(self):
+        return self.status in ('done', 'failed', 'cancelled')
+
+    @property
+    def cancelled(self):
+        row = self._row()
+        return row is None or bool(row[3])
+
+    @property
+    def result(self):
+        row = self._row()
+        return json.loads(row[1]) if row is not None and row[1] is not None else None
+
+    @property
+    def error(self):
+        row = self._row()
+        return row[2] if row is not None else None
+
+    @property
+    def events(self):
+        return self.queue._events(self.id, 0)
+
+    def report(self, stage, **data):
+        """
+        Record a progress event, raising JobCancelled if the job was cancelled.
+
+        Args:
+            stage: short name of the step just completed, e.g. 'graph_loaded'
+            **data: extra JSON-serializable details for the client
+        """
+        if self.cancelled:
+            raise JobCancelled()
+        self.queue._add_event(self.id, dict(data, stage=stage))
+
+    def cancel(self):
+        """
+        Ask the job to stop; a queued job never starts.
+        """
+        self.queue._execute('UPDATE jobs SET cancelled = 1 WHERE id = ?', (self.id,))
+        self.queue._finish(self.id, 'cancelled', only_from='queued')
+
+    def wait_events(self, since, timeout=None):
+        """
+        Block until there are events after index `since` or the job is done.
+
+        Returns:
+            List of new events, empty if the timeout expired first
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            events = self.queue._events(self.id, since)
+            if events or self.done or (deadline is not None and time.time() >= deadline):
+                return events
+            time.sleep(JOB_POLL_INTERVAL)
+
+    def to_dict(self):
+        row = self._row()
+        events = self.events
+        return {
+            'job_id': self.id,
+            'status': row[0] if row is not None else 'cancelled',
+            'progress': events[-1] if events else None,
+            'result': json.loads(row[1]) if row is not None and row[1] is not None else None,
+            'error': row[2] if row is not None else None,
+        }
+
+
+class JobQueue:
+    """
+    Runs jobs on a bounded thread pool, one live job per client.
+
+    Submitting a new job for a client cancels the one it supersedes, so a
+    burst of map refreshes only ever computes the latest route, and the
+    small pool keeps slow routes from taking every server thread. Jobs and
+    their events are kept in SQLite; server processes opening the same file
+    share them, so a job started by one worker can be streamed, cancelled
+    or superseded through any other.
+    """
+
+    def __init__(self, path=':memory:', max_workers=2):
+        """
+        Args:
+            path: SQLite database file shared by the server processes
+            max_workers: jobs run at once by this process
+        """
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._running = {}
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            client_id TEXT,
+            status TEXT NOT NULL,
+            cancelled INTEGER NOT NULL DEFAULT 0,
+            result TEXT,
+            error TEXT,
+            finished_at REAL)''')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS job_events (
+            job_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            event TEXT NOT NULL,
+            PRIMARY KEY (job_id, seq))''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS jobs_client ON jobs (client_id, status)')
+        self._db.commit()
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            cursor = self._db.execute(sql, parameters)
+            self._db.commit()
+            return cursor.rowcount
+
+    def _fetch(self, sql, parameters=()):
+        with self._lock:
+            return self._db.execute(sql, parameters).fetchone()
+
+    def _events(self, job_id, since):
+        with self._lock:
+            rows = self._db.execute('SELECT event FROM job_events WHERE job_id = ? AND seq >= ? ORDER BY seq',
+                                    (job_id, since)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def _add_event(self, job_id, event):
+        with self._lock:
+            self._db.execute('INSERT INTO job_events SELECT ?, COUNT(*), ? FROM job_events WHERE job_id = ?',
+                             (job_id, json.dumps(event), job_id))
+            self._db.commit()
+
+    def _finish(self, job_id, status, result=None, error=None, only_from=None):
+        # result is already JSON. The final event is added with the status,
+        # so a stream never sees a finished job without it
+        with self._lock:
+            condition = 'status = ?' if only_from else "status IN ('queued', 'running')"
+            changed = self._db.execute(
+                f'UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ? AND {condition}',
+                (status, result, error, time.time(), job_id)
+                + ((only_from,) if only_from else ())).rowcount
+            if changed:
+                self._db.execute('INSERT INTO job_events SELECT ?, COUNT(*), ? FROM job_events WHERE job_id = ?',
+                                 (job_id, json.dumps({'stage': status}), job_id))
+            self._db.commit()
+
+    def _start(self, job_id):
+        with self._lock:
+            changed = self._db.execute(
+                "UPDATE jobs SET status = 'running' WHERE id = ? AND status = 'queued' AND cancelled = 0",
+                (job_id,)).rowcount
+            self._db.commit()
+        if not changed:
+            self._finish(job_id, 'cancelled')
+        return bool(changed)
+
+    def submit(self, func, *args, client_id=None, **kwargs):
+        """
+        Queue func(*args, progress=job.report, **kwargs) and return its Job.
+
+        func returns the job result, which must be JSON-serializable. A
+        JobCancelled it raises marks the job cancelled; any other exception
+        marks it failed.
+        """
+        job = Job(self, uuid.uuid4().hex, client_id)
+        self._expire()
+        if client_id is not None:
+            with self._lock:
+                previous = self._db.execute(
+                    "SELECT id FROM jobs WHERE client_id = ? AND status IN ('queued', 'running')",
+                    (str(client_id),)).fetchall()
+            for (previous_id,) in previous:
+                print(f"Cancelling superseded job {previous_id} for client {client_id}")
+                Job(self, previous_id, client_id).cancel()
+        self._execute("INSERT INTO jobs (id, client_id, status) VALUES (?, ?, 'queued')",
+                      (job.id, str(client_id) if client_id is not None else None))
+        self._running[job.id] = job
+        self._executor.submit(self._run, job, func, args, kwargs)
+        return job
+
+    def _run(self, job, func, args, kwargs):
+        try:
+            if not self._start(job.id):
+                return
+            try:
+                result = json.dumps(func(*args, progress=job.report, **kwargs))
+            except JobCancelled:
+                self._finish(job.id, 'cancelled')
+            except Exception as e:
+                print(f"Error in job {job.id}: {str(e)}")
+                self._finish(job.id, 'failed', error=str(e))
+            else:
+                self._finish(job.id, 'done', result=result)
+        finally:
+            self._running.pop(job.id, None)
+
+    def _expire(self):
+        with self._lock:
+            expired = 'SELECT id FROM jobs WHERE finished_at < ?'
+            cutoff = time.time() - JOB_RETENTION
+            self._db.execute(f'DELETE FROM job_events WHERE job_id IN ({expired})', (cutoff,))
+            self._db.execute('DELETE FROM jobs WHERE finished_at < ?', (cutoff,))
+            self._db.commit()
+
+    def get(self, job_id):
+        """
+        Return the job with this id, or None if unknown or expired.
+        """
+        row = self._fetch('SELECT client_id FROM jobs WHERE id = ?', (job_id,))
+        return Job(self, job_id, row[0]) if row is not None else None
+
+    def shutdown(self):
+        for job in list(self._running.values()):
+            job.cancel()
+        self._executor.shutdown(wait=True)
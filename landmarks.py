@@ -0,0 +1,145 @@
+import numpy as np
+
+from shortest_paths import dijkstra_rows
+
+
+# Landmarks picked per graph; each costs two full searches to build and
+# 8 bytes per node to keep
+LANDMARK_COUNT = 16
+# Landmarks used in one query, those giving the best bound between its ends
+ACTIVE_LANDMARKS = 4
+# Slightly shrink the bounds so float32 distances never make them overestimate
+BOUND_FACTOR = 0.999
+
+
+class LandmarkIndex:
+    """
+    ALT index: shortest distances to and from a few landmarks.
+
+    By the triangle inequality, d(v, t) >= d(L, t) - d(L, v) and
+    d(v, t) >= d(v, L) - d(t, L) for every landmark L, which gives A* a much
+    tighter lower bound than the great-circle distance on a road network, so
+    point-to-point searches settle far fewer nodes. The bounds stay valid on
+    any subgraph, whose distances can only be longer.
+    """
+
+    def __init__(self, landmarks, from_landmarks, to_landmarks, version=None):
+        """
+        Args:
+            landmarks: internal node indices of the landmarks
+            from_landmarks: float32 array (landmarks, nodes) of d(L, v)
+            to_landmarks: float32 array (landmarks, nodes) of d(v, L)
+            version: version of the graph the index was built on
+        """
+        self.landmarks = landmarks
+        self.from_landmarks = from_landmarks
+        self.to_landmarks = to_landmarks
+        self.version = version
+
+    @classmethod
+    def build(cls, graph, count=LANDMARK_COUNT):
+        """
+        Pick landmarks by farthest-point selection and search from and to each.
+
+        Every landmark is the node farthest from those already picked, which
+        spreads them around the edge of the graph where they bound best.
+
+        Args:
+            graph: CSRGraph
+            count: number of landmarks
+
+        Returns:
+            LandmarkIndex
+        """
+        landmarks = []
+        from_rows = []
+        # Start from the node farthest from the centre of the graph
+        nearest = np.hypot(graph.lat - graph.lat.mean(), graph.lon - graph.lon.mean())
+        for _ in range(min(count, graph.n_nodes)):
+            candidates = np.where(np.isfinite(nearest), nearest, -1.0)
+            landmark = int(np.argmax(candidates))
+            if candidates[landmark] <= 0:
+                break
+            distances = dijkstra_rows(graph, [landmark])[0][0]
+            landmarks.append(landmark)
+            from_rows.append(distances)
+            nearest = distances if len(landmarks) == 1 else np.minimum(nearest, distances)
+
+        landmarks = np.asarray(landmarks, dtype=np.int64)
+        to_rows, _ = dijkstra_rows(graph.reverse(), landmarks)
+        from_rows = np.asarray(from_rows).reshape(len(landmarks), graph.n_nodes)
+        print(f"Built {len(landmarks)} landmarks for {graph.n_nodes} nodes")
+        return cls(landmarks, from_rows.astype(np.float32), to_rows.astype(np.float32), graph.version)
+
+    @property
+    def nbytes(self):
+        return self.from_landmarks.nbytes + self.to_landmarks.nbytes
+
+    def _bounds(self, landmarks, nodes, target):
+        from_rows = self.from_landmarks[landmarks]
+        to_rows = self.to_landmarks[landmarks]
+        # inf - inf means neither end is reachable from the landmark, fmax skips those
+        with np.errstate(invalid='ignore'):
+            bounds = np.fmax.reduce(np.fmax(from_rows[:, [target]] - from_rows[:, nodes],
+                                            to_rows[:, nodes] - to_rows[:, [target]]), axis=0)
+        return np.fmax(bounds, 0.0) * BOUND_FACTOR
+
+    def bound(self, source, target):
+        """
+        Lower bound on the distance from source to target in meters.
+        """
+        return float(self._bounds(slice(None), [source], target)[0])
+
+    def heuristic(self, source, target):
+        """
+        Lower bounds on the distance from every node to target, for astar.
+
+        Only the ACTIVE_LANDMARKS landmarks bounding source to target best
+        are used, which keeps building the array cheap.
+
+        Returns:
+            float array over the internal node indices
+        """
+        with np.errstate(invalid='ignore'):
+            forward = self.from_landmarks[:, target] - self.from_landmarks[:, source]
+            backward = self.to_landmarks[:, source] - self.to_landmarks[:, target]
+            scores = np.nan_to_num(np.fmax(forward, backward), nan=-np.inf)
+        active = np.argsort(-scores)[:ACTIVE_LANDMARKS]
+        return self._bounds(active, slice(None), target)
+
+    def subset(self, keep):
+        """
+        The index restricted to some nodes, for a subgraph of its graph.
+
+        Args:
+            keep: internal node indices kept, in the order of the subgraph
+        """
+        return LandmarkIndex(self.landmarks, self.from_landmarks[:, keep], self.to_landmarks[:, keep])
+
+    def save(self, path):
+        """
+        Write the index to an .npz file next to the graph's tiles.
+        """
+        with open(path, 'wb') as f:
+            np.savez(f, landmarks=self.landmarks, from_landmarks=self.from_landmarks,
+                     to_landmarks=self.to_landmarks, version=np.array(self.version or ''))
+
+    @classmethod
+    def load(cls, path, graph=None):
+        """
+        Read an index written by save.
+
+        Args:
+            path: .npz file
+            graph: optional CSRGraph the index must have been built on
+
+        Returns:
+            LandmarkIndex, or None if it belongs to another version of the graph
+        """
+        with np.load(path) as data:
+            version = str(data['version']) or None
+            if graph is not None and (version != graph.version
+                                      or data['from_landmarks'].shape[1] != graph.n_nodes):
+                return None
+            return cls(data['landmarks'], data['from_landmarks'], data['to_landmarks'], version)
+
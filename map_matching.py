@@ -0,0 +1,184 @@
+import numpy as np
+
+import metrics
+from csr_graph import as_csr
+from shortest_paths import astar, bounded_dijkstra, reconstruct_path
+from spatial_index import get_edge_index
+
+
+# Standard deviation of GPS noise around the true road, in meters
+GPS_SIGMA = 10.0
+# Scale of the penalty for route length differing from straight-line length
+TRANSITION_BETA = 20.0
+
+
+def _route_cutoff(straight_distance, radius):
+    """
+    Longest connecting route worth searching between two consecutive points.
+    """
+    return 2 * straight_distance + 2 * radius + 100
+
+
+def match_polyline(graph, points, radius=50, max_candidates=5, sigma=GPS_SIGMA, beta=TRANSITION_BETA,
+                   candidates=None):
+    """
+    Match a decoded polyline onto the road network with an HMM/Viterbi matcher.
+
+    Each point gets up to max_candidates nearby edges as hidden states. The
+    emission probability falls off with the distance from the point to the
+    edge, and the transition probability with the difference between the
+    route distance and the straight-line distance of consecutive points.
+    Route distances come from short bounded Dijkstra searches, so the cost
+    grows linearly with the number of points.
+
+    Args:
+        graph: OSMnx graph object or CSRGraph
+        points: List of (lat, lon) tuples from decoded points
+        radius: candidate search radius in meters
+        max_candidates: maximum candidate edges per point
+        sigma: GPS noise standard deviation in meters
+        beta: transition penalty scale in meters
+        candidates: per-point candidate edges already found by match_polylines
+
+    Returns:
+        Dictionary with the matched 'nodes' list and the per-point
+        'deviations' array in meters
+    """
+    graph = as_csr(graph)
+    points = np.asarray(points, dtype=np.float64)
+    index = get_edge_index(graph)
+    if candidates is None:
+        candidates = index.candidates(points[:, 0], points[:, 1], radius, max_candidates)
+    xy = index.projection.to_xy(points[:, 0], points[:, 1])
+    straight = np.hypot(*np.diff(xy, axis=0).T)
+
+    edges, distances, fractions = candidates[0]
+    scores = -0.5 * (distances / sigma) ** 2
+    history = [scores]
+    backpointers = []
+    searches_per_step = []
+    searches = {}
+
+    for t in range(1, len(points)):
+        prev_edges, _, prev_fractions = candidates[t - 1]
+        edges, distances, fractions = candidates[t]
+        cutoff = _route_cutoff(straight[t - 1], radius)
+
+        # Reuse searches from the previous step when they reached far enough
+        step_searches = {}
+        route = np.full((len(prev_edges), len(edges)), np.inf)
+        for i, (prev_edge, prev_fraction) in enumerate(zip(prev_edges.tolist(), prev_fractions.tolist())):
+            prev_length = index.length[prev_edge]
+            for j, (edge, fraction) in enumerate(zip(edges.tolist(), fractions.tolist())):
+                if edge == prev_edge:
+                    # Moving backwards along the same edge is GPS jitter, not a U-turn
+                    route[i, j] = abs(fraction - prev_fraction) * prev_length
+
+            source = int(index.v[prev_edge])
+            search = step_searches.get(source) or searches.get(source)
+            if search is None or search[0] < cutoff:
+                distances_from, predecessors = bounded_dijkstra(graph, source, cutoff=cutoff)
+                search = (cutoff, distances_from, predecessors)
+            step_searches[source] = search
+            distances_from = search[1]
+
+            for j, (edge, fraction) in enumerate(zip(edges.tolist(), fractions.tolist())):
+                between = distances_from.get(int(index.u[edge]))
+                if between is not None:
+                    total = (1 - prev_fraction) * prev_length + between + fraction * index.length[edge]
+                    route[i, j] = min(route[i, j], total)
+
+        searches = step_searches
+        searches_per_step.append(step_searches)
+
+        transition = -np.abs(route - straight[t - 1]) / beta
+        combined = scores[:, None] + transition
+        best_previous = np.argmax(combined, axis=0)
+        emission = -0.5 * (distances / sigma) ** 2
+        new_scores = combined[best_previous, np.arange(len(edges))] + emission
+        if np.all(np.isneginf(new_scores)):
+            # No candidate is reachable from the previous point: start over
+            best_previous = np.full(len(edges), -1)
+            new_scores = emission
+        backpointers.append(best_previous)
+        scores = new_scores
+        history.append(scores)
+
+    # Backtrack the most likely sequence of candidates
+    states = [int(np.argmax(history[-1]))]
+    for t in range(len(points) - 1, 0, -1):
+        previous = int(backpointers[t - 1][states[-1]])
+        if previous < 0:
+            previous = int(np.argmax(history[t - 1]))
+        states.append(previous)
+    states.reverse()
+
+    deviations = np.array([candidates[t][1][state] for t, state in enumerate(states)])
+    nodes = _assemble_nodes(graph, index, candidates, states, searches_per_step)
+    return {'nodes': nodes, 'deviations': deviations}
+
+
+def match_polylines(graph, polylines, radius=50, max_candidates=5, progress=None, **kwargs):
+    """
+    Match several polylines, finding candidate edges for all points at once.
+
+    Args:
+        graph: OSMnx graph object or CSRGraph
+        polylines: List of point lists, one per segment
+        radius: candidate search radius in meters
+        max_candidates: maximum candidate edges per point
+        progress: optional callable(matched, total) run after each polyline
+
+    Returns:
+        List of match_polyline results in the same order
+    """
+    graph = as_csr(graph)
+    index = get_edge_index(graph)
+    all_points = np.concatenate([np.asarray(points, dtype=np.float64).reshape(-1, 2) for points in polylines])
+    with metrics.timed('snap'):
+        candidates = index.candidates(all_points[:, 0], all_points[:, 1], radius, max_candidates)
+
+    results = []
+    start = 0
+    for points in polylines:
+        end = start + len(points)
+        results.append(match_polyline(graph, points, radius, max_candidates,
+                                      candidates=candidates[start:end], **kwargs))
+        start = end
+        if progress is not None:
+            progress(len(results), len(polylines))
+    return results
+
+
+def _assemble_nodes(graph, index, candidates, states, searches_per_step):
+    """
+    Turn the matched sequence of candidate edges into a list of OSM node IDs.
+    """
+    first_edge = candidates[0][0][states[0]]
+    first_fraction = candidates[0][2][states[0]]
+    nodes = [int(index.u[first_edge]) if first_fraction < 0.5 else int(index.v[first_edge])]
+
+    for t in range(1, len(states)):
+        prev_edge = int(candidates[t - 1][0][states[t - 1]])
+        edge = int(candidates[t][0][states[t]])
+        if edge == prev_edge:
+            continue
+
+        source = int(index.v[prev_edge])
+        target = int(index.u[edge])
+        nodes.append(source)
+        predecessors = searches_per_step[t - 1][source][2]
+        if target in predecessors:
+            nodes.extend(reconstruct_path(predecessors, target)[1:])
+        else:
+            # Matching restarted here, bridge the gap without a cutoff
+            _, bridge = astar(graph, source, target)
+            nodes.extend(bridge[1:] if bridge is not None else [target])
+
+    last_edge = candidates[-1][0][states[-1]]
+    if candidates[-1][2][states[-1]] >= 0.5:
+        nodes.append(int(index.v[last_edge]))
+
+    # Drop consecutive repeats left where two steps share an end node
+    nodes = [node for i, node in enumerate(nodes) if i == 0 or node != nodes[i - 1]]
+    return graph.node_ids[nodes].tolist()
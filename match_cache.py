@@ -0,0 +1,286 @@
+import hashlib
+import json
+import math
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from graph_store import tiles_for_bbox
+
+
+# Tiles within this many meters of a segment make up its graph version;
+# matching never looks further away than the candidate radius
+MATCH_MARGIN = 200.0
+# Rows deleted at a time once a table grows past its limit
+EVICTION_BATCH = 256
+
+
+def polyline_hash(points):
+    """
+    Hash a decoded polyline, rounded to the ~0.1 m precision of Strava polylines.
+    """
+    points = np.round(np.asarray(points, dtype=np.float64).reshape(-1, 2), 6)
+    return hashlib.sha1(points.tobytes()).hexdigest()[:16]
+
+
+def region_version(graph, points, margin=MATCH_MARGIN):
+    """
+    Version of the road data a polyline can be matched against.
+
+    For graphs from GraphTileStore this only covers the tiles around the
+    polyline, so the same segment keeps its key in any viewport that
+    contains it. Other graphs fall back to the version of the whole graph.
+
+    Args:
+        graph: CSRGraph
+        points: List of (lat, lon) tuples
+        margin: padding around the polyline in meters
+
+    Returns:
+        Version string, or None if the graph is not versioned
+    """
+    if graph.tile_versions is None:
+        return graph.version
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    pad_lat = margin / 111320.0
+    pad_lon = margin / (111320.0 * max(math.cos(math.radians(float(points[:, 0].mean()))), 0.01))
+    tiles = tiles_for_bbox(points[:, 0].max() + pad_lat, points[:, 0].min() - pad_lat,
+                           points[:, 1].max() + pad_lon, points[:, 1].min() - pad_lon)
+    # A tile outside the loaded graph is unknown, not empty
+    versions = [graph.tile_versions.get(tile, '?') or '-' for tile in tiles]
+    if '?' in versions:
+        return None
+    key = ','.join(f"{row}_{col}:{version}" for (row, col), version in zip(tiles, versions))
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+class MatchCache:
+    """
+    Persistent cache of map-matched segments and connector distances.
+
+    Matches are keyed by Strava segment id and a hash of its polyline and
+    stored with the version of the road tiles around the segment, so an
+    entry matched against older tile data is a miss and gets replaced.
+    Connector distances are keyed by the OSM nodes they join and the
+    version of the graph they were searched on. Both tables are kept to a
+    maximum size by dropping the least recently used rows. SQLite in WAL
+    mode lets several server processes share one file.
+    """
+
+    def __init__(self, path, max_matches=50000, max_connectors=500000):
+        """
+        Args:
+            path: SQLite database file, created if missing
+            max_matches: maximum number of cached segment matches
+            max_connectors: maximum number of cached connector distances
+        """
+        self.path = path
+        self.max_matches = max_matches
+        self.max_connectors = max_connectors
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS matches (
+            segment_id TEXT NOT NULL,
+            polyline_hash TEXT NOT NULL,
+            graph_version TEXT NOT NULL,
+            nodes BLOB NOT NULL,
+            last_used REAL NOT NULL,
+            PRIMARY KEY (segment_id, polyline_hash))''')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS connectors (
+            graph_version TEXT NOT NULL,
+            source INTEGER NOT NULL,
+            target INTEGER NOT NULL,
+            distance REAL NOT NULL,
+            cutoff REAL NOT NULL,
+            last_used REAL NOT NULL,
+            PRIMARY KEY (graph_version, source, target))''')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS viewports (
+            north REAL NOT NULL,
+            south REAL NOT NULL,
+            east REAL NOT NULL,
+            west REAL NOT NULL,
+            graph_version TEXT,
+            segment_ids TEXT NOT NULL,
+            created REAL NOT NULL,
+            PRIMARY KEY (north, south, east, west))''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS matches_last_used ON matches (last_used)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS connectors_last_used ON connectors (last_used)')
+        self._db.commit()
+
+    def get_matches(self, keys):
+        """
+        Look up matched node paths.
+
+        Args:
+            keys: List of (segment_id, polyline_hash, graph_version) tuples
+
+        Returns:
+            List with a list of OSM node IDs for every hit and None for every miss
+        """
+        results = []
+        used = []
+        with self._lock:
+            for segment_id, points_hash, version in keys:
+                row = None
+                if version is not None:
+                    row = self._db.execute(
+                        'SELECT nodes FROM matches WHERE segment_id = ? AND polyline_hash = ? AND graph_version = ?',
+                        (str(segment_id), points_hash, version)).fetchone()
+                if row is None:
+                    results.append(None)
+                    continue
+                results.append(np.frombuffer(row[0], dtype=np.int64).tolist())
+                used.append((time.time(), str(segment_id), points_hash))
+            if used:
+                self._db.executemany('UPDATE matches SET last_used = ? WHERE segment_id = ? AND polyline_hash = ?', used)
+                self._db.commit()
+        hits = len(used)
+        self.hits += hits
+        self.misses += len(keys) - hits
+        return results
+
+    def put_matches(self, entries):
+        """
+        Store matched node paths, replacing older matches of the same polyline.
+
+        Args:
+            entries: List of (segment_id, polyline_hash, graph_version, nodes) tuples
+        """
+        rows = [(str(segment_id), points_hash, version, np.asarray(nodes, dtype=np.int64).tobytes(), time.time())
+                for segment_id, points_hash, version, nodes in entries if version is not None]
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO matches VALUES (?, ?, ?, ?, ?)', rows)
+            self._evict('matches', self.max_matches)
+            self._db.commit()
+
+    def get_connectors(self, version, sources, targets, cutoff):
+        """
+        Look up connector distances between OSM nodes.
+
+        An unreachable pair only counts if it was searched at least as far
+        as the current cutoff.
+
+        Args:
+            version: version of the graph the connectors are searched on
+            sources, targets: OSM node IDs
+            cutoff: search limit in meters of the current request
+
+        Returns:
+            Dictionary from (source, target) to distance for the pairs found
+        """
+        if version is None:
+            return {}
+        sources = [int(source) for source in sources]
+        targets = set(int(target) for target in targets)
+        found = {}
+        with self._lock:
+            for source in sources:
+                rows = self._db.execute(
+                    'SELECT target, distance, cutoff FROM connectors WHERE graph_version = ? AND source = ?',
+                    (version, source)).fetchall()
+                for target, distance, searched in rows:
+                    if target in targets and (distance != math.inf or searched >= cutoff):
+                        found[(source, target)] = distance
+            if found:
+                self._db.executemany(
+                    'UPDATE connectors SET last_used = ? WHERE graph_version = ? AND source = ? AND target = ?',
+                    [(time.time(), version, source, target) for source, target in found])
+                self._db.commit()
+        return found
+
+    def put_connectors(self, version, distances, cutoff):
+        """
+        Store connector distances.
+
+        Args:
+            version: version of the graph the connectors were searched on
+            distances: Dictionary from (source, target) OSM node IDs to distance
+            cutoff: search limit the distances were found with
+        """
+        if version is None:
+            return
+        now = time.time()
+        rows = [(version, int(source), int(target), float(distance), float(cutoff), now)
+                for (source, target), distance in distances.items()]
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO connectors VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self._evict('connectors', self.max_connectors)
+            self._db.commit()
+
+    def put_viewport(self, bounds, graph_version, segment_ids):
+        """
+        Record a viewport whose matches and connectors were precomputed.
+
+        Args:
+            bounds: (north, south, east, west) of the graph the viewport was planned on
+            graph_version: version of that graph
+            segment_ids: Strava ids of the segments in the viewport
+        """
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO viewports VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (*bounds, graph_version, json.dumps([str(i) for i in segment_ids]), time.time()))
+            self._db.commit()
+
+    def find_viewport(self, north, south, east, west):
+        """
+        Find the smallest precomputed viewport containing a bounding box.
+
+        Returns:
+            (north, south, east, west) of its graph, or None
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT north, south, east, west FROM viewports '
+                'WHERE north >= ? AND south <= ? AND east >= ? AND west <= ? '
+                'ORDER BY (north - south) * (east - west) LIMIT 1',
+                (north, south, east, west)).fetchone()
+        return tuple(row) if row is not None else None
+
+    def viewports_within(self, north, south, east, west):
+        """
+        List the precomputed viewports lying inside a bounding box.
+
+        Returns:
+            List of (north, south, east, west) of their graphs
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT north, south, east, west FROM viewports '
+                'WHERE north <= ? AND south >= ? AND east <= ? AND west >= ? ORDER BY created DESC',
+                (north, south, east, west)).fetchall()
+        return [tuple(row) for row in rows]
+
+    def _evict(self, table, limit):
+        count = self._db.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+        if count > limit:
+            excess = count - limit + EVICTION_BATCH
+            self._db.execute(f'DELETE FROM {table} WHERE rowid IN '
+                             f'(SELECT rowid FROM {table} ORDER BY last_used LIMIT ?)', (excess,))
+
+    def invalidate(self, segment_id=None, graph_version=None):
+        """
+        Drop cached entries; with no arguments, drop everything.
+
+        Args:
+            segment_id: drop the matches of this segment
+            graph_version: drop connectors searched on this graph version
+        """
+        with self._lock:
+            if segment_id is None and graph_version is None:
+                self._db.execute('DELETE FROM matches')
+                self._db.execute('DELETE FROM connectors')
+            if segment_id is not None:
+                self._db.execute('DELETE FROM matches WHERE segment_id = ?', (str(segment_id),))
+            if graph_version is not None:
+                self._db.execute('DELETE FROM connectors WHERE graph_version = ?', (graph_version,))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,177 @@
+import cProfile
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Every metric name is prefixed with this
+PREFIX = 'strava_router_'
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Sampled profiles of slow work are saved here when set
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0.1))
+PROFILE_SLOW_SECONDS = float(os.environ.get('PROFILE_SLOW_SECONDS', 5.0))
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_collectors = []
+_local = threading.local()
+# cProfile can only run one profiler at a time
+_profile_lock = threading.Lock()
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name, amount=1, **labels):
+    """
+    Add to a counter.
+
+    Args:
+        name: counter name without prefix, ending in _total
+        amount: value to add
+        **labels: Prometheus labels
+    """
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+    """
+    Record a value, usually a duration in seconds, in a histogram.
+    """
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * len(BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+
+@contextmanager
+def timed(stage):
+    """
+    Time a pipeline stage into the stage_seconds histogram.
+
+    Stages timed while a request is being served also end up in that
+    request's Server-Timing header. Stages may nest, e.g. snap inside match.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        observe('stage_seconds', duration, stage=stage)
+        timings = getattr(_local, 'timings', None)
+        if timings is not None:
+            timings.append((stage, duration))
+
+
+def start_request():
+    """
+    Start collecting stage timings for the request on this thread.
+    """
+    _local.timings = []
+
+
+def finish_request():
+    """
+    Stop collecting stage timings for this thread.
+
+    Returns:
+        Server-Timing header value, or None if no stage was timed
+    """
+    timings = getattr(_local, 'timings', None)
+    _local.timings = None
+    if not timings:
+        return None
+    return ', '.join(f"{stage};dur={duration * 1000:.1f}" for stage, duration in timings)
+
+
+def register_collector(collect):
+    """
+    Add a callable read on every scrape.
+
+    collect() returns (name, type, labels, value) tuples, which suits
+    counters kept elsewhere such as the hit counts of a cache.
+    """
+    with _lock:
+        _collectors.append(collect)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def render():
+    """
+    Render every metric in the Prometheus text exposition format.
+    """
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: list(value) for key, value in _histograms.items()}
+        collectors = list(_collectors)
+
+    samples = {}
+    for (name, labels), value in counters.items():
+        samples.setdefault((name, 'counter'), []).append((name, labels, value))
+    for collect in collectors:
+        for name, metric_type, labels, value in collect():
+            samples.setdefault((name, metric_type), []).append((name, tuple(sorted(labels.items())), value))
+    for (name, labels), histogram in histograms.items():
+        rows = samples.setdefault((name, 'histogram'), [])
+        for bound, count in zip(BUCKETS, histogram):
+            rows.append((name + '_bucket', labels + (('le', repr(bound)),), count))
+        rows.append((name + '_bucket', labels + (('le', '+Inf'),), histogram[-1]))
+        rows.append((name + '_sum', labels, histogram[-2]))
+        rows.append((name + '_count', labels, histogram[-1]))
+
+    lines = []
+    for (name, metric_type), rows in sorted(samples.items()):
+        lines.append(f"# TYPE {PREFIX}{name} {metric_type}")
+        for sample_name, labels, value in rows:
+            lines.append(f"{PREFIX}{sample_name}{_format_labels(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def profiled(name):
+    """
+    Profile a sample of calls and save the profile if the call was slow.
+
+    Does nothing unless PROFILE_DIR is set. Profiles are written as
+    <PROFILE_DIR>/<name>-<timestamp>-<seconds>s.prof for snakeviz or pstats.
+    """
+    if not PROFILE_DIR or random.random() >= PROFILE_SAMPLE_RATE or not _profile_lock.acquire(blocking=False):
+        yield
+        return
+
+    profile = cProfile.Profile()
+    start = time.perf_counter()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        _profile_lock.release()
+        duration = time.perf_counter() - start
+        if duration >= PROFILE_SLOW_SECONDS:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_DIR, f"{name}-{time.strftime('%Y%m%dT%H%M%S')}-{duration:.1f}s.prof")
+            profile.dump_stats(path)
+            print(f"Saved profile of slow {name} ({duration:.1f}s) to {path}")
@@ -0,0 +1,215 @@
+"""
+Precompute matched segments and connector distances for a region.
+
+Splits the region into overlapping viewports, plans each one's segments in
+a process pool with find_best_path_through_segments, and leaves the road
+tiles on disk and the matches, connector distances and viewport index in
+the match cache the web app reads. A later /best-path inside a known
+viewport then loads its graph and connectors from the caches. Each
+viewport's graph also gets a landmark index (landmarks.py) saved next to
+the tiles, which speeds up the app's point-to-point searches.
+
+    python precompute.py --bbox 40.70 -74.02 40.82 -73.93 --segments explore/*.json
+    python precompute.py --polygon manhattan.geojson --segments explore/*.json --workers 8
+
+Segment files are /segments/explore responses, lists of segments, or
+benchmark fixtures (see benchmarks/record_fixtures.py).
+"""
+import argparse
+import json
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import polyline
+
+from landmarks import LANDMARK_COUNT
+from match_cache import MATCH_MARGIN
+
+# Viewports are this many degrees on a side and overlap by half, so any
+# bounding box up to half this size lies inside one of them
+VIEWPORT_DEG = 0.02
+VIEWPORT_OVERLAP = 0.5
+
+_app = None
+
+
+def load_segments(paths):
+    """
+    Read segments from explore responses, segment lists or benchmark fixtures.
+
+    Returns:
+        List of segments with decoded 'points', without duplicate ids
+    """
+    segments = {}
+    for path in paths:
+        with open(path) as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            data = data.get('explore', data).get('segments', [])
+        for segment in data:
+            points = segment['points']
+            if isinstance(points, str):
+                points = polyline.decode(points)
+            segments[segment['id']] = dict(segment, points=points)
+    return list(segments.values())
+
+
+def load_region(bbox=None, polygon_path=None):
+    """
+    Returns:
+        Tuple of ((lat_min, lon_min, lat_max, lon_max), shapely geometry or None)
+    """
+    if polygon_path is None:
+        return tuple(bbox), None
+    from shapely.geometry import shape
+    from shapely.ops import unary_union
+
+    with open(polygon_path) as f:
+        geojson = json.load(f)
+    features = geojson.get('features', [geojson])
+    region = unary_union([shape(feature.get('geometry', feature)) for feature in features])
+    lon_min, lat_min, lon_max, lat_max = region.bounds
+    return (lat_min, lon_min, lat_max, lon_max), region
+
+
+def make_viewports(bounds, region=None, size=VIEWPORT_DEG, overlap=VIEWPORT_OVERLAP):
+    """
+    Cover a region with overlapping square viewports.
+
+    Returns:
+        List of (lat_min, lon_min, lat_max, lon_max) tuples
+    """
+    lat_min, lon_min, lat_max, lon_max = bounds
+    step = size * (1 - overlap)
+    rows = max(1, math.ceil((lat_max - lat_min - size) / step) + 1)
+    cols = max(1, math.ceil((lon_max - lon_min - size) / step) + 1)
+    viewports = [(lat_min + row * step, lon_min + col * step,
+                  lat_min + row * step + size, lon_min + col * step + size)
+                 for row in range(rows) for col in range(cols)]
+    if region is not None:
+        from shapely.geometry import box
+
+        viewports = [viewport for viewport in viewports
+                     if region.intersects(box(viewport[1], viewport[0], viewport[3], viewport[2]))]
+    return viewports
+
+
+def segments_in(viewport, segments):
+    """
+    The segments /update-segments would return for a viewport.
+    """
+    lat_min, lon_min, lat_max, lon_max = viewport
+    found = []
+    for segment in segments:
+        lats = [point[0] for point in segment['points']]
+        lons = [point[1] for point in segment['points']]
+        if min(lats) <= lat_max and max(lats) >= lat_min and min(lons) <= lon_max and max(lons) >= lon_min:
+            found.append(segment)
+    return found
+
+
+def _init_worker(tile_dir, cache_path, offline, landmarks):
+    global _app
+    # Every worker opens the same tile directory and SQLite cache
+    os.environ['GRAPH_TILE_DIR'] = tile_dir
+    os.environ['MATCH_CACHE_PATH'] = cache_path
+    os.environ['GRAPH_TILE_OFFLINE'] = '1' if offline else '0'
+    os.environ['GRAPH_LANDMARKS'] = str(landmarks)
+    os.environ.pop('GRAPH_SERVER_ADDRESS', None)
+    import app
+    _app = app
+
+
+def precompute_viewport(viewport, segments):
+    """
+    Plan one viewport so its matches and connectors land in the caches.
+
+    Returns:
+        Dictionary with the graph 'bounds', 'version', 'segment_ids',
+        'total_distance' and 'seconds'
+    """
+    started = time.perf_counter()
+    north, south, east, west = _app.route_bounds(segments)
+    # Cover every tile the match cache keys a segment by
+    pad_lat = MATCH_MARGIN / 111320.0
+    pad_lon = pad_lat / max(math.cos(math.radians((north + south) / 2)), 0.01)
+    bounds = (north + pad_lat, south - pad_lat, east + pad_lon, west - pad_lon)
+    # Straight from the tile store, a viewport indexed earlier must not widen it
+    graph = _app.graph_tiles.get_csr(*bounds, 'walk')
+    if graph.n_nodes == 0:
+        return None
+    result = _app.find_best_path_through_segments(graph, segments)
+    return {
+        'bounds': bounds,
+        'version': graph.version,
+        'segment_ids': [segment['id'] for segment in segments],
+        'total_distance': result['total_distance'],
+        'seconds': time.perf_counter() - started,
+    }
+
+
+def precompute(viewports, segments, tile_dir, cache_path, workers=None, offline=False,
+               landmarks=LANDMARK_COUNT):
+    """
+    Precompute every viewport with a process pool and index the results.
+
+    Returns:
+        Number of viewports precomputed
+    """
+    from match_cache import MatchCache
+
+    jobs = [(viewport, segments_in(viewport, segments)) for viewport in viewports]
+    jobs = [(viewport, found) for viewport, found in jobs if found]
+    print(f"Precomputing {len(jobs)} viewports with segments out of {len(viewports)}")
+
+    cache = MatchCache(cache_path)
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(tile_dir, cache_path, offline, landmarks)) as pool:
+        futures = {pool.submit(precompute_viewport, viewport, found): viewport for viewport, found in jobs}
+        for future in as_completed(futures):
+            viewport = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Failed viewport {viewport}: {e}")
+                continue
+            if result is None:
+                print(f"No road network in viewport {viewport}")
+                continue
+            cache.put_viewport(result['bounds'], result['version'], result['segment_ids'])
+            done += 1
+            print(f"[{done}/{len(jobs)}] {len(result['segment_ids'])} segments, "
+                  f"{result['total_distance']:.0f} m route in {result['seconds']:.1f}s")
+    cache.close()
+    return done
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute matched segments and connectors for a region')
+    region = parser.add_mutually_exclusive_group(required=True)
+    region.add_argument('--bbox', nargs=4, type=float, metavar=('LAT_MIN', 'LON_MIN', 'LAT_MAX', 'LON_MAX'))
+    region.add_argument('--polygon', help='GeoJSON file with the region polygon')
+    parser.add_argument('--segments', nargs='+', required=True, help='segment fixture files')
+    parser.add_argument('--viewport-deg', type=float, default=VIEWPORT_DEG)
+    parser.add_argument('--workers', type=int, help='processes, default one per core')
+    parser.add_argument('--tile-dir', default=os.environ.get('GRAPH_TILE_DIR', 'graph_tiles'))
+    parser.add_argument('--cache', default=os.environ.get('MATCH_CACHE_PATH', 'match_cache.sqlite'))
+    parser.add_argument('--offline', action='store_true', help='only use tiles already on disk')
+    parser.add_argument('--landmarks', type=int, default=LANDMARK_COUNT,
+                        help='landmarks per viewport graph, 0 to skip the index')
+    args = parser.parse_args()
+
+    bounds, polygon = load_region(args.bbox, args.polygon)
+    segments = load_segments(args.segments)
+    viewports = make_viewports(bounds, polygon, args.viewport_deg)
+    started = time.perf_counter()
+    done = precompute(viewports, segments, args.tile_dir, args.cache, args.workers, args.offline,
+                      args.landmarks)
+    print(f"Precomputed {done} viewports in {time.perf_counter() - started:.1f}s into {args.cache}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+# Start and end points are rounded to this many decimals, about 10 cm
+START_DECIMALS = 6
+
+
+def route_key(segments, start=None, loop=False, end=None):
+    """
+    Canonical hash of a route request: its segments in order, their points
+    and the routing options.
+
+    Segment order is kept because the result's optimal_order indexes into it.
+
+    Returns:
+        Hex digest
+    """
+    digest = hashlib.sha1()
+    for segment in segments:
+        points = np.asarray(segment['points'], dtype=np.float64).reshape(-1, 2)
+        digest.update(f"{segment.get('id')}:{len(points)}:".encode())
+        digest.update(points.tobytes())
+    start, end = (None if point is None else [round(float(point['lat']), START_DECIMALS),
+                                              round(float(point['lng']), START_DECIMALS)]
+                  for point in (start, end))
+    digest.update(json.dumps({'start': start, 'end': end, 'loop': bool(loop)}, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class RouteCache:
+    """
+    Memoized route results with request coalescing.
+
+    A result is kept under its route_key until it is older than the TTL or
+    evicted, least recently used first, to stay under max_bytes. Results
+    are stored as JSON in SQLite, so server processes opening the same file
+    serve each other's routes, including /routes/<route_id>. Identical
+    requests that arrive at one process while the route is still being
+    planned wait for that one computation instead of each starting their own.
+    """
+
+    def __init__(self, path=':memory:', max_bytes=64 * 1024 * 1024, ttl=3600, retry_errors=()):
+        """
+        Args:
+            path: SQLite database file shared by the server processes
+            max_bytes: evict results above this total JSON size
+            ttl: seconds a result is served before it is planned again
+            retry_errors: exception types of the planning request itself,
+                such as a cancelled job; requests waiting on it plan again
+                instead of failing with it
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.retry_errors = tuple(retry_errors)
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS routes (
+            key TEXT PRIMARY KEY,
+            result TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created REAL NOT NULL,
+            last_used REAL NOT NULL)''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS routes_last_used ON routes (last_used)')
+        self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM routes').fetchone()[0]
+
+    @property
+    def nbytes(self):
+        with self._lock:
+            return self._db.execute('SELECT COALESCE(SUM(size), 0) FROM routes').fetchone()[0]
+
+    def _lookup(self, key, now):
+        row = self._db.execute('SELECT result, created FROM routes WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        if now - row[1] > self.ttl:
+            self._db.execute('DELETE FROM routes WHERE key = ?', (key,))
+            self._db.commit()
+            return None
+        self._db.execute('UPDATE routes SET last_used = ? WHERE key = ?', (now, key))
+        self._db.commit()
+        return json.loads(row[0])
+
+    def get_or_compute(self, key, compute):
+        """
+        Return the cached result for key, computing it once if needed.
+
+        Args:
+            key: route_key of the request
+            compute: callable returning the JSON-serializable result
+
+        Returns:
+            Tuple of (result, how) where how is 'hit', 'coalesced' or 'miss'
+        """
+        while True:
+            with self._lock:
+                result = self._lookup(key, time.time())
+                if result is not None:
+                    self.hits += 1
+                    return result, 'hit'
+                future = self._pending.get(key)
+                owner = future is None
+                if owner:
+                    future = self._pending[key] = Future()
+                    self.misses += 1
+                else:
+                    self.coalesced += 1
+
+            if not owner:
+                try:
+                    return future.result(), 'coalesced'
+                except self.retry_errors:
+                    # The planning request was cancelled, plan it for this one instead
+                    continue
+
+            try:
+                result = compute()
+            except BaseException as e:
+                with self._lock:
+                    del self._pending[key]
+                future.set_exception(e)
+                raise
+            self.put(key, result)
+            with self._lock:
+                del self._pending[key]
+            future.set_result(result)
+            return result, 'miss'
+
+    def get(self, key):
+        """
+        Return the cached result for key, or None.
+        """
+        with self._lock:
+            return self._lookup(key, time.time())
+
+    def put(self, key, result):
+        """
+        Store a result, evicting the least recently used ones over max_bytes.
+        """
+        encoded = json.dumps(result, separators=(',', ':'))
+        if len(encoded) > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?, ?)',
+                             (key, encoded, len(encoded), now, now))
+            total = self._db.execute('SELECT SUM(size) FROM routes').fetchone()[0]
+            if total > self.max_bytes:
+                # Oldest first until the rest fits
+                rows = self._db.execute('SELECT key, size FROM routes ORDER BY last_used').fetchall()
+                evicted = []
+                for old_key, size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    evicted.append((old_key,))
+                    total -= size
+                self._db.executemany('DELETE FROM routes WHERE key = ?', evicted)
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM routes')
+            self._db.commit()
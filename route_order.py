@@ -0,0 +1,260 @@
+import time
+
+import numpy as np
+
+
+# Largest number of segments solved exactly with Held-Karp
+EXACT_LIMIT = 12
+# Default time budget for local search, in seconds
+TIME_BUDGET = 0.5
+# Number of perturbed restarts tried by local search within the time budget
+PERTURBATION_RESTARTS = 10
+# Stand-in for unreachable connectors so the solvers can still compare tours
+UNREACHABLE = 1e9
+
+
+def _tour_matrix(distances, start_costs, end_costs, loop):
+    """
+    Turn the ordering problem into a closed tour over a cost matrix.
+
+    Unless the route is a loop with no fixed start, a depot node 0 is added
+    whose outgoing costs reach each segment from the start point and whose
+    incoming costs lead from each segment to the end point. Missing start or
+    end points cost nothing, which leaves that end of the route free.
+
+    Returns:
+        Tuple of (cost matrix, whether node 0 is a depot)
+    """
+    distances = np.asarray(distances, dtype=np.float64)
+    n = len(distances)
+    if loop and start_costs is None and end_costs is None:
+        return distances.copy(), False
+
+    matrix = np.zeros((n + 1, n + 1))
+    matrix[1:, 1:] = distances
+    if start_costs is not None:
+        matrix[0, 1:] = start_costs
+    if end_costs is not None:
+        matrix[1:, 0] = end_costs
+    return matrix, True
+
+
+def _tour_cost(matrix, tour):
+    return float(matrix[tour, np.roll(tour, -1)].sum())
+
+
+def nearest_neighbour(matrix, first=0):
+    """
+    Build a tour by always moving to the closest unvisited node.
+    """
+    tour = [first]
+    unvisited = set(range(len(matrix))) - {first}
+    while unvisited:
+        current = tour[-1]
+        nearest = min(unvisited, key=lambda x: matrix[current, x])
+        tour.append(nearest)
+        unvisited.remove(nearest)
+    return tour
+
+
+def held_karp(matrix):
+    """
+    Exact shortest tour by dynamic programming over subsets.
+
+    Node 0 is the fixed first node of the tour. Runs in O(2^n n^2) time,
+    so it is only used for small n.
+    """
+    n = len(matrix)
+    if n <= 2:
+        return list(range(n))
+
+    m = n - 1
+    full = (1 << m) - 1
+    cost = np.full((1 << m, m), np.inf)
+    parent = np.full((1 << m, m), -1, dtype=np.int64)
+    inner = matrix[1:, 1:]
+    for j in range(m):
+        cost[1 << j, j] = matrix[0, j + 1]
+
+    for mask in range(1, 1 << m):
+        if mask & (mask - 1) == 0:
+            continue
+        for j in range(m):
+            bit = 1 << j
+            if not mask & bit:
+                continue
+            previous = cost[mask ^ bit] + inner[:, j]
+            k = int(np.argmin(previous))
+            cost[mask, j] = previous[k]
+            parent[mask, j] = k
+
+    closing = cost[full] + matrix[1:, 0]
+    last = int(np.argmin(closing))
+    tour = []
+    mask = full
+    while last >= 0:
+        tour.append(last + 1)
+        mask, last = mask ^ (1 << last), parent[mask, last]
+    return [0] + tour[::-1]
+
+
+def local_search(matrix, tour, deadline):
+    """
+    Improve a tour with 2-opt and Or-opt moves until no move helps or time runs out.
+
+    Node 0 stays first. The costs can be asymmetric, so 2-opt reverses the
+    affected stretch and compares its full cost rather than just the two
+    replaced edges.
+    """
+    tour = list(tour)
+    n = len(tour)
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+
+        # Or-opt: move a chain of 1-3 nodes elsewhere without reversing it
+        for length in (1, 2, 3):
+            for i in range(1, n - length + 1):
+                chain = tour[i:i + length]
+                before, after = tour[i - 1], tour[(i + length) % n]
+                removed = matrix[before, chain[0]] + matrix[chain[-1], after] - matrix[before, after]
+                rest = tour[:i] + tour[i + length:]
+                for j in range(len(rest)):
+                    a, b = rest[j], rest[(j + 1) % len(rest)]
+                    added = matrix[a, chain[0]] + matrix[chain[-1], b] - matrix[a, b]
+                    if added < removed - 1e-9:
+                        tour = rest[:j + 1] + chain + rest[j + 1:]
+                        improved = True
+                        break
+                if improved or time.perf_counter() >= deadline:
+                    break
+            if improved:
+                break
+        if improved:
+            continue
+
+        # 2-opt: reverse the stretch between positions i and j
+        current = _tour_cost(matrix, tour)
+        for i in range(1, n - 1):
+            for j in range(i + 1, n):
+                candidate = tour[:i] + tour[i:j + 1][::-1] + tour[j + 1:]
+                candidate_cost = _tour_cost(matrix, candidate)
+                if candidate_cost < current - 1e-9:
+                    tour, current = candidate, candidate_cost
+                    improved = True
+                    break
+            if improved or time.perf_counter() >= deadline:
+                break
+    return tour
+
+
+def _double_bridge(tour, rng):
+    """
+    Cut the tour into four stretches and reconnect them in a new order.
+    """
+    a, b, c = sorted(rng.choice(np.arange(1, len(tour)), 3, replace=False))
+    return tour[:a] + tour[c:] + tour[b:c] + tour[a:b]
+
+
+def cheapest_insertion(matrix, tour):
+    """
+    Complete a partial tour by inserting each missing node where it adds least.
+
+    Node 0 stays first, so a depot keeps its place.
+    """
+    tour = list(tour) or [0]
+    for node in range(len(matrix)):
+        if node in tour:
+            continue
+        costs = [matrix[tour[k], node] + matrix[node, tour[(k + 1) % len(tour)]]
+                 - matrix[tour[k], tour[(k + 1) % len(tour)]] for k in range(len(tour))]
+        tour.insert(int(np.argmin(costs)) + 1, node)
+    return tour
+
+
+def _local_search_solver(matrix, deadline, restarts=PERTURBATION_RESTARTS, initial=None):
+    # Start from the best nearest-neighbour tour over every first node, or
+    # from a tour already known to be good if that is cheaper
+    starts = [nearest_neighbour(matrix, first) for first in range(len(matrix))]
+    if initial is not None:
+        starts.append(initial)
+    starts = [tour[tour.index(0):] + tour[:tour.index(0)] for tour in starts]
+    best = local_search(matrix, min(starts, key=lambda tour: _tour_cost(matrix, tour)), deadline)
+    best_cost = _tour_cost(matrix, best)
+
+    # Escape local minima with random double-bridge kicks while time allows
+    rng = np.random.default_rng(0)
+    for _ in range(restarts if len(best) > 4 else 0):
+        if time.perf_counter() >= deadline:
+            break
+        candidate = local_search(matrix, _double_bridge(best, rng), deadline)
+        candidate_cost = _tour_cost(matrix, candidate)
+        if candidate_cost < best_cost - 1e-9:
+            best, best_cost = candidate, candidate_cost
+    return best
+
+
+def _held_karp_solver(matrix, deadline):
+    return held_karp(matrix)
+
+
+def _nearest_neighbour_solver(matrix, deadline):
+    return nearest_neighbour(matrix)
+
+
+SOLVERS = {
+    'held-karp': _held_karp_solver,
+    'local-search': _local_search_solver,
+    'nearest-neighbour': _nearest_neighbour_solver,
+}
+
+
+def solve_order(distances, start_costs=None, end_costs=None, loop=False, method='auto',
+                time_budget=TIME_BUDGET, initial_order=None):
+    """
+    Find the order to run segments in that minimizes the connecting distance.
+
+    Args:
+        distances: n x n matrix of connector lengths from the end of segment i
+            to the start of segment j
+        start_costs: optional distances from a fixed start point to each segment
+        end_costs: optional distances from each segment to a fixed end point;
+            pass the distances back to the start point for a loop
+        loop: return to the first segment when there is no fixed start or end
+        method: 'auto', or one of the SOLVERS names
+        time_budget: seconds allowed for local search
+        initial_order: optional order of some of the segments, e.g. the
+            previous solution before segments were added; with the rest
+            inserted cheaply it is one of the tours local search may start from
+
+    Returns:
+        Dictionary with the 'order' of segment indices, its 'cost', the
+        'baseline_cost' of the original nearest-neighbour order from segment 0,
+        the relative 'gap' between them and the 'method' used
+    """
+    n = len(distances)
+    if n == 0:
+        return {'order': [], 'cost': 0.0, 'baseline_cost': 0.0, 'gap': 0.0, 'method': method}
+
+    true_matrix, has_depot = _tour_matrix(distances, start_costs, end_costs, loop)
+    matrix = np.where(np.isfinite(true_matrix), true_matrix, UNREACHABLE)
+    if method == 'auto':
+        method = 'held-karp' if n <= EXACT_LIMIT else 'local-search'
+
+    deadline = time.perf_counter() + time_budget
+    offset = 1 if has_depot else 0
+    if initial_order is not None and method == 'local-search':
+        initial = ([0] if has_depot else []) + [i + offset for i in initial_order if 0 <= i < n]
+        tour = _local_search_solver(matrix, deadline, initial=cheapest_insertion(matrix, initial))
+    else:
+        tour = SOLVERS[method](matrix, deadline)
+
+    # Baseline is the original heuristic: nearest neighbour from segment 0
+    baseline = nearest_neighbour(np.asarray(distances, dtype=np.float64))
+    baseline_tour = ([0] if has_depot else []) + [i + offset for i in baseline]
+
+    order = [int(i) - offset for i in tour[offset:]]
+    cost = _tour_cost(true_matrix, tour)
+    baseline_cost = _tour_cost(true_matrix, baseline_tour)
+    gap = (baseline_cost - cost) / baseline_cost if baseline_cost and np.isfinite(baseline_cost) else 0.0
+    return {'order': order, 'cost': cost, 'baseline_cost': baseline_cost, 'gap': gap, 'method': method}
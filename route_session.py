@@ -0,0 +1,277 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import match_cache
+import metrics
+import spatial_index
+import strava_api
+from connectors import IncrementalConnectors
+from graph_store import tiles_for_bbox
+
+
+class RouteSession:
+    """
+    One client's route, kept on the server between updates.
+
+    The session holds the road graph, the matched segments and their
+    connector distances. Each update is diffed against what the session
+    already has, so a new segment costs one match and two graph searches,
+    a removed segment costs nothing, and the order is re-solved starting
+    from the previous one.
+    """
+
+    def __init__(self, session_id=None):
+        self.id = session_id or uuid.uuid4().hex
+        self.graph = None
+        self.connectors = None
+        self.segments = {}
+        self.paths = {}
+        self.order = []
+        self.revision = 0
+        self.last_used = time.time()
+        self.lock = threading.Lock()
+        self._hashes = {}
+
+    def state(self):
+        """
+        The session without its graph, as JSON for RouteSessionStore.
+
+        Keys stay in (key, value) pairs, as segment ids may be numbers.
+        """
+        return json.dumps({
+            'segments': list(self.segments.items()),
+            'paths': list(self.paths.items()),
+            'hashes': list(self._hashes.items()),
+            'order': self.order,
+        })
+
+    @classmethod
+    def from_state(cls, session_id, state, revision):
+        """
+        Rebuild a session saved by another server process.
+
+        Matches carry over; the graph and connectors are rebuilt from them
+        on the next update, without matching the segments again.
+        """
+        session = cls(session_id)
+        state = json.loads(state)
+        session.segments = {key: segment for key, segment in state['segments']}
+        session.paths = {key: path for key, path in state['paths']}
+        session._hashes = {key: points_hash for key, points_hash in state['hashes']}
+        session.order = [key for key in state['order'] if key in session.paths]
+        session.revision = revision
+        return session
+
+    def covers(self, north, south, east, west):
+        """
+        Whether the session graph has every road tile of a bounding box.
+        """
+        if self.graph is None or self.graph.tile_versions is None:
+            return False
+        return all(tile in self.graph.tile_versions for tile in tiles_for_bbox(north, south, east, west))
+
+    def _reset(self, graph):
+        # Matched paths carry over, they are OSM node ids in any graph
+        print(f"Route session {self.id} moved to a graph with {graph.n_nodes} nodes")
+        self.graph = graph
+        self.connectors = IncrementalConnectors(graph)
+        previous = list(self.order) + [key for key in self.paths if key not in self.order]
+        self.order = previous
+        for key in previous:
+            try:
+                self.connectors.add(key, self.paths[key])
+            except KeyError:
+                # The new graph lacks a node of this match, match it again
+                self._forget(key)
+
+    def _forget(self, key):
+        if key in self.connectors.keys:
+            self.connectors.remove(key)
+        for table in (self.segments, self.paths, self._hashes):
+            table.pop(key, None)
+
+    def update(self, graph, segments, start=None, loop=False, cache=None, progress=None, end=None):
+        """
+        Bring the session to a new set of segments and re-plan the route.
+
+        Args:
+            graph: CSRGraph covering the segments and start point; the
+                session keeps its own graph if this is the same object
+            segments: List of segment objects with 'points' and ideally 'id'
+            start: optional {'lat': value, 'lng': value} the route must start from
+            loop: finish back at the start (or at the first segment without a start)
+                when there is no end point
+            cache: optional MatchCache for newly added segments
+            progress: optional callable(stage, **details) run after each step
+            end: optional {'lat': value, 'lng': value} the route must finish at
+
+        Returns:
+            Dictionary with the 'segments', matched 'paths' and 'connectors'
+            in the same order, and the 'plan' from strava_api.plan_path_order
+        """
+        if progress is None:
+            progress = lambda stage, **details: None
+        self.last_used = time.time()
+        if graph is not self.graph:
+            self._reset(graph)
+
+        wanted = {}
+        for segment in segments:
+            key = segment.get('id') or match_cache.polyline_hash(segment['points'])
+            wanted[key] = segment
+
+        removed = [key for key in self.segments if key not in wanted]
+        for key in removed:
+            self._forget(key)
+
+        added = []
+        for key, segment in wanted.items():
+            points_hash = match_cache.polyline_hash(segment['points'])
+            if self._hashes.get(key) != points_hash:
+                added.append((key, segment, points_hash))
+            else:
+                self.segments[key] = segment
+
+        if added:
+            with metrics.timed('match'):
+                paths = strava_api.find_segment_path_nodes(
+                    self.graph, [segment['points'] for _, segment, _ in added],
+                    progress=lambda matched, total: progress('segment_matched', matched=matched, total=total),
+                    segment_ids=[segment.get('id', '') for _, segment, _ in added],
+                    cache=cache)
+            with metrics.timed('matrix'):
+                for (key, segment, points_hash), path in zip(added, paths):
+                    self.connectors.add(key, path)
+                    self.segments[key] = segment
+                    self.paths[key] = path
+                    self._hashes[key] = points_hash
+        print(f"Route session {self.id}: {len(added)} segments added, {len(removed)} removed, "
+              f"{len(self.segments)} in route")
+        progress('connectors_built', added=len(added), removed=len(removed))
+
+        # Snap the start and end points to the road network, a loop without an
+        # end point also ends at the start
+        start_node, end_node = spatial_index.snap_endpoints(self.graph, start, end, loop)
+        self.connectors.set_endpoints(start_node, end_node)
+
+        keys = self.connectors.keys
+        position = {key: i for i, key in enumerate(keys)}
+        paths = [self.paths[key] for key in keys]
+        with metrics.timed('order'):
+            plan = strava_api.plan_path_order(self.graph, paths, self.connectors, loop=loop,
+                                              initial_order=[position[key] for key in self.order if key in position])
+        self.order = [keys[i] for i in plan['order']]
+        progress('order_solved', method=plan['method'], total_distance=plan['cost'])
+
+        return {
+            'segments': [self.segments[key] for key in keys],
+            'paths': paths,
+            'connectors': self.connectors,
+            'plan': plan,
+        }
+
+
+class RouteSessionStore:
+    """
+    Live route sessions, dropped after a period of inactivity.
+
+    Sessions are saved to SQLite after every update, so server processes
+    opening the same file share them. Each process keeps the sessions it
+    used recently in memory with their graph and connectors, and only
+    rebuilds one when another process has updated it since.
+    """
+
+    def __init__(self, path=':memory:', ttl=1800, max_sessions=100):
+        """
+        Args:
+            path: SQLite database file shared by the server processes
+            ttl: seconds a session is kept after its last update
+            max_sessions: least recently used sessions are dropped above this count
+        """
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS route_sessions (
+            id TEXT PRIMARY KEY,
+            revision INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            last_used REAL NOT NULL)''')
+        self._db.commit()
+
+    def create(self):
+        session = RouteSession()
+        with self._lock:
+            self._expire()
+            self._db.execute('INSERT INTO route_sessions VALUES (?, ?, ?, ?)',
+                             (session.id, session.revision, session.state(), session.last_used))
+            count = self._db.execute('SELECT COUNT(*) FROM route_sessions').fetchone()[0]
+            if count > self.max_sessions:
+                self._db.execute('DELETE FROM route_sessions WHERE id IN '
+                                 '(SELECT id FROM route_sessions ORDER BY last_used LIMIT ?)',
+                                 (count - self.max_sessions,))
+            self._db.commit()
+            self._keep(session)
+        return session
+
+    def get(self, session_id):
+        """
+        Return a live session, or None if unknown or expired.
+        """
+        with self._lock:
+            self._expire()
+            row = self._db.execute('SELECT revision, state FROM route_sessions WHERE id = ?',
+                                   (session_id,)).fetchone()
+            if row is None:
+                self._sessions.pop(session_id, None)
+                return None
+            self._db.execute('UPDATE route_sessions SET last_used = ? WHERE id = ?', (time.time(), session_id))
+            self._db.commit()
+            session = self._sessions.get(session_id)
+            if session is None or session.revision != row[0]:
+                # Updated by another process since this one last had it
+                session = RouteSession.from_state(session_id, row[1], row[0])
+            self._keep(session)
+            return session
+
+    def save(self, session):
+        """
+        Store a session after an update so every process sees it.
+        """
+        with self._lock:
+            # Counted in the database, so two processes saving the same
+            # session never end up at the same revision
+            self._db.execute('UPDATE route_sessions SET revision = revision + 1, state = ?, last_used = ? '
+                             'WHERE id = ?', (session.state(), time.time(), session.id))
+            row = self._db.execute('SELECT revision FROM route_sessions WHERE id = ?', (session.id,)).fetchone()
+            self._db.commit()
+            if row is not None:
+                session.revision = row[0]
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            deleted = self._db.execute('DELETE FROM route_sessions WHERE id = ?', (session_id,)).rowcount
+            self._db.commit()
+            return deleted > 0
+
+    def _keep(self, session):
+        self._sessions[session.id] = session
+        self._sessions.move_to_end(session.id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def _expire(self):
+        now = time.time()
+        self._db.execute('DELETE FROM route_sessions WHERE last_used < ?', (now - self.ttl,))
+        self._db.commit()
+        for session_id, session in list(self._sessions.items()):
+            if now - session.last_used > self.ttl:
+                del self._sessions[session_id]
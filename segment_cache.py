@@ -0,0 +1,246 @@
+import json
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import polyline
+
+
+# Size of a segment cache tile in degrees (~1 km north-south)
+SEGMENT_TILE_DEG = 0.01
+# Viewports over this many tiles are cached as a whole instead of per tile
+MAX_VIEWPORT_TILES = 64
+# Strava's segment explore returns at most this many segments, so a full
+# response may have left segments out
+EXPLORE_LIMIT = 10
+# Viewports cached as a whole are keyed on their bounds rounded to this
+# many decimals, about 10 cm
+VIEWPORT_DECIMALS = 6
+
+
+def _tile_span(lat_min, lon_min, lat_max, lon_max):
+    rows = range(math.floor(lat_min / SEGMENT_TILE_DEG), math.floor(lat_max / SEGMENT_TILE_DEG) + 1)
+    cols = range(math.floor(lon_min / SEGMENT_TILE_DEG), math.floor(lon_max / SEGMENT_TILE_DEG) + 1)
+    return rows, cols
+
+
+def _span_bounds(rows, cols):
+    return (rows[0] * SEGMENT_TILE_DEG, cols[0] * SEGMENT_TILE_DEG,
+            (rows[-1] + 1) * SEGMENT_TILE_DEG, (cols[-1] + 1) * SEGMENT_TILE_DEG)
+
+
+def _intersects(bounds, lat_min, lon_min, lat_max, lon_max):
+    south, west, north, east = bounds
+    return south <= lat_max and north >= lat_min and west <= lon_max and east >= lon_min
+
+
+class SegmentCache:
+    """
+    Cache of Strava segment-explore results keyed on quantized bounding boxes.
+
+    The map is cut into SEGMENT_TILE_DEG tiles. A viewport is answered from
+    the cache when every tile it touches was fetched within the TTL;
+    otherwise the tiles that are missing are fetched together in one call
+    and remembered. Tiles are only remembered when that call returned fewer
+    than EXPLORE_LIMIT segments, since a capped result is not everything in
+    them. When it was capped, and for viewports over MAX_VIEWPORT_TILES,
+    the viewport itself is fetched and cached as a whole, so it gets the
+    same segments a direct query would. Segments are
+    stored once by id with their polyline already decoded, so panning never
+    decodes the same segment twice. Fetched segments are also written to
+    SQLite, so server processes opening the same file can look up by id a
+    segment any of them sent.
+    """
+
+    def __init__(self, ttl=3600, max_tiles=1024, path=':memory:', max_segments=100000):
+        """
+        Args:
+            ttl: seconds before a tile is fetched again
+            max_tiles: least recently used tiles and viewports are dropped
+                above this count
+            path: SQLite database file shared by the server processes
+            max_segments: oldest shared segments are dropped above this count
+        """
+        self.ttl = ttl
+        self.max_tiles = max_tiles
+        self.max_segments = max_segments
+        self.hits = 0
+        self.misses = 0
+        self._tiles = OrderedDict()
+        self._segments = {}
+        self._bounds = {}
+        self._references = {}
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS segments (
+            id TEXT PRIMARY KEY,
+            segment TEXT NOT NULL,
+            fetched REAL NOT NULL)''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS segments_fetched ON segments (fetched)')
+        self._db.commit()
+
+    def _share(self, segments, now):
+        # Raw Strava segments, each process decodes the ones it looks up
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO segments VALUES (?, ?, ?)',
+                                 [(str(segment['id']), json.dumps(segment), now) for segment in segments])
+            self._db.execute('DELETE FROM segments WHERE fetched < ?', (now - self.ttl,))
+            count = self._db.execute('SELECT COUNT(*) FROM segments').fetchone()[0]
+            if count > self.max_segments:
+                self._db.execute('DELETE FROM segments WHERE id IN '
+                                 '(SELECT id FROM segments ORDER BY fetched LIMIT ?)', (count - self.max_segments,))
+            self._db.commit()
+
+    def _fresh_tile(self, tile, now):
+        entry = self._tiles.get(tile)
+        if entry is None or now - entry[0] > self.ttl:
+            return None
+        self._tiles.move_to_end(tile)
+        return entry[1]
+
+    def _add_segment(self, segment):
+        segment_id = segment['id']
+        if segment_id not in self._segments or self._segments[segment_id].get('points_encoded') != segment['points']:
+            points = polyline.decode(segment['points'])
+            stored = dict(segment, points=points, points_encoded=segment['points'])
+            lats = [point[0] for point in points] or [segment['start_latlng'][0]]
+            lons = [point[1] for point in points] or [segment['start_latlng'][1]]
+            self._segments[segment_id] = stored
+            self._bounds[segment_id] = (min(lats), min(lons), max(lats), max(lons))
+        return segment_id
+
+    def _store_tile(self, tile, segment_ids, now):
+        # Tiles are (row, col), whole viewports ('viewport', *bounds).
+        # The new references come first, so a segment only the old entry
+        # held is not forgotten on the way
+        self._retain(segment_ids)
+        old = self._tiles.pop(tile, None)
+        if old is not None:
+            self._release(old[1])
+        self._tiles[tile] = (now, segment_ids)
+
+        while len(self._tiles) > self.max_tiles:
+            _, (_, evicted) = self._tiles.popitem(last=False)
+            self._release(evicted)
+
+    def _retain(self, segment_ids):
+        for segment_id in segment_ids:
+            self._references[segment_id] = self._references.get(segment_id, 0) + 1
+
+    def _release(self, segment_ids):
+        # Forget segments no cached tile refers to any more
+        for segment_id in segment_ids:
+            self._references[segment_id] -= 1
+            if self._references[segment_id] == 0:
+                del self._references[segment_id]
+                del self._segments[segment_id]
+                del self._bounds[segment_id]
+
+    def get_segment(self, segment_id):
+        """
+        Return a cached segment with decoded points, or None.
+        """
+        with self._lock:
+            segment = self._segments.get(segment_id)
+            if segment is not None:
+                return dict(segment)
+            # Fetched by another process
+            row = self._db.execute('SELECT segment FROM segments WHERE id = ? AND fetched >= ?',
+                                   (str(segment_id), time.time() - self.ttl)).fetchone()
+        if row is None:
+            return None
+        segment = json.loads(row[0])
+        return dict(segment, points=polyline.decode(segment['points']), points_encoded=segment['points'])
+
+    def get_segments(self, lat_min, lon_min, lat_max, lon_max, fetch):
+        """
+        Get the segments in a viewport, fetching only tiles not in the cache.
+
+        Args:
+            lat_min, lon_min, lat_max, lon_max: viewport bounds
+            fetch: callable taking (lat_min, lon_min, lat_max, lon_max) and
+                returning the raw Strava segment list for those bounds
+
+        Returns:
+            List of segment dictionaries with decoded 'points'
+        """
+        rows, cols = _tile_span(lat_min, lon_min, lat_max, lon_max)
+        if not rows or not cols:
+            return []
+        now = time.time()
+        bounds = tuple(round(float(value), VIEWPORT_DECIMALS) for value in (lat_min, lon_min, lat_max, lon_max))
+        with self._lock:
+            segment_ids = self._fresh_tile(('viewport',) + bounds, now)
+        if segment_ids is not None:
+            self.hits += 1
+        elif len(rows) * len(cols) <= MAX_VIEWPORT_TILES:
+            segment_ids = self._get_tiles(rows, cols, now, fetch)
+        if segment_ids is None:
+            segment_ids = self._fetch_viewport(bounds, now, fetch)
+
+        with self._lock:
+            return [{key: value for key, value in self._segments[segment_id].items() if key != 'points_encoded'}
+                    for segment_id in dict.fromkeys(segment_ids)
+                    if segment_id in self._segments
+                    and _intersects(self._bounds[segment_id], lat_min, lon_min, lat_max, lon_max)]
+
+    def _get_tiles(self, rows, cols, now, fetch):
+        """
+        Segment ids of the tiles of a viewport, fetching the missing ones.
+
+        Returns:
+            List of segment ids, or None if the fetch hit EXPLORE_LIMIT and
+            the viewport has to be fetched itself
+        """
+        tiles = [(row, col) for row in rows for col in cols]
+        with self._lock:
+            cached = {tile: self._fresh_tile(tile, now) for tile in tiles}
+        missing = [tile for tile, segment_ids in cached.items() if segment_ids is None]
+        if not missing:
+            self.hits += 1
+            return [segment_id for tile in tiles for segment_id in cached[tile]]
+
+        # One request covering every missing tile, snapped to the grid
+        missing_rows = range(min(row for row, _ in missing), max(row for row, _ in missing) + 1)
+        missing_cols = range(min(col for _, col in missing), max(col for _, col in missing) + 1)
+        bounds = _span_bounds(missing_rows, missing_cols)
+        print(f"Segment cache miss for {len(missing)} tiles, fetching {bounds}")
+        fetched = fetch(*bounds)
+        self._share(fetched, now)
+        if len(fetched) >= EXPLORE_LIMIT:
+            return None
+        self.misses += 1
+
+        with self._lock:
+            fetched_ids = [self._add_segment(segment) for segment in fetched]
+            # Held until every tile is stored, so replacing one tile cannot
+            # forget a segment the next one needs; the hold is then released,
+            # dropping segments that fall in none of the tiles
+            self._retain(fetched_ids)
+            for row in missing_rows:
+                for col in missing_cols:
+                    tile_bounds = _span_bounds(range(row, row + 1), range(col, col + 1))
+                    segment_ids = [segment_id for segment_id in fetched_ids
+                                   if _intersects(self._bounds[segment_id], *tile_bounds)]
+                    self._store_tile((row, col), segment_ids, now)
+                    if (row, col) in cached:
+                        cached[(row, col)] = segment_ids
+            self._release(fetched_ids)
+        return [segment_id for tile in tiles for segment_id in cached[tile]]
+
+    def _fetch_viewport(self, bounds, now, fetch):
+        """
+        Fetch a viewport and cache it as a whole.
+        """
+        self.misses += 1
+        print(f"Segment cache miss for viewport, fetching {bounds}")
+        fetched = fetch(*bounds)
+        self._share(fetched, now)
+        with self._lock:
+            segment_ids = [self._add_segment(segment) for segment in fetched]
+            self._store_tile(('viewport',) + bounds, segment_ids, now)
+        return segment_ids
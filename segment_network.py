@@ -0,0 +1,128 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from csr_graph import CSRGraph
+from shortest_paths import astar
+from spatial_index import LocalProjection, get_node_index, great_circle
+
+
+# Points of different segments closer than this many meters are merged into
+# one junction, so segments that cross or run into each other connect
+JUNCTION_TOLERANCE = 10.0
+
+
+class SegmentNetwork:
+    """
+    Routable network made of the segments themselves, for /find-path.
+
+    Every segment point is a node, consecutive points are joined in both
+    directions, and points within JUNCTION_TOLERANCE of a point of another
+    segment are snapped onto it as one junction node. Points of the same
+    segment are never merged, so a densely sampled segment keeps all of
+    its points. The network is a
+    CSRGraph with integer node ids, so it shares the snapping and A* code
+    of the road network.
+    """
+
+    def __init__(self, segments, tolerance=JUNCTION_TOLERANCE):
+        """
+        Args:
+            segments: list of segments with decoded 'points'
+            tolerance: junction merge distance in meters
+        """
+        point_lists = [np.asarray(segment['points'], dtype=np.float64).reshape(-1, 2) for segment in segments]
+        points = np.concatenate(point_lists + [np.empty((0, 2))])
+        lengths = np.array([len(p) for p in point_lists], dtype=np.int64)
+        segment_of = np.repeat(np.arange(len(point_lists)), lengths)
+
+        # Snap points onto a representative point of another segment
+        representative = np.arange(len(points))
+        absorbs = np.zeros(len(points), dtype=bool)
+        if len(points):
+            projection = LocalProjection(float(points[:, 0].mean()), float(points[:, 1].mean()))
+            pairs = cKDTree(projection.to_xy(points[:, 0], points[:, 1])).query_pairs(tolerance, output_type='ndarray')
+            pairs = pairs[segment_of[pairs[:, 0]] != segment_of[pairs[:, 1]]]
+            pairs = np.sort(pairs, axis=1)
+            # Pairs in order of their first point, which becomes the representative
+            # unless it was snapped itself; a snapped point never gathers others,
+            # so merges cannot chain along a line of close points
+            for kept, snapped in pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))].tolist():
+                if representative[kept] == kept and representative[snapped] == snapped:
+                    representative[snapped] = kept
+                    absorbs[kept] = True
+        nodes, labels = np.unique(representative, return_inverse=True)
+        n_nodes = len(nodes)
+
+        # Consecutive points of the same segment, weighted by their haversine distance
+        first = np.arange(len(points) - 1)
+        first = first[~np.isin(first, np.cumsum(lengths) - 1)]
+        u, v = labels[first], labels[first + 1]
+        distances = great_circle(points[first, 0], points[first, 1], points[first + 1, 0], points[first + 1, 1])
+        # Both points snapped onto the same junction
+        keep = u != v
+        u, v, distances = u[keep], v[keep], distances[keep]
+        self.graph = CSRGraph.from_edges(np.arange(n_nodes), points[nodes, 0], points[nodes, 1],
+                                         np.concatenate((u, v)), np.concatenate((v, u)),
+                                         np.concatenate((distances, distances)))
+        self.n_segments = len(segments)
+        self.n_junctions = int(absorbs.sum())
+
+    def shortest_path(self, start, end):
+        """
+        Shortest path along the segments between the points nearest two locations.
+
+        Args:
+            start, end: (lat, lon) pairs
+
+        Returns:
+            Tuple of (list of [lat, lon] points, distance in meters), or
+            (None, inf) if the segments do not connect them
+        """
+        nodes, _ = get_node_index(self.graph).nearest_index([start[0], end[0]], [start[1], end[1]])
+        distance, path = astar(self.graph, int(nodes[0]), int(nodes[1]))
+        if path is None:
+            return None, float('inf')
+        return self.graph.coordinates(path), distance
+
+
+def network_key(segments):
+    """
+    Digest of the segments' ids and points, the same for the same request.
+    """
+    digest = hashlib.sha1()
+    for segment in segments:
+        digest.update(str(segment.get('id')).encode())
+        digest.update(np.asarray(segment['points'], dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+class SegmentNetworkCache:
+    """
+    LRU cache of segment networks, so repeated /find-path queries over the
+    same viewport only snap and search.
+    """
+
+    def __init__(self, max_networks=32):
+        self.max_networks = max_networks
+        self._networks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, segments):
+        """
+        Get the network of a list of segments, building it on first use.
+        """
+        key = network_key(segments)
+        with self._lock:
+            if key in self._networks:
+                self._networks.move_to_end(key)
+                return self._networks[key]
+        network = SegmentNetwork(segments)
+        with self._lock:
+            self._networks[key] = network
+            while len(self._networks) > self.max_networks:
+                self._networks.popitem(last=False)
+        return network
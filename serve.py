@@ -0,0 +1,105 @@
+"""
+Production entry point: one graph loader process and gunicorn workers.
+
+The loader owns the road-network tile store and keeps each stitched graph
+in shared memory once; the workers attach to it, so routing scales across
+cores without every worker holding its own copy of the graphs.
+
+    python serve.py --bind 0.0.0.0:8000
+
+Route jobs, route sessions, the segments sent to clients and planned
+routes are kept in one SQLite file every worker opens, so any worker can
+answer any request and no sticky sessions are needed. It runs one worker
+per core by default.
+"""
+import argparse
+import multiprocessing
+import os
+import secrets
+import signal
+import sys
+import tempfile
+import time
+
+from graph_server import SharedGraphServer
+from graph_store import GraphTileStore
+
+# Seconds to wait for the loader to start listening
+LOADER_STARTUP_TIMEOUT = 30
+
+
+def run_loader(address, authkey):
+    # Unlink the shared graphs when the server stops the loader
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    store = GraphTileStore(
+        os.environ.get('GRAPH_TILE_DIR', 'graph_tiles'),
+        offline=os.environ.get('GRAPH_TILE_OFFLINE', '0') == '1',
+        max_bytes=int(float(os.environ['GRAPH_TILE_MAX_MB']) * 1024 * 1024) if os.environ.get('GRAPH_TILE_MAX_MB') else None,
+        landmarks=int(os.environ.get('GRAPH_LANDMARKS', 0)),
+    )
+    SharedGraphServer(store, max_graphs=int(os.environ.get('GRAPH_SERVER_GRAPHS', 8))).serve(address, authkey)
+
+
+def start_loader():
+    """
+    Start the graph loader and point the workers at it and at the shared
+    state through the environment.
+
+    Returns:
+        The loader Process
+    """
+    directory = tempfile.mkdtemp(prefix='strava-router-')
+    address = os.path.join(directory, 'graphs.sock')
+    authkey = secrets.token_hex(16)
+    loader = multiprocessing.Process(target=run_loader, args=(address, authkey.encode()),
+                                     name='graph-loader', daemon=True)
+    loader.start()
+
+    deadline = time.time() + LOADER_STARTUP_TIMEOUT
+    while not os.path.exists(address):
+        if not loader.is_alive() or time.time() > deadline:
+            raise RuntimeError('Graph loader failed to start')
+        time.sleep(0.05)
+
+    os.environ['GRAPH_SERVER_ADDRESS'] = address
+    os.environ['GRAPH_SERVER_AUTHKEY'] = authkey
+    # State the workers share, next to the socket unless set already
+    os.environ.setdefault('SERVER_STATE_PATH', os.path.join(directory, 'state.sqlite'))
+    return loader
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the app under gunicorn with a shared graph store')
+    parser.add_argument('--bind', default=os.environ.get('BIND', '127.0.0.1:8000'))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count())),
+                        help='worker processes, one per core by default')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('WEB_THREADS', 16)),
+                        help='request threads per worker; progress streams hold one each')
+    parser.add_argument('--timeout', type=int, default=120, help='seconds before a stuck worker is restarted')
+    args = parser.parse_args()
+
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SystemExit('serve.py needs gunicorn: pip install gunicorn')
+
+    class Application(BaseApplication):
+        def load_config(self):
+            for key, value in {'bind': args.bind, 'workers': args.workers, 'threads': args.threads,
+                               'worker_class': 'gthread', 'timeout': args.timeout}.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # Imported in each worker, after the loader address is in the environment
+            from app import app
+            return app
+
+    loader = start_loader()
+    try:
+        Application().run()
+    finally:
+        loader.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+import heapq
+
+import numpy as np
+from scipy.sparse.csgraph import dijkstra as csgraph_dijkstra
+
+from spatial_index import great_circle
+
+
+# scipy marks nodes without a predecessor with this value
+NO_PREDECESSOR = -9999
+
+
+def bounded_dijkstra(graph, source, targets=None, cutoff=None):
+    """
+    Run Dijkstra from a single source until every target is settled.
+
+    Suited to the many short searches of map matching, where a heap in
+    Python that stops early beats a full-graph search in C.
+
+    Args:
+        graph: CSRGraph
+        source: internal node index to start from
+        targets: internal node indices to reach; the search stops once all are settled
+        cutoff: maximum path length in meters to explore
+
+    Returns:
+        Tuple of (distances, predecessors) dictionaries for settled nodes
+    """
+    indptr, indices, lengths = graph.indptr, graph.indices, graph.lengths
+    remaining = set(targets) if targets is not None else None
+    if remaining is not None:
+        remaining.discard(source)
+
+    distances = {}
+    predecessors = {source: None}
+    seen = {source: 0.0}
+    heap = [(0.0, source)]
+    while heap:
+        distance, node = heapq.heappop(heap)
+        if node in distances:
+            continue
+        distances[node] = distance
+        if remaining is not None:
+            remaining.discard(node)
+            if not remaining:
+                break
+
+        start, end = indptr[node], indptr[node + 1]
+        for neighbour, length in zip(indices[start:end].tolist(), lengths[start:end].tolist()):
+            if neighbour in distances:
+                continue
+            candidate = distance + length
+            if cutoff is not None and candidate > cutoff:
+                continue
+            if candidate < seen.get(neighbour, float('inf')):
+                seen[neighbour] = candidate
+                predecessors[neighbour] = node
+                heapq.heappush(heap, (candidate, neighbour))
+
+    return distances, predecessors
+
+
+def astar(graph, source, target, heuristic=None):
+    """
+    Point-to-point shortest path with A*.
+
+    Args:
+        graph: CSRGraph
+        source, target: internal node indices
+        heuristic: optional array of lower bounds on the distance from every
+            node to the target; defaults to the graph's landmark bounds if it
+            has a LandmarkIndex, else the great-circle distance
+
+    Returns:
+        Tuple of (distance, list of internal node indices), or (inf, None)
+        if the target is unreachable
+    """
+    landmarks = graph.cache.get('landmarks')
+    if heuristic is None and landmarks is not None:
+        heuristic = landmarks.heuristic(source, target)
+    elif heuristic is None:
+        # Slightly shrunk so float32 edge lengths never make it overestimate
+        heuristic = 0.999 * great_circle(graph.lat, graph.lon, graph.lat[target], graph.lon[target])
+
+    indptr, indices, lengths = graph.indptr, graph.indices, graph.lengths
+    distances = {source: 0.0}
+    predecessors = {source: None}
+    closed = set()
+    heap = [(float(heuristic[source]), source)]
+    while heap:
+        _, node = heapq.heappop(heap)
+        if node == target:
+            return distances[node], reconstruct_path(predecessors, target)
+        if node in closed:
+            continue
+        closed.add(node)
+
+        distance = distances[node]
+        start, end = indptr[node], indptr[node + 1]
+        for neighbour, length in zip(indices[start:end].tolist(), lengths[start:end].tolist()):
+            candidate = distance + length
+            if candidate < distances.get(neighbour, float('inf')):
+                distances[neighbour] = candidate
+                predecessors[neighbour] = node
+                heapq.heappush(heap, (candidate + float(heuristic[neighbour]), neighbour))
+
+    return float('inf'), None
+
+
+def dijkstra_rows(graph, sources, limit=np.inf):
+    """
+    Full single-source searches from several sources at once, in C.
+
+    Args:
+        graph: CSRGraph
+        sources: internal node indices
+        limit: stop exploring past this distance in meters
+
+    Returns:
+        Tuple of (distances, predecessors) arrays of shape (len(sources), n_nodes)
+    """
+    if len(sources) == 0:
+        return np.empty((0, graph.n_nodes)), np.empty((0, graph.n_nodes), dtype=np.int32)
+    distances, predecessors = csgraph_dijkstra(graph.matrix, indices=np.asarray(sources),
+                                               limit=limit, return_predecessors=True)
+    return distances, predecessors
+
+
+def reconstruct_path(predecessors, target):
+    """
+    Walk a predecessor tree back from a target to its source.
+
+    Args:
+        predecessors: dictionary from bounded_dijkstra, or a predecessor row
+            from dijkstra_rows
+        target: internal node index
+
+    Returns:
+        List of internal node indices from source to target
+    """
+    path = [target]
+    if isinstance(predecessors, dict):
+        while predecessors[path[-1]] is not None:
+            path.append(predecessors[path[-1]])
+    else:
+        while predecessors[path[-1]] != NO_PREDECESSOR:
+            path.append(int(predecessors[path[-1]]))
+    path.reverse()
+    return path
@@ -0,0 +1,157 @@
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from spatial_index import LocalProjection
+
+
+# Simplified lines stay within this many screen pixels of the full line
+PIXEL_TOLERANCE = 1.0
+# Ground size of one 256-pixel web-mercator tile pixel at zoom 0 on the equator
+METERS_PER_PIXEL_ZOOM0 = 156543.03392
+MAX_ZOOM = 22
+
+
+def zoom_tolerance(zoom, lat):
+    """
+    Simplification tolerance in meters for a map zoom level at a latitude.
+    """
+    zoom = min(max(float(zoom), 0.0), MAX_ZOOM)
+    return PIXEL_TOLERANCE * METERS_PER_PIXEL_ZOOM0 * math.cos(math.radians(lat)) / 2 ** zoom
+
+
+def dp_importance(points):
+    """
+    Douglas-Peucker importance of every point of a line.
+
+    A point's importance is the largest tolerance at which Douglas-Peucker
+    still keeps it, so the simplification at any tolerance is the points
+    whose importance exceeds it. This is computed once per line and reused
+    for every zoom level.
+
+    Args:
+        points: list or array of [lat, lon] points
+
+    Returns:
+        float array, inf for the two end points
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    importance = np.zeros(len(points))
+    if len(points) == 0:
+        return importance
+    importance[[0, -1]] = np.inf
+    xy = LocalProjection(float(points[:, 0].mean()), float(points[:, 1].mean())).to_xy(points[:, 0], points[:, 1])
+
+    # Split every open range at once per round, instead of one range per step
+    split = np.zeros(len(points), dtype=bool)
+    split[[0, -1]] = True
+    while True:
+        inside = np.flatnonzero(~split)
+        if len(inside) == 0:
+            break
+        anchors = np.flatnonzero(split)
+        ranges = np.searchsorted(anchors, inside) - 1
+        first, last = anchors[ranges], anchors[ranges + 1]
+
+        # Distance of every point to the chord joining the ends of its range
+        chord = xy[last] - xy[first]
+        offsets = xy[inside] - xy[first]
+        length = np.einsum('ij,ij->i', chord, chord)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = np.clip(np.einsum('ij,ij->i', offsets, chord) / length, 0.0, 1.0)
+        fraction[length == 0] = 0.0
+        distances = np.hypot(*(offsets - fraction[:, None] * chord).T)
+
+        # The farthest point of each range, the first one on ties
+        starts = np.flatnonzero(np.r_[True, ranges[1:] != ranges[:-1]])
+        farthest = np.maximum.reduceat(distances, starts)
+        candidates = np.flatnonzero(distances == farthest[np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(inside)]))])
+        _, chosen = np.unique(ranges[candidates], return_index=True)
+        chosen = candidates[chosen]
+
+        # Never above the split that made this range, so smaller tolerances
+        # always keep a superset of the points
+        parent = np.minimum(importance[first[chosen]], importance[last[chosen]])
+        importance[inside[chosen]] = np.minimum(distances[chosen], parent)
+        split[inside[chosen]] = True
+    return importance
+
+
+def simplify_line(points, tolerance, importance=None, keep=None):
+    """
+    Douglas-Peucker simplification of a line.
+
+    Args:
+        points: list of [lat, lon] points
+        tolerance: meters the simplified line may deviate
+        importance: dp_importance of the points, computed if not given
+        keep: optional indices kept regardless of the tolerance
+
+    Returns:
+        Tuple of (simplified points, indices of the kept points)
+    """
+    if importance is None:
+        importance = dp_importance(points)
+    mask = importance > tolerance
+    if keep is not None:
+        mask[np.asarray(keep, dtype=np.int64)] = True
+    kept = np.flatnonzero(mask)
+    return [points[i] for i in kept.tolist()], kept
+
+
+class ImportanceCache:
+    """
+    LRU cache of dp_importance arrays keyed by segment or route.
+    """
+
+    def __init__(self, max_lines=4096):
+        self.max_lines = max_lines
+        self._lines = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, points):
+        """
+        Return the importance of a line, computing it on first use.
+
+        Args:
+            key: hashable id that changes whenever the points do
+            points: the line's [lat, lon] points
+        """
+        with self._lock:
+            if key in self._lines:
+                self._lines.move_to_end(key)
+                return self._lines[key]
+        importance = dp_importance(points)
+        with self._lock:
+            self._lines[key] = importance
+            while len(self._lines) > self.max_lines:
+                self._lines.popitem(last=False)
+        return importance
+
+
+def simplify_route(route, tolerance, importance=None):
+    """
+    Simplify a route's path, remapping its segments' start and end indices.
+
+    The points where segments start and end are always kept, so every
+    segment can still be sliced out of the simplified path.
+
+    Args:
+        route: route dictionary with 'path' and 'segments'
+        tolerance: meters the simplified path may deviate
+        importance: optional cached dp_importance of the path
+
+    Returns:
+        Copy of the route with the simplified path
+    """
+    segments = route.get('segments') or []
+    keep = [index for segment in segments for index in (segment['start_idx'], segment['end_idx'])
+            if 0 <= index < len(route['path'])]
+    path, kept = simplify_line(route['path'], tolerance, importance, keep)
+    # Kept points are sorted, so an old index maps to its rank among them
+    segments = [dict(segment, start_idx=int(np.searchsorted(kept, segment['start_idx'])),
+                     end_idx=int(np.searchsorted(kept, segment['end_idx'])))
+                for segment in segments]
+    return dict(route, path=path, segments=segments, tolerance=tolerance)
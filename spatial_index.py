@@ -0,0 +1,270 @@
+import math
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from csr_graph import as_csr
+
+
+EARTH_RADIUS = 6371008.8  # meters
+
+# Spacing of the sample points used to index edges
+EDGE_SAMPLE_SPACING = 20.0  # meters
+
+
+def great_circle(lat1, lon1, lat2, lon2):
+    """
+    Vectorized haversine distance in meters.
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(a, dtype=np.float64)) for a in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class LocalProjection:
+    """
+    Equirectangular projection to meters around a reference point.
+
+    Accurate to well under a meter over the few kilometers a route covers,
+    and cheap enough to apply to whole arrays at once.
+    """
+
+    def __init__(self, lat0, lon0):
+        self.lat0 = lat0
+        self.lon0 = lon0
+        self.kx = math.radians(1) * EARTH_RADIUS * math.cos(math.radians(lat0))
+        self.ky = math.radians(1) * EARTH_RADIUS
+
+    def to_xy(self, lats, lons):
+        """
+        Project latitude/longitude arrays to (x, y) meters.
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        return np.column_stack(((lons - self.lon0) * self.kx, (lats - self.lat0) * self.ky))
+
+
+class NodeIndex:
+    """
+    KD-tree over the nodes of a graph for batched snapping.
+
+    Nodes are projected to meters once, so nearest-node and radius queries
+    for any number of points run in a single vectorized call.
+    """
+
+    def __init__(self, graph):
+        csr = as_csr(graph)
+        self.node_ids = csr.node_ids
+        if csr.n_nodes:
+            self.projection = LocalProjection(float(csr.lat.mean()), float(csr.lon.mean()))
+        else:
+            self.projection = LocalProjection(0.0, 0.0)
+        self.xy = self.projection.to_xy(csr.lat, csr.lon)
+        self.tree = cKDTree(self.xy) if len(self.xy) else None
+
+    def nearest(self, lats, lons):
+        """
+        Snap every point to its nearest node.
+
+        Args:
+            lats, lons: arrays of point coordinates
+
+        Returns:
+            Tuple of (node IDs, distances in meters) arrays
+        """
+        positions, distances = self.nearest_index(lats, lons)
+        return self.node_ids[positions], distances
+
+    def nearest_index(self, lats, lons):
+        """
+        Like nearest, but returns internal CSR node indices.
+        """
+        if self.tree is None:
+            raise ValueError("Graph has no nodes to snap to")
+        distances, positions = self.tree.query(self.projection.to_xy(lats, lons))
+        return positions, distances
+
+    def within(self, lats, lons, radius):
+        """
+        Find every node within a radius of each point.
+
+        Points with no node inside the radius get their nearest node, so each
+        point always has at least one candidate.
+
+        Args:
+            lats, lons: arrays of point coordinates
+            radius: search radius in meters
+
+        Returns:
+            List with, for each point, a tuple of (node IDs, distances) arrays
+            sorted by distance
+        """
+        if self.tree is None:
+            raise ValueError("Graph has no nodes to snap to")
+        xy = self.projection.to_xy(lats, lons)
+        neighbours = self.tree.query_ball_point(xy, radius)
+        _, nearest = self.tree.query(xy)
+
+        result = []
+        for i, positions in enumerate(neighbours):
+            positions = np.asarray(positions if positions else [nearest[i]], dtype=np.int64)
+            distances = np.hypot(*(self.xy[positions] - xy[i]).T)
+            order = np.argsort(distances)
+            result.append((self.node_ids[positions[order]], distances[order]))
+        return result
+
+
+class EdgeIndex:
+    """
+    Spatial index over the edges of a graph.
+
+    Every edge is sampled every EDGE_SAMPLE_SPACING meters along the straight
+    line between its end nodes and the samples are stored in a KD-tree. A
+    radius query on the samples gives the candidate edges for a point, which
+    are then measured exactly by projecting the point onto each edge.
+    """
+
+    def __init__(self, graph):
+        csr = as_csr(graph)
+        nodes = get_node_index(csr)
+        self.projection = nodes.projection
+
+        # Edge end points are internal CSR node indices
+        self.u = np.repeat(np.arange(csr.n_nodes), np.diff(csr.indptr))
+        self.v = csr.indices.astype(np.int64)
+        self.length = csr.lengths.astype(np.float64)
+        self.start = nodes.xy[self.u].reshape(-1, 2)
+        self.end = nodes.xy[self.v].reshape(-1, 2)
+
+        # Sample each edge so long edges can still be found from their middle
+        straight = np.hypot(*(self.end - self.start).T)
+        counts = np.ceil(straight / EDGE_SAMPLE_SPACING).astype(np.int64) + 1
+        self.sample_edge = np.repeat(np.arange(len(counts)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        fractions = offsets / np.maximum(np.repeat(counts, counts) - 1, 1)
+        samples = (self.start[self.sample_edge]
+                   + (self.end - self.start)[self.sample_edge] * fractions[:, None])
+        self.tree = cKDTree(samples) if len(samples) else None
+
+    def project(self, xy, edges):
+        """
+        Project points onto edges.
+
+        Args:
+            xy: (x, y) points in meters, one per edge or a single point
+            edges: array of edge indices
+
+        Returns:
+            Tuple of (distances in meters, fractions along each edge)
+        """
+        start = self.start[edges]
+        direction = self.end[edges] - start
+        squared = np.einsum('ij,ij->i', direction, direction)
+        fractions = np.einsum('ij,ij->i', xy - start, direction) / np.where(squared > 0, squared, 1)
+        fractions = np.clip(fractions, 0.0, 1.0)
+        closest = start + direction * fractions[:, None]
+        return np.hypot(*(closest - xy).T), fractions
+
+    def candidates(self, lats, lons, radius, max_candidates=5):
+        """
+        Find the candidate edges near each point.
+
+        Points with no edge within the radius get their single nearest edge,
+        so every point has at least one candidate. Ties at the cut-off are
+        all kept, so every edge leaving a nearby junction is a candidate.
+
+        Args:
+            lats, lons: arrays of point coordinates
+            radius: search radius in meters
+            max_candidates: maximum number of edges kept per point
+
+        Returns:
+            List with, for each point, a tuple of (edges, distances, fractions)
+            arrays sorted by distance
+        """
+        if self.tree is None:
+            raise ValueError("Graph has no edges to match against")
+
+        xy = self.projection.to_xy(lats, lons)
+        neighbours = self.tree.query_ball_point(xy, radius + EDGE_SAMPLE_SPACING / 2)
+        _, nearest = self.tree.query(xy)
+
+        # Flatten every (point, nearby edge) pair and measure them all at once
+        counts = np.fromiter((len(samples) for samples in neighbours), dtype=np.int64, count=len(neighbours))
+        samples = np.fromiter((s for samples in neighbours for s in samples), dtype=np.int64, count=counts.sum())
+        pairs = np.unique(np.column_stack((np.repeat(np.arange(len(xy)), counts),
+                                           self.sample_edge[samples])), axis=0).reshape(-1, 2)
+        distances, fractions = self.project(xy[pairs[:, 0]], pairs[:, 1])
+        keep = distances <= radius
+
+        # Points with nothing in range fall back to their nearest edge
+        missing = np.setdiff1d(np.arange(len(xy)), pairs[keep, 0])
+        if len(missing):
+            extra = np.column_stack((missing, self.sample_edge[nearest[missing]]))
+            extra_distances, extra_fractions = self.project(xy[missing], extra[:, 1])
+            pairs = np.concatenate((pairs[keep], extra))
+            distances = np.concatenate((distances[keep], extra_distances))
+            fractions = np.concatenate((fractions[keep], extra_fractions))
+        else:
+            pairs, distances, fractions = pairs[keep], distances[keep], fractions[keep]
+
+        order = np.lexsort((distances, pairs[:, 0]))
+        pairs, distances, fractions = pairs[order], distances[order], fractions[order]
+        splits = np.searchsorted(pairs[:, 0], np.arange(1, len(xy)))
+
+        result = []
+        for edges, point_distances, point_fractions in zip(np.split(pairs[:, 1], splits),
+                                                           np.split(distances, splits),
+                                                           np.split(fractions, splits)):
+            if len(edges) > max_candidates:
+                # Edges meeting at a node are equally close; keep all of them
+                keep = point_distances <= point_distances[max_candidates - 1] + 1.0
+                edges, point_distances, point_fractions = edges[keep], point_distances[keep], point_fractions[keep]
+            result.append((edges, point_distances, point_fractions))
+        return result
+
+
+def get_node_index(graph):
+    """
+    Get the node index for a graph, building it on first use.
+
+    The index is cached with the graph's CSR form so it lives exactly as long
+    as the graph stays in the tile store's memory cache.
+    """
+    csr = as_csr(graph)
+    if 'node_index' not in csr.cache:
+        csr.cache['node_index'] = NodeIndex(csr)
+    return csr.cache['node_index']
+
+
+def get_edge_index(graph):
+    """
+    Get the edge index for a graph, building it on first use.
+    """
+    csr = as_csr(graph)
+    if 'edge_index' not in csr.cache:
+        csr.cache['edge_index'] = EdgeIndex(csr)
+    return csr.cache['edge_index']
+
+
+def snap_endpoints(graph, start=None, end=None, loop=False):
+    """
+    Snap a route's optional start and end points to the road network.
+
+    Args:
+        graph: OSMnx graph object or CSRGraph
+        start, end: optional {'lat': value, 'lng': value}
+        loop: a loop with a start and no end finishes back at the start
+
+    Returns:
+        Tuple of (start node, end node), None where there is no point
+    """
+    if loop and end is None:
+        end = start
+    points = [point for point in (start, end) if point is not None]
+    if not points:
+        return None, None
+    nodes, _ = get_node_index(graph).nearest([point['lat'] for point in points],
+                                             [point['lng'] for point in points])
+    nodes = [int(node) for node in nodes]
+    return (nodes[0] if start is not None else None), (nodes[-1] if end is not None else None)
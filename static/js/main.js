@@ -36,18 +36,72 @@ function updateCoordinates(sw, ne) {
     document.getElementById('ne-coords').innerText = `${ne.lat.toFixed(4)}, ${ne.lng.toFixed(4)}`;
 }
 
+// Compact binary route frames, see wire_format.py; JSON is the fallback
+const FRAME_TYPE = 'application/vnd.strava-router.frame';
+const COMPACT_ACCEPT = `${FRAME_TYPE}, application/json;q=0.5`;
+const COORDINATE_SCALE = 1e6;
+
+// Decode a frame: magic, uint32 header length, JSON header, int32 coordinates
+function decodeFrame(buffer) {
+    const view = new DataView(buffer);
+    const magic = String.fromCharCode(view.getUint8(0), view.getUint8(1), view.getUint8(2), view.getUint8(3));
+    if (magic !== 'SRF1') {
+        throw new Error('Not a route frame');
+    }
+    const headerLength = view.getUint32(4, true);
+    const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 8, headerLength)));
+    const coordinates = new Int32Array(buffer, 8 + headerLength);
+
+    // Coordinate lists are {"$coords": [offset, count]}, a first point then deltas
+    function restore(value) {
+        if (Array.isArray(value)) {
+            return value.map(restore);
+        }
+        if (value === null || typeof value !== 'object') {
+            return value;
+        }
+        if (value.$coords) {
+            const [offset, count] = value.$coords;
+            const points = new Array(count);
+            let lat = 0;
+            let lng = 0;
+            for (let i = 0; i < count; i++) {
+                lat += coordinates[2 * (offset + i)];
+                lng += coordinates[2 * (offset + i) + 1];
+                points[i] = [lat / COORDINATE_SCALE, lng / COORDINATE_SCALE];
+            }
+            return points;
+        }
+        const restored = {};
+        for (const key of Object.keys(value)) {
+            restored[key] = restore(value[key]);
+        }
+        return restored;
+    }
+
+    return restore(header);
+}
+
+// Read a response body in whichever encoding the server chose
+async function readPayload(response) {
+    if ((response.headers.get('Content-Type') || '').startsWith(FRAME_TYPE)) {
+        return decodeFrame(await response.arrayBuffer());
+    }
+    return response.json();
+}
+
 // Function to send a POST request with the coordinates
 async function sendPostRequest(data) {
     try {
         const response = await fetch('/update-segments', {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: { 'Content-Type': 'application/json', 'Accept': COMPACT_ACCEPT },
             body: JSON.stringify(data)
         });
         if (!response.ok) {
             throw new Error(`HTTP error! Status: ${response.status}`);
         }
-        return await response.json();
+        return await readPayload(response);
     } catch (error) {
         console.error("Error during POST request:", error);
         throw error;
@@ -125,6 +179,40 @@ function handleResponse(segments) {
     }
 }
 
+// The server keeps this page's route between updates and only routes the
+// segments that changed; created on the first update
+let routeSessionId = null;
+
+async function submitRouteUpdate(body) {
+    if (!routeSessionId) {
+        const created = await fetch('/route-sessions', { method: 'POST' });
+        if (!created.ok) {
+            throw new Error(`HTTP error! Status: ${created.status}`);
+        }
+        routeSessionId = (await created.json()).session_id;
+    }
+    const response = await fetch(`/route-sessions/${routeSessionId}/jobs`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(body)
+    });
+    if (response.status === 404) {
+        // The session expired, start a new one
+        routeSessionId = null;
+        return submitRouteUpdate(body);
+    }
+    if (response.status === 409 && body.segment_ids) {
+        // The server no longer caches these segments, send their points. The
+        // page only has them simplified for the zoom, and matching needs every
+        // point, so fetch them again at full detail
+        const { segment_ids, ...rest } = body;
+        const fetched = await sendPostRequest({ southwest: body.southwest, northeast: body.northeast });
+        const segments = fetched.filter(segment => segment_ids.includes(segment.id));
+        return submitRouteUpdate({ ...rest, segments });
+    }
+    return response;
+}
+
 // Function to find the best path through all segments
 async function findBestPath() {
     if (!window.currentSegments) return;
@@ -137,20 +225,67 @@ async function findBestPath() {
     const ne = { lat: parseFloat(neText[0]), lng: parseFloat(neText[1]) };
 
     try {
-        const response = await fetch('/best-path', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({
-                southwest: sw,
-                northeast: ne,
-                segments: window.currentSegments
-            })
+        const response = await submitRouteUpdate({
+            southwest: sw,
+            northeast: ne,
+            // The server still has the segments it just sent us
+            segment_ids: window.currentSegments.map(segment => segment.id),
+            start: window.startPoint || null,
+            loop: document.getElementById('loop-route').checked,
+            zoom: map.getZoom()
         });
         if (!response.ok) {
             throw new Error(`HTTP error! Status: ${response.status}`);
         }
-        const result = await response.json();
+        const job = await response.json();
 
+        // The server cancels the previous job, stop listening to it too
+        if (window.bestPathEvents) {
+            window.bestPathEvents.close();
+        }
+        // The route itself is fetched compactly once the job is done
+        const events = new EventSource(`/best-path/jobs/${job.job_id}/events?result=0`);
+        window.bestPathEvents = events;
+
+        showPathProgress('Loading road network...');
+        events.addEventListener('graph_loaded', () => showPathProgress('Matching segments...'));
+        events.addEventListener('segment_matched', (e) => {
+            const progress = JSON.parse(e.data);
+            showPathProgress(`Matched segment ${progress.matched} of ${progress.total}`);
+        });
+        events.addEventListener('connectors_built', () => showPathProgress('Ordering segments...'));
+        events.addEventListener('order_solved', () => showPathProgress('Drawing route...'));
+        events.addEventListener('done', async () => {
+            events.close();
+            const result = await fetch(`/best-path/jobs/${job.job_id}/result`, {
+                headers: { 'Accept': COMPACT_ACCEPT }
+            });
+            if (!result.ok) {
+                showPathProgress(`Error finding best path: HTTP ${result.status}`);
+                return;
+            }
+            renderBestPath(await readPayload(result));
+        });
+        events.addEventListener('failed', (e) => {
+            events.close();
+            showPathProgress(`Error finding best path: ${JSON.parse(e.data).error}`);
+        });
+        events.addEventListener('cancelled', () => events.close());
+
+    } catch (error) {
+        console.error("Error finding best path:", error);
+        showPathProgress(`Error finding best path: ${error.message}`);
+    }
+}
+
+// Show a status line while a route is being planned
+function showPathProgress(message) {
+    document.getElementById('path-details').innerHTML = `<p>${message}</p>`;
+}
+
+// Draw a planned route and its details
+function renderBestPath(result) {
+    try {
         // Clear existing path layers
         if (window.pathLayer) {
             window.pathLayer.clearLayers();
@@ -181,6 +316,7 @@ async function findBestPath() {
         
         pathDetailsContainer.innerHTML = `
             <p><strong>Total Distance:</strong> ${(result.total_distance || 0).toFixed(0)} meters</p>
+            <p><strong>Nearest-Neighbour Distance:</strong> ${(result.baseline_distance || 0).toFixed(0)} meters</p>
             <p><strong>Segments Covered:</strong> ${result.segments_covered}</p>
         `;
 
@@ -207,9 +343,8 @@ async function findBestPath() {
         }
 
     } catch (error) {
-        console.error("Error finding best path:", error);
-        let pathDetailsContainer = document.getElementById('path-details');
-        pathDetailsContainer.innerHTML = `<p>Error finding best path: ${error.message}</p>`;
+        console.error("Error drawing best path:", error);
+        showPathProgress(`Error drawing best path: ${error.message}`);
     }
 }
 
@@ -222,7 +357,9 @@ async function updateRectangleCoordinates(layer) {
 
     var data = {
         southwest: { lat: sw.lat, lng: sw.lng },
-        northeast: { lat: ne.lat, lng: ne.lng }
+        northeast: { lat: ne.lat, lng: ne.lng },
+        // Geometry comes back simplified to what this zoom level can show
+        zoom: map.getZoom()
     };
 
     try {
@@ -244,3 +381,20 @@ map.on('draw:created', function (e) {
     // Update coordinates
     updateRectangleCoordinates(layer);
 });
+
+// Click the map to set where the route starts
+map.on('draw:drawstart', function () { window.drawing = true; });
+map.on('draw:drawstop', function () { window.drawing = false; });
+map.on('click', function (e) {
+    if (window.drawing) return;
+    window.startPoint = { lat: e.latlng.lat, lng: e.latlng.lng };
+    if (window.startMarker) {
+        window.startMarker.setLatLng(e.latlng);
+    } else {
+        window.startMarker = L.marker(e.latlng).addTo(map).bindPopup('Start');
+    }
+    findBestPath();
+});
+
+// Re-plan when switching between loop and one-way routes
+document.getElementById('loop-route').addEventListener('change', findBestPath);
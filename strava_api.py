@@ -1,31 +1,167 @@
+import os
+import threading
+import time
+
 import keyring
 import requests
-import osmnx as ox
-import networkx as nx
-import matplotlib.pyplot as plt
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import numpy as np
 import polyline
 
+import map_matching
+import match_cache
+import metrics
+import route_order
+import shortest_paths
+import spatial_index
+from connectors import ConnectorMatrix
+from csr_graph import as_csr
+
+
+# Keyring entries (service, username) holding the Strava API credentials
+CREDENTIAL_KEYS = {
+    'client_id': ('strava_client_id', 'segment_router'),
+    'client_secret': ('strava_client_secret', 'segment_router'),
+    'refresh_token': ('strava_refresh_token', 'segment_router'),
+}
+# Overridable so a local stub server can stand in for Strava
+BASE_URL = os.environ.get('STRAVA_BASE_URL', 'https://www.strava.com/api/v3')
+AUTH_URL = os.environ.get('STRAVA_AUTH_URL', 'https://www.strava.com/oauth/token')
+
+# Seconds to wait on Strava before giving up on a request
+REQUEST_TIMEOUT = 10
+# Refresh the access token this many seconds before it expires
+TOKEN_EXPIRY_MARGIN = 60
+# Longest wait in seconds before a retry, for backoff and Retry-After alike
+MAX_RETRY_WAIT = 2
+
+class CappedRetry(Retry):
+    """
+    Retry that never sleeps longer than MAX_RETRY_WAIT for a Retry-After.
+    """
+    # urllib3 otherwise retries any 429 that carries a Retry-After
+    RETRY_AFTER_STATUS_CODES = frozenset({503})
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return min(retry_after, MAX_RETRY_WAIT) if retry_after is not None else None
 
-# Strava API credentials
-CLIENT_ID = keyring.get_password('strava_client_id', 'segment_router')
-CLIENT_SECRET = keyring.get_password('strava_client_secret', 'segment_router')
-REFRESH_TOKEN = keyring.get_password('strava_refresh_token', 'segment_router')
-BASE_URL = 'https://www.strava.com/api/v3'
+def create_session(retries=3, backoff_factor=0.5):
+    """
+    Create a keep-alive HTTP session that retries transient Strava failures.
+    
+    Only GET requests are retried on 5xx responses and read errors. The
+    OAuth refresh POST is not, since Strava rotates the refresh token and a
+    refresh that succeeded but answered with an error cannot be replayed.
+    Rate limits (429) are not retried either; their windows last minutes,
+    so the error goes straight back to the caller instead of holding a
+    request thread.
+    
+    Args:
+        retries: number of retries on connection errors and 5xx responses
+        backoff_factor: exponential backoff between retries in seconds
+    
+    Returns:
+        requests.Session
+    """
+    retry = CappedRetry(total=retries, backoff_factor=backoff_factor, backoff_max=MAX_RETRY_WAIT,
+                        status_forcelist=(500, 502, 503, 504),
+                        allowed_methods=frozenset({'GET'}), respect_retry_after_header=True)
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=4, pool_maxsize=16)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# One pooled session backs every Strava call, so TLS handshakes are reused
+SESSION = create_session()
+
+def refresh_access_token(client_id, client_secret, refresh_token, session=SESSION):
+    """
+    Exchange a refresh token for a new access token.
+    
+    Returns:
+        Strava token response with 'access_token', 'expires_at' and a
+        possibly rotated 'refresh_token'
+    """
+    with metrics.timed('strava_token'):
+        response = session.post(AUTH_URL, data={
+            'client_id': client_id,
+            'client_secret': client_secret,
+            'grant_type': 'refresh_token',
+            'refresh_token': refresh_token
+        }, timeout=REQUEST_TIMEOUT)
+    metrics.increment('strava_requests_total', call='token', status=response.status_code)
+    response.raise_for_status()  # Raise an error for bad status codes
+    return response.json()
 
 def get_access_token(client_id, client_secret, refresh_token):
     """
     Obtain a new access token using the refresh token.
     """
-    auth_url = 'https://www.strava.com/oauth/token'
-    response = requests.post(auth_url, data={
-        'client_id': client_id,
-        'client_secret': client_secret,
-        'grant_type': 'refresh_token',
-        'refresh_token': refresh_token
-    })
-    response.raise_for_status()  # Raise an error for bad status codes
-    return response.json()['access_token']
+    return refresh_access_token(client_id, client_secret, refresh_token)['access_token']
+
+class TokenManager:
+    """
+    Keeps a Strava access token until it is about to expire.
+    
+    Concurrent requests that find the token stale wait on one refresh
+    instead of each doing their own OAuth round trip. Strava may rotate the
+    refresh token on every refresh; the newest one is kept for the next.
+    """
+
+    def __init__(self, client_id=None, client_secret=None, refresh_token=None, session=SESSION):
+        """
+        Args:
+            client_id, client_secret, refresh_token: Strava API credentials;
+                any left out are read from the keyring on the first refresh
+            session: requests session for the OAuth calls
+        """
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_token = refresh_token
+        self.session = session
+        self._access_token = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+
+    def _valid(self):
+        return self._access_token is not None and time.time() < self._expires_at - TOKEN_EXPIRY_MARGIN
+
+    def get_token(self):
+        """
+        Return a valid access token, refreshing it if needed.
+        """
+        if self._valid():
+            return self._access_token
+        with self._lock:
+            # Another thread may have refreshed while this one waited
+            if not self._valid():
+                self._load_credentials()
+                token = refresh_access_token(self.client_id, self.client_secret,
+                                             self.refresh_token, self.session)
+                self._access_token = token['access_token']
+                self._expires_at = token.get('expires_at', time.time() + token.get('expires_in', 0))
+                self.refresh_token = token.get('refresh_token', self.refresh_token)
+                print(f"Refreshed Strava access token, valid for {self._expires_at - time.time():.0f}s")
+            return self._access_token
+
+    def _load_credentials(self):
+        # Keyring backends can be slow or prompt, so nothing is read until needed
+        for name, (service, username) in CREDENTIAL_KEYS.items():
+            if getattr(self, name) is None:
+                setattr(self, name, keyring.get_password(service, username))
+
+    def invalidate(self):
+        """
+        Forget the cached token, e.g. after Strava rejected it.
+        """
+        with self._lock:
+            self._access_token = None
+            self._expires_at = 0
+
+token_manager = TokenManager()
 
 def search_segments(lat_min, lon_min, lat_max, lon_max, access_token):
     """
@@ -39,7 +175,9 @@ def search_segments(lat_min, lon_min, lat_max, lon_max, access_token):
     headers = {
         'Authorization': f"Bearer {access_token}"
     }
-    response = requests.get(search_url, headers=headers, params=params)
+    with metrics.timed('strava_explore'):
+        response = SESSION.get(search_url, headers=headers, params=params, timeout=REQUEST_TIMEOUT)
+    metrics.increment('strava_requests_total', call='explore', status=response.status_code)
     response.raise_for_status()
     return response.json()
 
@@ -50,46 +188,37 @@ def calculate_deviation(path_nodes, points, graph):
     Args:
         path_nodes: List of node IDs in the path
         points: List of (lat, lon) tuples from decoded points
-        graph: OSMnx graph object
+        graph: OSMnx graph object or CSRGraph
     """
+    csr = as_csr(graph)
+    nodes = csr.index(path_nodes).tolist()
+    points = np.asarray(points, dtype=np.float64)
+    
+    # Straight-line length of every step of the original path at once
+    original_distances = spatial_index.great_circle(points[:-1, 0], points[:-1, 1],
+                                                    points[1:, 0], points[1:, 1])
+    
     total_deviation = 0
-    for i in range(len(points)-1):
-        # Get the segment of the original path
-        start_point = points[i]
-        end_point = points[i+1]
-        
+    for i, original_distance in enumerate(original_distances.tolist()):
         # Find the corresponding nodes in our path
         start_node_idx = i
-        end_node_idx = min(i+1, len(path_nodes)-1)
-        
-        # Calculate the distance between the original path and the node path
-        original_distance = ox.distance.great_circle(
-            start_point[0], start_point[1],
-            end_point[0], end_point[1]
-        )
+        end_node_idx = min(i+1, len(nodes)-1)
         
         node_distance = 0
         for j in range(start_node_idx, end_node_idx):
-            node1 = path_nodes[j]
-            node2 = path_nodes[j+1]
+            node1 = nodes[j]
+            node2 = nodes[j+1]
             
             # Check if there's a direct edge between these nodes
-            if graph.has_edge(node1, node2):
-                node_distance += graph.edges[node1, node2, 0]['length']
-            else:
+            length = csr.edge_length(node1, node2)
+            if length is None:
                 # If no direct edge, try to find the shortest path
-                try:
-                    path = nx.shortest_path(graph, node1, node2, weight='length')
-                    # Sum up the lengths of all edges in the path
-                    for k in range(len(path)-1):
-                        if graph.has_edge(path[k], path[k+1]):
-                            node_distance += graph.edges[path[k], path[k+1], 0]['length']
-                except nx.NetworkXNoPath:
-                    # If no path exists, use the straight-line distance
-                    node_distance += ox.distance.great_circle(
-                        graph.nodes[node1]['y'], graph.nodes[node1]['x'],
-                        graph.nodes[node2]['y'], graph.nodes[node2]['x']
-                    )
+                length, _ = shortest_paths.astar(csr, node1, node2)
+            if length == float('inf'):
+                # If no path exists, use the straight-line distance
+                length = float(spatial_index.great_circle(csr.lat[node1], csr.lon[node1],
+                                                          csr.lat[node2], csr.lon[node2]))
+            node_distance += length
         
         total_deviation += abs(original_distance - node_distance)
     
@@ -100,7 +229,94 @@ def find_best_path_nodes(graph, points, max_deviation=50):
     Find the best sequence of nodes that minimizes deviation from the original path.
     
     Args:
-        graph: OSMnx graph object
+        graph: OSMnx graph object or CSRGraph
+        points: List of (lat, lon) tuples from decoded points
+        max_deviation: Maximum allowed deviation in meters from original path
+    
+    Returns:
+        List of node IDs that best approximate the path
+    """
+    try:
+        if not points or len(points) < 2:
+            raise ValueError("Need at least 2 points to find a path")
+
+        # Match the polyline onto the road network
+        result = map_matching.match_polyline(graph, points, radius=max_deviation)
+        return result['nodes']
+
+    except Exception as e:
+        print(f"Error in find_best_path_nodes: {str(e)}")
+        raise
+
+def find_segment_path_nodes(graph, segment_points, max_deviation=50, progress=None,
+                            segment_ids=None, cache=None):
+    """
+    Find the best node sequence for several segments at once.
+    
+    Candidate edges for every point of every segment are looked up in a
+    single spatial index query before each segment is matched. With a
+    match cache, only segments not matched before on the same road data
+    are matched again.
+    
+    Args:
+        graph: OSMnx graph object or CSRGraph
+        segment_points: List of point lists, one per segment
+        max_deviation: Maximum allowed deviation in meters from original path
+        progress: optional callable(matched, total) run after each segment
+        segment_ids: optional Strava segment ids used as cache keys
+        cache: optional MatchCache
+    
+    Returns:
+        List of node ID lists, one per segment
+    """
+    for points in segment_points:
+        if not points or len(points) < 2:
+            raise ValueError("Need at least 2 points to find a path")
+
+    if cache is None:
+        results = map_matching.match_polylines(graph, segment_points, radius=max_deviation,
+                                               progress=progress)
+        return [result['nodes'] for result in results]
+
+    csr = as_csr(graph)
+    if segment_ids is None:
+        segment_ids = [''] * len(segment_points)
+    keys = [(segment_id, f"{match_cache.polyline_hash(points)}@{max_deviation}",
+             match_cache.region_version(csr, points))
+            for segment_id, points in zip(segment_ids, segment_points)]
+    paths = cache.get_matches(keys)
+    for i, path in enumerate(paths):
+        if path is None:
+            continue
+        try:
+            csr.index(path)
+        except KeyError:
+            # Matched on nodes this graph does not have
+            paths[i] = None
+
+    missing = [i for i, path in enumerate(paths) if path is None]
+    hits = len(paths) - len(missing)
+    print(f"Match cache: {hits} of {len(paths)} segments already matched")
+    if progress is not None and hits:
+        progress(hits, len(paths))
+    if missing:
+        results = map_matching.match_polylines(
+            csr, [segment_points[i] for i in missing], radius=max_deviation,
+            progress=None if progress is None else lambda matched, total: progress(hits + matched, len(paths)))
+        for i, result in zip(missing, results):
+            paths[i] = result['nodes']
+        cache.put_matches([keys[i] + (paths[i],) for i in missing])
+    return paths
+
+def find_best_path_nodes_greedy(graph, points, max_deviation=50):
+    """
+    Find the best sequence of nodes that minimizes deviation from the original path.
+
+    This is the original remove-one-node search, kept as a baseline for the
+    map-matching benchmark. It is cubic or worse in the number of points.
+    
+    Args:
+        graph: OSMnx graph object or CSRGraph
         points: List of (lat, lon) tuples from decoded points
         max_deviation: Maximum allowed deviation in meters from original path
     
@@ -114,20 +330,9 @@ def find_best_path_nodes(graph, points, max_deviation=50):
         # Convert points to numpy array for easier calculations
         points_array = np.array(points)
         
-        # Get all nodes within max_deviation meters of the path
-        nodes = []
-        for point in points:
-            try:
-                # Get all nodes within max_deviation meters
-                nearby_nodes = ox.distance.nearest_nodes(graph, 
-                                                       [point[1]],  # longitude
-                                                       [point[0]],  # latitude
-                                                       return_dist=True)
-                if nearby_nodes[0] is not None:
-                    nodes.extend(nearby_nodes[0])
-            except Exception as e:
-                print(f"Error finding nearest nodes for point {point}: {str(e)}")
-                continue
+        # Snap every point to its nearest node in one query
+        nodes, _ = spatial_index.get_node_index(graph).nearest(points_array[:, 0], points_array[:, 1])
+        nodes = nodes.tolist()
         
         if not nodes:
             raise ValueError("No nodes found near the path points")
@@ -157,74 +362,59 @@ def find_best_path_nodes(graph, points, max_deviation=50):
         return best_path
 
     except Exception as e:
-        print(f"Error in find_best_path_nodes: {str(e)}")
+        print(f"Error in find_best_path_nodes_greedy: {str(e)}")
         raise
 
-def find_optimal_path_order(graph, paths):
+def find_optimal_path_order(graph, paths, connectors=None, loop=False, method='auto',
+                            time_budget=route_order.TIME_BUDGET):
     """
     Find the optimal order to traverse multiple paths to minimize total distance.
     
     Args:
-        graph: OSMnx graph object
+        graph: OSMnx graph object or CSRGraph
         paths: List of lists, where each inner list contains node IDs representing a path
+        connectors: ConnectorMatrix already built for these paths, built here if omitted.
+            Its start and end nodes, if any, fix where the route begins and ends.
+        loop: return to the start (or to the first segment) at the end
+        method: ordering engine, see route_order.SOLVERS
+        time_budget: seconds allowed for local search on large inputs
     
     Returns:
         Tuple of (optimal order of paths, total distance)
     """
-    # Create a distance matrix between all path endpoints
-    n_paths = len(paths)
-    distance_matrix = np.zeros((n_paths, n_paths))
-    
-    # Calculate distances between all path endpoints
-    for i in range(n_paths):
-        for j in range(n_paths):
-            if i != j:
-                # Get the end node of path i and start node of path j
-                end_node = paths[i][-1]
-                start_node = paths[j][0]
-                
-                try:
-                    # Try to find the shortest path between these nodes
-                    path = nx.astar_path(graph, end_node, start_node, 
-                                       heuristic=lambda u, v: ox.distance.great_circle(
-                                           graph.nodes[u]['y'], graph.nodes[u]['x'],
-                                           graph.nodes[v]['y'], graph.nodes[v]['x']
-                                       ),
-                                       weight='length')
-                    
-                    # Calculate the total length of this connecting path
-                    total_length = sum(graph.edges[path[k], path[k+1], 0]['length'] 
-                                     for k in range(len(path)-1))
-                    distance_matrix[i, j] = total_length
-                except nx.NetworkXNoPath:
-                    # If no path exists, use a very large number
-                    distance_matrix[i, j] = float('inf')
-    
-    # Now solve the TSP to find the optimal order
-    def solve_tsp(distance_matrix):
-        n = len(distance_matrix)
-        # Start with path 0
-        path = [0]
-        unvisited = set(range(1, n))
-        
-        while unvisited:
-            current = path[-1]
-            # Find the nearest unvisited path
-            nearest = min(unvisited, key=lambda x: distance_matrix[current, x])
-            path.append(nearest)
-            unvisited.remove(nearest)
-        
-        return path
+    result = plan_path_order(graph, paths, connectors, loop, method, time_budget)
+    return result['order'], result['cost']
+
+def plan_path_order(graph, paths, connectors=None, loop=False, method='auto',
+                    time_budget=route_order.TIME_BUDGET, initial_order=None):
+    """
+    Solve the segment ordering and report how it compares with the old heuristic.
     
-    # Get the optimal order
-    optimal_order = solve_tsp(distance_matrix)
+    Takes the same arguments as find_optimal_path_order, plus an optional
+    initial_order to warm-start the solver from, see route_order.solve_order.
     
-    # Calculate total distance
-    total_distance = 0
-    for i in range(len(optimal_order)-1):
-        total_distance += distance_matrix[optimal_order[i], optimal_order[i+1]]
-    
-    return optimal_order, total_distance
+    Returns:
+        Dictionary from route_order.solve_order with 'order', 'cost',
+        'baseline_cost', 'gap' and 'method'
+    """
+    # Distances from every path end to every path start, one search per end
+    if connectors is None:
+        connectors = ConnectorMatrix(graph, paths)
+
+    end_distances = connectors.end_distances
+    if loop and connectors.start_node is not None and end_distances is None:
+        raise ValueError("Loop routes with a start point need the start as end node")
+
+    result = route_order.solve_order(connectors.distances,
+                                     start_costs=connectors.start_distances,
+                                     end_costs=end_distances,
+                                     loop=loop,
+                                     method=method,
+                                     time_budget=time_budget,
+                                     initial_order=initial_order)
+    print(f"Ordered {len(paths)} paths with {result['method']}: {result['cost']:.0f} m, "
+          f"{result['gap'] * 100:.1f}% shorter than nearest neighbour")
+    return result
 
 def connect_optimal_path(graph, paths, optimal_order):
     """
@@ -235,6 +425,9 @@ def connect_optimal_path(graph, paths, optimal_order):
         paths: List of lists of node IDs
         optimal_order: List indicating the order to traverse the paths
     """
+    # Only this plotting helper needs them, and they are slow to import
+    import networkx as nx
+    import osmnx as ox
     
     # Plot the connecting paths between segments
     for i in range(len(optimal_order)-1):
@@ -0,0 +1,137 @@
+import threading
+import time
+
+import metrics
+import spatial_index
+
+
+def parse_regions(text):
+    """
+    Parse regions given as "lat_min,lon_min,lat_max,lon_max" separated by ';'.
+
+    Returns:
+        List of (north, south, east, west) tuples
+    """
+    regions = []
+    for part in (text or '').split(';'):
+        if part.strip():
+            lat_min, lon_min, lat_max, lon_max = (float(value) for value in part.split(','))
+            regions.append((lat_max, lat_min, lon_max, lon_min))
+    return regions
+
+
+class WarmUp:
+    """
+    Background preloading of road graphs and their indexes.
+
+    For each region graphs are loaded from the tile store, downloading
+    missing tiles, and their node and edge indexes built. Those graphs are
+    the viewports precomputed inside the region if there are any, else the
+    region itself. Requests inside a region look up the graph it was warmed
+    with (find_bounds) instead of stitching one for their own bounding box,
+    so the first /best-path there only plans. Landmark indexes come with
+    the graphs when the tile store has them.
+    """
+
+    def __init__(self, store, regions, viewports=None, network_type='walk', max_graphs=8):
+        """
+        Args:
+            store: GraphTileStore or RemoteGraphStore
+            regions: list of (north, south, east, west) bounding boxes
+            viewports: optional callable(north, south, east, west) returning
+                the precomputed viewport bounds inside a region
+            network_type: network loaded
+            max_graphs: graphs loaded at most, the store keeps no more in memory
+        """
+        self.store = store
+        self.regions = regions
+        self.viewports = viewports
+        self.network_type = network_type
+        self.max_graphs = max_graphs
+        self.state = 'idle' if regions else 'ready'
+        self.graphs_total = 0
+        self.graphs_done = 0
+        self.errors = []
+        self.warmed = []
+        self.started_at = None
+        self.finished_at = None
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self.state == 'ready'
+
+    def start(self):
+        """
+        Start warming up in a daemon thread; does nothing without regions.
+        """
+        if self.state != 'idle':
+            return
+        self.state = 'warming'
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name='warm-up', daemon=True)
+        self._thread.start()
+
+    def wait(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self.ready
+
+    def _graph_bounds(self):
+        bounds = []
+        for region in self.regions:
+            inside = self.viewports(*region) if self.viewports is not None else []
+            bounds.extend(inside or [region])
+        # Later graphs would evict earlier ones from the store's memory
+        return list(dict.fromkeys(bounds))[:self.max_graphs]
+
+    def _run(self):
+        bounds = self._graph_bounds()
+        self.graphs_total = len(bounds)
+        for north, south, east, west in bounds:
+            try:
+                with metrics.timed('warm_up'):
+                    graph = self.store.get_csr(north, south, east, west, self.network_type)
+                    if graph.n_nodes:
+                        spatial_index.get_node_index(graph)
+                        spatial_index.get_edge_index(graph)
+                print(f"Warmed up graph with {graph.n_nodes} nodes for {(north, south, east, west)}")
+                self.warmed.append((north, south, east, west))
+            except Exception as e:
+                # A region that fails to load is reported, the rest still warm up
+                print(f"Warm-up failed for {(north, south, east, west)}: {e}")
+                self.errors.append({'bounds': [north, south, east, west], 'error': str(e)})
+            self.graphs_done += 1
+        self.finished_at = time.time()
+        self.state = 'ready'
+        print(f"Warm-up finished in {self.finished_at - self.started_at:.1f}s, "
+              f"{self.graphs_done - len(self.errors)} of {self.graphs_total} graphs loaded")
+
+    def find_bounds(self, north, south, east, west):
+        """
+        Find the smallest warmed graph containing a bounding box.
+
+        Returns:
+            (north, south, east, west) the graph was loaded with, or None
+        """
+        inside = [bounds for bounds in self.warmed
+                  if bounds[0] >= north and bounds[1] <= south and bounds[2] >= east and bounds[3] <= west]
+        if not inside:
+            return None
+        return min(inside, key=lambda bounds: (bounds[0] - bounds[1]) * (bounds[2] - bounds[3]))
+
+    def status(self):
+        """
+        Progress for the readiness endpoint.
+        """
+        elapsed = None
+        if self.started_at is not None:
+            elapsed = (self.finished_at or time.time()) - self.started_at
+        return {
+            'ready': self.ready,
+            'state': self.state,
+            'graphs_total': self.graphs_total,
+            'graphs_done': self.graphs_done,
+            'errors': self.errors,
+            'seconds': elapsed,
+        }
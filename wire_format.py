@@ -0,0 +1,128 @@
+import json
+import struct
+
+import numpy as np
+import polyline
+
+
+# Media types a client can ask for in its Accept header
+JSON_TYPE = 'application/json'
+POLYLINE_TYPE = 'application/vnd.strava-router.polyline+json'
+FRAME_TYPE = 'application/vnd.strava-router.frame'
+MEDIA_TYPES = (JSON_TYPE, POLYLINE_TYPE, FRAME_TYPE)
+
+# Payload keys holding lists of [lat, lon] pairs
+COORDINATE_KEYS = ('points', 'path')
+# Coordinates are sent as integer microdegrees, about 0.1 m
+COORDINATE_SCALE = 1e6
+POLYLINE_PRECISION = 6
+FRAME_MAGIC = b'SRF1'
+
+
+def negotiate(accept_mimetypes):
+    """
+    Pick the response encoding for a request.
+
+    Args:
+        accept_mimetypes: the request's werkzeug MIMEAccept
+
+    Returns:
+        One of MEDIA_TYPES, JSON_TYPE unless the client asks for another
+    """
+    return accept_mimetypes.best_match(MEDIA_TYPES, default=JSON_TYPE) or JSON_TYPE
+
+
+def _replace_coordinates(payload, replace):
+    """
+    Copy a JSON-like payload with every coordinate list passed through replace.
+    """
+    if isinstance(payload, dict):
+        return {key: replace(value) if key in COORDINATE_KEYS and isinstance(value, list)
+                else _replace_coordinates(value, replace)
+                for key, value in payload.items()}
+    if isinstance(payload, list):
+        return [_replace_coordinates(value, replace) for value in payload]
+    return payload
+
+
+def encode_polylines(payload):
+    """
+    Encode a payload as JSON with coordinate lists as Google polyline strings.
+
+    Returns:
+        UTF-8 JSON bytes
+    """
+    encoded = _replace_coordinates(payload, lambda points: polyline.encode(
+        [tuple(point) for point in points], POLYLINE_PRECISION))
+    return json.dumps(encoded, separators=(',', ':')).encode()
+
+
+def encode_frame(payload):
+    """
+    Encode a payload as a binary frame.
+
+    The frame is FRAME_MAGIC, the little-endian uint32 length of a JSON
+    header, the header padded to 4 bytes, then little-endian int32
+    coordinates. Each coordinate list in the header is replaced by
+    {"$coords": [offset, count]}, pointing at count points from point
+    offset in the coordinate block. A list stores its first point in
+    microdegrees and every following point as the difference from the
+    previous one.
+
+    Returns:
+        Frame bytes
+    """
+    blocks = []
+    offset = [0]
+
+    def replace(points):
+        quantized = np.round(np.asarray(points, dtype=np.float64).reshape(-1, 2) * COORDINATE_SCALE).astype(np.int64)
+        deltas = quantized.copy()
+        deltas[1:] -= quantized[:-1]
+        blocks.append(deltas)
+        reference = {'$coords': [offset[0], len(deltas)]}
+        offset[0] += len(deltas)
+        return reference
+
+    header = json.dumps(_replace_coordinates(payload, replace), separators=(',', ':')).encode()
+    header += b' ' * (-len(header) % 4)
+    coordinates = np.concatenate(blocks) if blocks else np.zeros((0, 2), dtype=np.int64)
+    return FRAME_MAGIC + struct.pack('<I', len(header)) + header + coordinates.astype('<i4').tobytes()
+
+
+def decode_frame(data):
+    """
+    Decode a binary frame back into a payload, the inverse of encode_frame.
+    """
+    if data[:4] != FRAME_MAGIC:
+        raise ValueError('Not a route frame')
+    header_length, = struct.unpack_from('<I', data, 4)
+    header = json.loads(data[8:8 + header_length])
+    coordinates = np.frombuffer(data, dtype='<i4', offset=8 + header_length).reshape(-1, 2)
+
+    def restore(value):
+        if isinstance(value, dict):
+            if '$coords' in value:
+                start, count = value['$coords']
+                points = np.cumsum(coordinates[start:start + count].astype(np.int64), axis=0)
+                return (points / COORDINATE_SCALE).tolist()
+            return {key: restore(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [restore(item) for item in value]
+        return value
+
+    return restore(header)
+
+
+def encode(payload, media_type):
+    """
+    Encode a payload in a negotiated media type.
+
+    Returns:
+        Response body bytes
+    """
+    if media_type == FRAME_TYPE:
+        return encode_frame(payload)
+    if media_type == POLYLINE_TYPE:
+        return encode_polylines(payload)
+    return json.dumps(payload, separators=(',', ':')).encode()